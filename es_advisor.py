@@ -0,0 +1,424 @@
+## es_advisor.py - shard consolidation advice for small customers
+##
+## Every daily customer-YYYY.MM.DD index costs its shard count in heap on
+## the nodes that hold it and an entry per index and per shard copy in
+## the cluster state.  Customers whose daily indexes are small get little
+## from their shards, so for each customer whose average daily primary
+## size is below smallIndexBytes three ways of having fewer shards are
+## compared:
+##   shrink   each daily index to the smallest factor of its primary
+##            count that still keeps shards under targetShardBytes
+##   weekly   reindex the days of each week into customer-DATE-weekly
+##   monthly  reindex the days of each month into customer-DATE-monthly
+## and the one leaving the fewest shard copies is proposed (shrink wins
+## ties: it is the cheapest to run).  Either way the daily names stay on
+## as aliases of the index that replaced them.
+## The newest index, and for roll-ups the week or month it falls in, is
+## still being written and is left alone, as are indexes that already
+## are the result of a consolidation.  New names keep a -YYYY.MM.DD part
+## so splitIndexName still files them under the customer.
+##
+## Cluster state savings are estimated from the es_state breakdown: the
+## metadata section divided over the indexes and the routing sections
+## divided over the shard copies.
+##
+## applyPlans runs the plans 'parallel' at a time, in batches, waiting
+## for the cluster to be green between batches.  A plan that fails part
+## way deletes the target it created and puts the sources' settings back,
+## so it can be applied again.  _shrink needs ES 5 or later, _reindex 2.3
+## or later.
+
+import json
+import math
+import time
+import logging
+from datetime import date, timedelta
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import es_cat
+import es_client
+import es_aggregate
+
+## Customers whose average daily primary size is below this are advised.
+smallIndexBytes = 1024 * 1024 * 1024
+
+## Primary shard size consolidation aims to stay under.
+targetShardBytes = 10 * 1024 * 1024 * 1024
+
+## Suffixes given to consolidated indexes, in tie break order.
+actions = ('shrink', 'weekly', 'monthly')
+
+## Seconds between progress polls while applying, and how long any one
+## step may take.
+pollInterval = 10
+stepTimeout = 4 * 3600
+
+## sources: list of index names consumed; shards/replicas: of the target
+## shardsBefore/shardsAfter: shard copies (primaries * (1 + replicas))
+Plan = namedtuple('Plan', 'customer action sources target shards replicas docs bytes shardsBefore shardsAfter')
+
+
+class ConsolidationError(Exception):
+  pass
+
+
+def _consolidated(name):
+  return name.rsplit('-', 1)[-1] in actions
+
+
+def _shardsFor(size):
+  return max(1, int(math.ceil(float(size) / targetShardBytes)))
+
+
+def _shrinkTo(primaries, size):
+  """
+  Smallest factor of primaries that keeps shards under targetShardBytes.
+  """
+  need = _shardsFor(size)
+  for factor in xrange(need, primaries + 1):
+    if primaries % factor == 0:
+      return factor
+  return primaries
+
+
+def _period(action, idxDate):
+  """
+  First day of the week or month idxDate falls in, as YYYY.MM.DD.
+  """
+  day = date.fromordinal(es_aggregate.dateOrdinal(idxDate))
+  if action == 'weekly':
+    day -= timedelta(days=day.weekday())
+  else:
+    day = day.replace(day=1)
+  return day.strftime("%Y.%m.%d")
+
+
+def _shrinkPlans(customer, rows):
+  plans = []
+  for (name, idxDate, pri, rep, docs, size) in rows:
+    shards = _shrinkTo(pri, size)
+    if shards < pri:
+      plans.append(Plan(customer, 'shrink', [name], "%s-%s-shrink" % (customer, idxDate), shards, rep,
+                        docs, size, pri * (1 + rep), shards * (1 + rep)))
+  return plans
+
+
+def _rollupPlans(customer, action, rows, current):
+  periods = {}
+  for row in rows:
+    period = _period(action, row[1])
+    if period != current:
+      periods.setdefault(period, []).append(row)
+  plans = []
+  for (period, group) in sorted(periods.items()):
+    if len(group) < 2:
+      continue
+    size = sum(row[5] for row in group)
+    rep = max(row[3] for row in group)
+    shards = _shardsFor(size)
+    plans.append(Plan(customer, action, sorted(row[0] for row in group),
+                      "%s-%s-%s" % (customer, period, action), shards, rep,
+                      sum(row[4] for row in group), size,
+                      sum(row[2] * (1 + row[3]) for row in group), shards * (1 + rep)))
+  return plans
+
+
+def advise(indexes, small = smallIndexBytes):
+  """
+  Consolidation plans for customers whose daily indexes average below
+  'small' primary bytes.  indexes is a dict of index ->
+  (customer, date, primaries, replicas, docs, primary bytes).
+
+  returns list of Plan, ordered by customer then source
+  """
+  customers = {}
+  for (name, (customer, idxDate, pri, rep, docs, size)) in indexes.iteritems():
+    if idxDate != es_aggregate.orphanDate:
+      customers.setdefault(customer, []).append((name, idxDate, pri, rep, docs, size))
+
+  advice = []
+  for (customer, rows) in sorted(customers.items()):
+    daily = sorted(row for row in rows if not _consolidated(row[0]))
+    if not daily or sum(row[5] for row in daily) / len(daily) >= small:
+      continue
+    newest = max(row[1] for row in rows)
+    settled = [row for row in daily if row[1] != newest]
+
+    best = None
+    for action in actions:
+      if action == 'shrink':
+        plans = _shrinkPlans(customer, settled)
+      else:
+        plans = _rollupPlans(customer, action, settled, _period(action, newest))
+      saved = sum(p.shardsBefore - p.shardsAfter for p in plans)
+      if saved > 0 and (best is None or saved > best[0]):
+        best = (saved, plans)
+    if best:
+      advice.extend(best[1])
+  return advice
+
+
+def stateCosts(stateSections, indexCount, copyCount):
+  """
+  Cluster state bytes per index and per shard copy, from an
+  es_state.stateBreakdown section dict.
+
+  returns (bytes per index, bytes per shard copy)
+  """
+  perIndex = float(stateSections.get('metadata', 0)) / max(indexCount, 1)
+  perCopy = float(stateSections.get('routing_table', 0) +
+                  stateSections.get('routing_nodes', 0)) / max(copyCount, 1)
+  return (perIndex, perCopy)
+
+
+def savings(plan, costs):
+  """
+  returns (shard copies saved, cluster state bytes saved)
+  """
+  copies = plan.shardsBefore - plan.shardsAfter
+  return (copies, (len(plan.sources) - 1) * costs[0] + copies * costs[1])
+
+
+#########################################
+## Applying plans
+
+def _json(data):
+  return json.dumps(data)
+
+
+def _waitFor(esMaster, esPort, index, params):
+  """
+  Block on _cluster/health for index until params hold, stepTimeout at most.
+  """
+  query = {'timeout': '%ds' % stepTimeout}
+  query.update(params)
+  health = es_client.get(esMaster, esPort, '_cluster/health/' + index, params=query,
+                         timeout=stepTimeout + 60).json()
+  if health.get('timed_out'):
+    raise ConsolidationError("%s: timed out waiting for %s" % (index, params))
+
+
+def _count(esMaster, esPort, indexes):
+  return es_client.get(esMaster, esPort, ','.join(indexes) + '/_count').json()['count']
+
+
+def _shrinkNode(esMaster, esPort, index):
+  """
+  The node holding the most primaries of index.
+  """
+  nodes = {}
+  shards = es_cat.cat(esMaster, esPort, 'shards/' + index, ('node',),
+                      where={'prirep': ('p',), 'state': ('STARTED',)}).data
+  for node in shards['node']:
+    nodes[node] = nodes.get(node, 0) + 1
+  if not nodes:
+    raise ConsolidationError("%s: no started primaries" % index)
+  return max(sorted(nodes), key=nodes.get)
+
+
+def _indexSettings(esMaster, esPort, index):
+  """
+  returns the flat settings of index
+  """
+  data = es_client.get(esMaster, esPort, index + '/_settings', params={'flat_settings': 'true'}).json()
+  return data.values()[0]['settings']
+
+
+def _exists(esMaster, esPort, index):
+  """
+  Whether an index or alias answers to the name.
+  """
+  try:
+    es_client.get(esMaster, esPort, index + '/_settings')
+  except requests.HTTPError, e:
+    if e.response is not None and e.response.status_code == 404:
+      return False
+    raise
+  return True
+
+
+def _swapped(esMaster, esPort, target, alias):
+  """
+  Whether target already carries alias, i.e. the swap of a step that
+  got no answer went through.  When that cannot be told, it is taken
+  to have, so the target is kept.
+  """
+  try:
+    es_client.get(esMaster, esPort, '%s/_alias/%s' % (target, alias))
+  except requests.HTTPError, e:
+    return e.response is None or e.response.status_code != 404
+  except requests.RequestException:
+    return True
+  return True
+
+
+def _rollback(esMaster, esPort, plan, created, index, settings):
+  """
+  Undo a failed step: delete the target if this run created it, then
+  put settings back on index.  Failures here are logged, not raised, so
+  the error that caused them is the one reported.
+
+  returns True if the swap to the target had in fact been made, in
+  which case nothing is undone
+  """
+  if created:
+    if _swapped(esMaster, esPort, plan.target, plan.sources[0]):
+      return True
+    try:
+      es_client.delete(esMaster, esPort, plan.target)
+    except requests.HTTPError, e:
+      if e.response is None or e.response.status_code != 404:
+        logging.error("%s: could not delete it: %s" % (plan.target, e))
+    except requests.RequestException, e:
+      logging.error("%s: could not delete it: %s" % (plan.target, e))
+  try:
+    es_client.put(esMaster, esPort, index + '/_settings', _json(settings))
+  except requests.RequestException, e:
+    logging.error("%s: could not restore %s: %s" % (index, settings, e))
+  return False
+
+
+def _swap(esMaster, esPort, plan):
+  """
+  Replace the sources with aliases of the same names to the target.
+  One call, so each name always answers: from its source until the
+  alias to the target replaces it.
+  """
+  es_client.post(esMaster, esPort, '_aliases', _json({
+    'actions': [{'add': {'index': plan.target, 'alias': source}} for source in plan.sources] +
+               [{'remove_index': {'index': source}} for source in plan.sources]}))
+
+
+def shrinkIndex(esMaster, esPort, plan):
+  """
+  Gather a copy of every shard on one node, shrink, and replace the
+  source with an alias of the same name.  If any step fails the target
+  is deleted and the source gets its replicas, write block and
+  allocation back.
+  """
+  (source,) = plan.sources
+  if _exists(esMaster, esPort, plan.target):
+    raise ConsolidationError("%s already exists" % plan.target)
+  node = _shrinkNode(esMaster, esPort, source)
+  current = _indexSettings(esMaster, esPort, source)
+  original = dict((key, current.get(key)) for key in (
+    'index.number_of_replicas', 'index.blocks.write', 'index.routing.allocation.require._name'))
+  logging.info("%s: gathering shards on %s" % (source, node))
+  es_client.put(esMaster, esPort, source + '/_settings', _json({
+    'index.routing.allocation.require._name': node,
+    'index.blocks.write': True,
+    'index.number_of_replicas': 0}))
+  created = False
+  try:
+    _waitFor(esMaster, esPort, source, {'wait_for_no_relocating_shards': 'true'})
+    before = _count(esMaster, esPort, [source])
+
+    created = True
+    es_client.post(esMaster, esPort, '%s/_shrink/%s' % (source, plan.target), _json({
+      'settings': {'index.number_of_shards': plan.shards,
+                   'index.number_of_replicas': plan.replicas,
+                   'index.routing.allocation.require._name': None,
+                   'index.blocks.write': None}}))
+    _waitFor(esMaster, esPort, plan.target, {'wait_for_status': 'green'})
+    after = _count(esMaster, esPort, [plan.target])
+    if after != before:
+      raise ConsolidationError("%s: %d docs, %s has %d; source kept" % (source, before, plan.target, after))
+    _swap(esMaster, esPort, plan)
+  except Exception:
+    if not _rollback(esMaster, esPort, plan, created, source, original):
+      raise
+    logging.warn("%s: alias swap got no answer but was made" % plan.target)
+
+
+def rollupIndexes(esMaster, esPort, plan):
+  """
+  Reindex the sources into the target and, once the document counts
+  agree, replace the sources with aliases of the same names.  If any
+  step fails the target is deleted and the sources' write block is
+  lifted again.
+  """
+  sources = ','.join(plan.sources)
+  if _exists(esMaster, esPort, plan.target):
+    raise ConsolidationError("%s already exists" % plan.target)
+  es_client.put(esMaster, esPort, sources + '/_settings', _json({'index.blocks.write': True}))
+  created = False
+  try:
+    before = _count(esMaster, esPort, plan.sources)
+
+    created = True
+    es_client.put(esMaster, esPort, plan.target, _json({
+      'settings': {'index.number_of_shards': plan.shards,
+                   'index.number_of_replicas': plan.replicas}}))
+    task = es_client.post(esMaster, esPort, '_reindex', _json({
+      'source': {'index': plan.sources}, 'dest': {'index': plan.target}}),
+      params={'wait_for_completion': 'false'}).json()['task']
+    logging.info("%s: reindex task %s for %d indexes" % (plan.target, task, len(plan.sources)))
+
+    deadline = time.time() + stepTimeout
+    while True:
+      status = es_client.get(esMaster, esPort, '_tasks/' + task).json()
+      if status.get('completed'):
+        break
+      if time.time() > deadline:
+        raise ConsolidationError("%s: reindex task %s still running" % (plan.target, task))
+      time.sleep(pollInterval)
+    failures = status.get('response', {}).get('failures') or status.get('error')
+    if failures:
+      raise ConsolidationError("%s: reindex failed: %s" % (plan.target, failures))
+
+    _waitFor(esMaster, esPort, plan.target, {'wait_for_status': 'green'})
+    es_client.post(esMaster, esPort, plan.target + '/_refresh')
+    after = _count(esMaster, esPort, [plan.target])
+    if after != before:
+      raise ConsolidationError("%s: %d docs in sources, %d in target; sources kept" % (plan.target, before, after))
+    _swap(esMaster, esPort, plan)
+  except Exception:
+    if not _rollback(esMaster, esPort, plan, created, sources, {'index.blocks.write': None}):
+      raise
+    logging.warn("%s: alias swap got no answer but was made" % plan.target)
+
+
+def _apply(args):
+  (esMaster, esPort, plan) = args
+  start = time.time()
+  try:
+    if plan.action == 'shrink':
+      shrinkIndex(esMaster, esPort, plan)
+    else:
+      rollupIndexes(esMaster, esPort, plan)
+  except (requests.RequestException, ConsolidationError, KeyError, ValueError), e:
+    logging.error("%s -> %s failed: %s" % (",".join(plan.sources), plan.target, e))
+    return (plan, str(e))
+  logging.info("%s -> %s done in %ds" % (",".join(plan.sources), plan.target, time.time() - start))
+  return (plan, None)
+
+
+def applyPlans(esMaster, esPort, plans, parallel = 2, batch = 20):
+  """
+  Run the plans, at most 'parallel' at once, 'batch' plans between
+  waits for a green cluster.  A failed plan leaves its sources in place.
+  If the cluster does not get back to green the remaining plans are not
+  run and are returned with that error.
+
+  returns list of (plan, error message or None)
+  """
+  results = []
+  pool = ThreadPool(max(1, parallel))
+  try:
+    for first in xrange(0, len(plans), batch):
+      chunk = plans[first:first + batch]
+      results.extend(pool.map(_apply, [(esMaster, esPort, plan) for plan in chunk], 1))
+      logging.info("Batch of %d done, %d of %d plans" % (len(chunk), len(results), len(plans)))
+      try:
+        _waitFor(esMaster, esPort, '', {'wait_for_status': 'green'})
+      except (requests.RequestException, ConsolidationError, ValueError), e:
+        logging.error("Cluster not green after %d of %d plans, stopping: %s" % (len(results), len(plans), e))
+        results.extend((plan, "not run: cluster not green: %s" % e) for plan in plans[len(results):])
+        break
+  finally:
+    pool.close()
+    pool.join()
+  return results
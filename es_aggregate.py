@@ -0,0 +1,104 @@
+## es_aggregate.py - single pass per-customer index aggregation
+##
+## Daily indexes are named customer-YYYY.MM.DD.  Each index row is folded
+## into a small per-customer record as it is read, so nothing has to be
+## kept per index and nothing has to be sorted except the customer names.
+##
+## YYYY.MM.DD strings sort the same way as the dates they name, so oldest
+## and newest are tracked by plain string comparison.  Dates are only
+## parsed to compute retention, once per distinct string.
+
+import re
+from datetime import datetime
+
+## Sentinels used before any index has been seen for a customer.
+oldestSentinel = "2038.12.31"
+newestSentinel = "1970.01.01"
+
+## Date given to indexes that do not follow the naming convention.
+orphanDate = "1970.01.01"
+
+## Per-customer record layout.
+IDX, SHARDS, DOCS, SIZE, OLDEST, NEWEST = range(6)
+
+_idxName = re.compile(r'(.*)-(\d{4}\.\d{2}\.\d{2})')
+_ordinals = {}
+
+
+def splitIndexName(name):
+  """
+  Split a customer-YYYY.MM.DD index name into customer and date.
+  Indexes without a date suffix are their own customer, dated
+  orphanDate.
+
+  returns (customer, date)
+  """
+  regRes = _idxName.match(name)
+  if regRes:
+    return regRes.group(1), regRes.group(2)
+  return name, orphanDate
+
+
+def dateOrdinal(date):
+  """
+  Day number of a YYYY.MM.DD string, parsed once per distinct string.
+  """
+  day = _ordinals.get(date)
+  if day is None:
+    day = datetime.strptime(date, "%Y.%m.%d").toordinal()
+    _ordinals[date] = day
+  return day
+
+
+def addIndex(stats, customer, date, shards, docs, size):
+  """
+  Fold one index into the customer stats dict.
+  """
+  rec = stats.get(customer)
+  if rec is None:
+    rec = [0, 0, 0, 0, oldestSentinel, newestSentinel]
+    stats[customer] = rec
+  rec[IDX] += 1
+  rec[SHARDS] += shards
+  rec[DOCS] += docs
+  rec[SIZE] += size
+  if date < rec[OLDEST]:
+    rec[OLDEST] = date
+  if date > rec[NEWEST]:
+    rec[NEWEST] = date
+
+
+def removeIndex(stats, customer, date, shards, docs, size, dates = None):
+  """
+  Take one index back out of the customer stats dict, the reverse of
+  addIndex.  dates is the customer's date -> index count map with this
+  index already taken off (and dates left with no index deleted); it is
+  used to find the new oldest/newest when the index was either.  A
+  customer with no indexes left is dropped.
+  """
+  rec = stats.get(customer)
+  if rec is None:
+    return
+  rec[IDX] -= 1
+  if rec[IDX] <= 0:
+    del stats[customer]
+    return
+  rec[SHARDS] -= shards
+  rec[DOCS] -= docs
+  rec[SIZE] -= size
+  if dates and (date == rec[OLDEST] or date == rec[NEWEST]) and not dates.get(date):
+    rec[OLDEST] = min(dates)
+    rec[NEWEST] = max(dates)
+
+
+def customerRows(stats):
+  """
+  Generator of per-customer results ordered by customer name.
+
+  yields (customer, indexes, shards, docs, size, newest, oldest, retention days)
+  """
+  for customer in sorted(stats):
+    rec = stats[customer]
+    retention = dateOrdinal(rec[NEWEST]) - dateOrdinal(rec[OLDEST]) + 1
+    yield (customer, rec[IDX], rec[SHARDS], rec[DOCS], rec[SIZE],
+           rec[NEWEST], rec[OLDEST], retention)
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+## es_bench.py - benchmarks for the report and planner engines
+##
+## Runs against synthetic data only; never talks to a cluster.
+##
+## usage: es_bench.py aggregate [-r ROWS] [-C CUSTOMERS]
+##   Time the per-customer aggregation at increasing row counts (doubling
+##   up to ROWS) and compare it against the original sort based loop.
+##
+## usage: es_bench.py planner [-N NODES] [-s SHARDS] [-m MOVES] [--method {load,swap}]
+##   Time planning MOVES load moves on NODES nodes of SHARDS shards each.
+##
+## usage: es_bench.py sim [-s SIZES] [-N NODES] [-m MOVES] [--tools]
+##   On es_sim clusters of each size (total shard copies), time and
+##   measure peak memory of generating the cluster, the report engine
+##   (_cat/indices aggregation and cluster state breakdown) and the load
+##   and swap planners, and score each planner by the variance of the
+##   simulated node load after its moves.  --tools also runs es_report.py
+##   and tellMeWhatToMove.py against the simulator over HTTP.  Each size
+##   runs in its own process so peak memory is per size.
+##
+## usage: es_bench.py cat [-s SIZES] [-N NODES]
+##   Parse synthetic _cat/shards answers of each size (rows, with
+##   relocating and unassigned copies mixed in) with the original
+##   re.search/split loop, es_cat.parseLines alone and es_cat.parseLines
+##   plus the getShardData rows, each in its own process; reports rows
+##   and mb per second and peak memory and checks all three agree.
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import shutil
+import hashlib
+import resource
+import tempfile
+import subprocess
+from multiprocessing import Pool
+from collections import namedtuple
+from operator import attrgetter
+from datetime import datetime, date
+
+import es_cat
+import es_collect
+import es_aggregate
+import es_planner
+import es_state
+import es_sim
+
+
+def syntheticIndexRows(rows, customers, seed = 1):
+  """
+  Generator of (index name, shards, docs, size) rows for daily indexes
+  spread over 'customers' customers.
+  """
+  rnd = random.Random(seed)
+  start = date(2015, 1, 1).toordinal()
+  for i in xrange(rows):
+    day = date.fromordinal(start + rnd.randint(0, 729)).strftime("%Y.%m.%d")
+    name = "cust%05d-prod-%s" % (rnd.randint(0, customers - 1), day)
+    yield (name, rnd.randint(1, 5), rnd.randint(0, 10000000), rnd.randint(0, 20 * 1073741824))
+
+
+def aggregateNew(rows):
+  stats = {}
+  for (name, shards, docs, size) in rows:
+    (customer, idxDate) = es_aggregate.splitIndexName(name)
+    es_aggregate.addIndex(stats, customer, idxDate, shards, docs, size)
+  return ["%60s\t%d\t%d\t%8d\t%8.2f mb\t%s - %s = %d" % (c, i, s, d, float(z) / (1024.00 * 1024.00), n, o, r)
+          for (c, i, s, d, z, n, o, r) in es_aggregate.customerRows(stats)][:-1]
+
+
+def aggregateOld(rows):
+  """
+  The original es_report.py customer loop, kept for comparison.
+  """
+  idxInfo = namedtuple("idxInfo", 'name shards documents size customer date')
+  esIdx = []
+  for (name, shards, docs, size) in rows:
+    (customer, idxDate) = es_aggregate.splitIndexName(name)
+    esIdx.append(idxInfo(name, str(shards), docs, str(size), customer, idxDate))
+
+  out = []
+  curCust = False
+  idxCount = shardCount = docCount = size = 0
+  oldest = "2038.12.31"
+  newest = "1970.01.01"
+  for a in sorted(esIdx, key=attrgetter('customer')):
+    if (a.customer != curCust) and (curCust):
+      retension = datetime.strptime(newest, "%Y.%m.%d") - datetime.strptime(oldest, "%Y.%m.%d")
+      out.append("%60s\t%d\t%d\t%8d\t%8.2f mb\t%s - %s = %d" % (curCust, idxCount, shardCount, docCount, float(size) / (1024.00 * 1024.00), newest, oldest, retension.days + 1))
+      idxCount = shardCount = docCount = size = 0
+      oldest = "2038.12.31"
+      newest = "1970.01.01"
+    curCust = a.customer
+    idxCount += 1
+    docCount += int(a.documents)
+    shardCount += int(a.shards)
+    size += int(a.size)
+    cDate = datetime.strptime(a.date, "%Y.%m.%d")
+    if cDate < datetime.strptime(oldest, "%Y.%m.%d"):
+      oldest = a.date
+    if cDate > datetime.strptime(newest, "%Y.%m.%d"):
+      newest = a.date
+  return out
+
+
+def timed(func, *fargs):
+  start = time.time()
+  result = func(*fargs)
+  return result, time.time() - start
+
+
+def benchAggregate(args):
+  print "%10s\t%10s\t%12s\t%10s\t%10s" % ("rows", "new (s)", "ns/row", "old (s)", "speedup")
+  rows = 1000
+  while rows <= args.rows:
+    data = list(syntheticIndexRows(rows, args.customers))
+    (newOut, newTime) = timed(aggregateNew, data)
+    if rows <= args.compare:
+      (oldOut, oldTime) = timed(aggregateOld, data)
+      if oldOut != newOut:
+        print "Output mismatch at %d rows" % rows
+        sys.exit(1)
+      print "%10d\t%10.3f\t%12.1f\t%10.3f\t%9.1fx" % (rows, newTime, newTime * 1e9 / rows, oldTime, oldTime / max(newTime, 1e-9))
+    else:
+      print "%10d\t%10.3f\t%12.1f\t%10s\t%10s" % (rows, newTime, newTime * 1e9 / rows, "-", "-")
+    rows *= 2
+
+
+def syntheticCluster(nodes, perNode, seed = 1):
+  """
+  Build usage and shards dicts shaped like tellMeWhatToMove's: daily
+  indexes of 1 to 5 primaries plus a replica placed on distinct nodes,
+  with skewed shard activity and node load.
+
+  returns usage, shards
+  """
+  rnd = random.Random(seed)
+  names = ["es%03d" % n for n in range(nodes)]
+  shards = dict((n, []) for n in names)
+  total = 0
+  i = 0
+  while total < nodes * perNode:
+    index = "cust%04d-%s" % (i % 997, "2016.%02d.%02d" % (1 + i // 28 % 12, 1 + i % 28))
+    primaries = rnd.randint(1, 5)
+    copies = min(nodes, primaries * 2)
+    for (n, node) in enumerate(rnd.sample(names, copies)):
+      shards[node].append([index, str(n % primaries), int(rnd.paretovariate(1.5) * 10), rnd.randint(0, 1073741824)])
+    total += copies
+    i += 1
+  usage = {}
+  for node in names:
+    usage[node] = [rnd.uniform(0.5, 4.0), 0, sum(e[3] for e in shards[node]), len(shards[node])]
+  return usage, shards
+
+
+def benchPlanner(args):
+  (usage, shards) = syntheticCluster(args.nodes, args.shards)
+  (model, buildTime) = timed(es_planner.buildModel, usage, shards)
+  before = sorted(model.load.values())
+  if args.method == "swap":
+    (swaps, planTime) = timed(es_planner.planSwapMoves, model, args.moves)
+    planned = "%d swaps" % len(swaps)
+  else:
+    ((moves, stuck), planTime) = timed(es_planner.planLoadMoves, model, args.moves)
+    planned = "%d moves (%d stuck)" % (len(moves), len(stuck))
+  after = sorted(model.load.values())
+  print "nodes %d, shards %d" % (args.nodes, args.nodes * args.shards)
+  print "model build: %.3f s" % buildTime
+  print "planned %s in %.3f s" % (planned, planTime)
+  print "load spread: %.2f - %.2f  ->  %.2f - %.2f" % (before[0], before[-1], after[0], after[-1])
+
+
+def peakMb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def loadSpread(loads):
+  """
+  returns (variance, max / mean) of a list of node loads
+  """
+  mean = sum(loads) / len(loads)
+  return sum((l - mean) ** 2 for l in loads) / len(loads), max(loads) / mean
+
+
+def runTool(argv):
+  """
+  Run one of the tools to completion, output discarded.
+
+  returns (seconds, peak rss in mb, exit status)
+  """
+  start = time.time()
+  with open(os.devnull, 'w') as null:
+    proc = subprocess.Popen([sys.executable] + argv, stdout=null, stderr=null)
+    (pid, status, usage) = os.wait4(proc.pid, 0)
+  return time.time() - start, usage.ru_maxrss / 1024.0, status >> 8
+
+
+def simCase(size, nodes, moves, tools):
+  """
+  All measurements for one cluster size.  Peak memory is the growth of
+  this process's peak RSS during the phase.
+
+  returns list of (phase, seconds, peak mb, note)
+  """
+  results = []
+
+  def measure(phase, func, *fargs):
+    before = peakMb()
+    (out, took) = timed(func, *fargs)
+    results.append([phase, took, peakMb() - before, ""])
+    return out
+
+  cluster = measure("generate", es_sim.sizedCluster, size, nodes)
+  results[-1][3] = "%d copies, %d indexes" % (len(cluster.cNode), len(cluster.indices))
+
+  def report():
+    stats = {}
+    for line in es_sim.catIndices(cluster, ('index', 'pri', 'docs.count', 'docs.deleted', 'store.size')):
+      fields = line.split()
+      (customer, idxDate) = es_aggregate.splitIndexName(fields[0])
+      es_aggregate.addIndex(stats, customer, idxDate, int(fields[1]), int(fields[2]) - int(fields[3]), int(fields[4]))
+    return len(list(es_aggregate.customerRows(stats)))
+
+  customers = measure("report indices", report)
+  results[-1][3] = "%d customers" % customers
+
+  placement = cluster.cNode[:]
+  (variance, peak) = loadSpread(es_sim.nodeLoads(cluster))
+  results.append(["load before", 0.0, 0.0, "variance %.3f, max/mean %.2f" % (variance, peak)])
+  for method in ("load", "swap"):
+    (usage, shards, zones) = es_sim.usageModel(cluster)
+
+    def plan():
+      model = es_planner.buildModel(usage, shards, (), zones)
+      if method == "swap":
+        return [m for pair in es_planner.planSwapMoves(model, moves) for m in pair]
+      return es_planner.planLoadMoves(model, moves)[0]
+
+    planned = measure("plan " + method, plan)
+    es_sim.applyMoves(cluster, planned)
+    (variance, peak) = loadSpread(es_sim.nodeLoads(cluster))
+    results[-1][3] = "%d moves: variance %.3f, max/mean %.2f" % (len(planned), variance, peak)
+    cluster.cNode[:] = placement
+
+  ## Render the state up front so only the scan is timed.
+  state = "".join(es_sim.clusterState(cluster))
+  chunks = [state[i:i + es_state.stateChunk] for i in xrange(0, len(state), es_state.stateChunk)]
+  del state
+  (stateBytes, sections, byCustomer) = measure("report state", es_state.stateBreakdown, chunks)
+  results[-1][3] = "%.1f mb state" % (stateBytes / 1048576.0)
+  del chunks
+
+  if tools:
+    server = es_sim.startServer(cluster)
+    port = str(server.server_address[1])
+    here = os.path.dirname(os.path.abspath(__file__))
+    tempDir = tempfile.mkdtemp(prefix="es_bench")
+    for (phase, argv) in (("es_report.py -s", [os.path.join(here, "es_report.py"), "-H", "127.0.0.1",
+                                               "-P", port, "-s"]),
+                          ("tellMeWhatToMove.py", [os.path.join(here, "tellMeWhatToMove.py"), "-H",
+                                                   "127.0.0.1", "-P", port, "-n", "2", "-i", "1",
+                                                   "-l", str(moves), "-t", tempDir])):
+      (took, rss, status) = runTool(argv)
+      results.append([phase, took, rss, "exit %d" % status])
+    server.shutdown()
+    shutil.rmtree(tempDir, True)
+  return results
+
+
+def benchSim(args):
+  print "%10s  %-22s %10s %10s  %s" % ("shards", "phase", "seconds", "peak mb", "")
+  for size in [int(s) for s in args.sizes.split(',')]:
+    pool = Pool(1, maxtasksperchild=1)
+    results = pool.apply(simCase, (size, args.nodes, args.moves, args.tools))
+    pool.close()
+    pool.join()
+    for (phase, took, mb, note) in results:
+      print "%10d  %-22s %10.3f %10.1f  %s" % (size, phase, took, mb, note)
+
+
+def syntheticShardLines(path, rows, nodes, seed = 1):
+  """
+  Write a v=true _cat/shards answer in es_collect.shardColumns to path:
+  mostly STARTED copies, with relocating pairs (a RELOCATING row whose
+  node cell is "node -> ip id node" and an INITIALIZING row with blank
+  docs) and UNASSIGNED rows with only index, shard and state.
+
+  returns bytes written
+  """
+  rnd = random.Random(seed)
+  names = ["es-%d-zone%s" % (n, "abc"[n % 3]) for n in range(nodes)]
+  with open(path, 'w') as out:
+    out.write(" ".join(es_collect.shardColumns) + "\n")
+    for i in xrange(rows):
+      index = "cust%05d-prod-2016.%02d.%02d" % (i // 40 % 20000, 1 + i // 28 % 12, 1 + i % 28)
+      shard = i // 2 % 5
+      roll = rnd.random()
+      if roll < 0.01:
+        out.write("%s %d UNASSIGNED\n" % (index, shard))
+        continue
+      (docs, size) = (rnd.randint(0, 10000000), rnd.randint(0, 20 * 1073741824))
+      node = rnd.choice(names)
+      if roll < 0.03:
+        target = rnd.choice(names)
+        out.write("%s %d RELOCATING %d %d %s -> 10.0.0.%d %s %s\n" % (index, shard, docs, size, node, i % 250,
+                                                                    "%022x" % i, target))
+        out.write("%s %d INITIALIZING  %s\n" % (index, shard, target))
+      else:
+        out.write("%s %d STARTED %d %d %s\n" % (index, shard, docs, size, node))
+  return os.path.getsize(path)
+
+
+def catOld(lines):
+  """
+  The original es_collect.getShardData loop, kept for comparison.
+  """
+  totalDocs = 0
+  rows = []
+  for esShards in lines:
+      if re.search('STARTED', esShards):
+          fields = esShards.split()
+          docs = int(fields[3])
+          totalDocs += docs
+          rows.append([fields[5], fields[0], fields[1], 0, docs, int(fields[4])])
+  return totalDocs, rows
+
+
+def catNew(lines, rows = True):
+  shards = es_cat.parseLines(lines, es_collect.shardColumns, es_collect.shardTypes, es_collect.shardWhere).data
+  return sum(shards['docs']), es_collect.shardRows(shards) if rows else shards
+
+
+def catCase(path, method):
+  """
+  Parse the file at path with one method, in a fresh process.
+
+  returns (seconds, peak mb, rows, digest of the rows)
+  """
+  with open(path, 'r') as lines:
+    if method == "split":
+      ((docs, rows), took) = timed(catOld, lines)
+    else:
+      ((docs, rows), took) = timed(catNew, lines, method == "es_cat+rows")
+  peak = peakMb()
+  if method == "es_cat":
+    rows = es_collect.shardRows(rows)
+  digest = hashlib.md5()
+  for row in rows:
+    digest.update("%s %s %s %d %d\n" % (row[0], row[1], row[2], row[4], row[5]))
+  return (took, peak, len(rows), "%d/%s" % (docs, digest.hexdigest()))
+
+
+def benchCat(args):
+  tempDir = tempfile.mkdtemp(prefix="es_bench")
+  try:
+    print "%10s %8s  %-12s %8s %12s %8s %8s %8s" % ("rows", "mb", "parser", "seconds", "rows/s", "mb/s",
+                                                   "peak mb", "speedup")
+    for size in [int(s) for s in args.sizes.split(',')]:
+      path = os.path.join(tempDir, "shards.%d" % size)
+      mb = syntheticShardLines(path, size, args.nodes) / 1048576.0
+      base = None
+      for method in ("split", "es_cat", "es_cat+rows"):
+        pool = Pool(1, maxtasksperchild=1)
+        (took, rss, rows, check) = pool.apply(catCase, (path, method))
+        pool.close()
+        pool.join()
+        if base is None:
+          base = (took, check)
+        elif check != base[1]:
+          print "Output mismatch at %d rows: %s" % (size, method)
+          sys.exit(1)
+        print "%10d %8.1f  %-12s %8.3f %12.0f %8.1f %8.1f %7.1fx" % (size, mb, method, took, size / max(took, 1e-9),
+                                                                   mb / max(took, 1e-9), rss, base[0] / max(took, 1e-9))
+      os.remove(path)
+  finally:
+    shutil.rmtree(tempDir, True)
+
+
+###############################################
+## Argument parsing...
+parser = argparse.ArgumentParser(description='Benchmark report and planner engines on synthetic data.')
+sub = parser.add_subparsers(dest="bench")
+
+p = sub.add_parser("aggregate", help="Per-customer index aggregation.")
+p.add_argument("-r", "--rows", default=2000000, type=int,
+               help="Largest number of index rows to time. (default 2000000)")
+p.add_argument("-C", "--customers", default=2000, type=int,
+               help="Number of distinct customers. (default 2000)")
+p.add_argument("--compare", default=200000, type=int,
+               help="Also run the original loop up to this many rows. (default 200000)")
+p.set_defaults(func=benchAggregate)
+
+p = sub.add_parser("planner", help="Load move planner.")
+p.add_argument("-N", "--nodes", default=9, type=int,
+               help="Number of data nodes. (default 9)")
+p.add_argument("-s", "--shards", default=4000, type=int,
+               help="Shards per node. (default 4000)")
+p.add_argument("-m", "--moves", default=500, type=int,
+               help="Moves to plan. (default 500)")
+p.add_argument("--method", default="load", choices=['load', 'swap'],
+               help="Planner to time. (default load)")
+p.set_defaults(func=benchPlanner)
+
+p = sub.add_parser("sim", help="Report and planners on simulated clusters.")
+p.add_argument("-s", "--sizes", default="10000,100000,1000000",
+               help="Comma separated cluster sizes in shard copies. (default 10000,100000,1000000)")
+p.add_argument("-N", "--nodes", default=30, type=int,
+               help="Number of data nodes. (default 30)")
+p.add_argument("-m", "--moves", default=50, type=int,
+               help="Moves each planner may make. (default 50)")
+p.add_argument("--tools", default=False, action='store_true',
+               help="Also run es_report.py and tellMeWhatToMove.py against the simulator.")
+p.set_defaults(func=benchSim)
+
+p = sub.add_parser("cat", help="_cat/shards parsing.")
+p.add_argument("-s", "--sizes", default="1000000,4000000",
+               help="Comma separated _cat/shards row counts. (default 1000000,4000000)")
+p.add_argument("-N", "--nodes", default=30, type=int,
+               help="Number of data nodes. (default 30)")
+p.set_defaults(func=benchCat)
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  args.func(args)
@@ -0,0 +1,209 @@
+## es_cat.py - header aware _cat parsing into typed columns
+##
+## _cat rows are whitespace separated text, so picking fields by position
+## goes wrong as soon as a row does not have exactly one token per
+## requested column: ES leaves out columns it does not know (load on 5.x,
+## a typo) from the header and every row, unassigned shards have blank
+## docs/store/node cells, and a relocating shard's node cell reads
+## "node -> ip id node".  Here the columns are always asked for with v=true
+## and found by name in the header line, so a column ES left out comes
+## back as blanks instead of shifting the rest.  Within a row:
+##   - tokens beyond the header's column count belong to the last column
+##     (the relocating node cell), so multi-token columns go last
+##   - a row short of tokens has blank cells, and there is no telling
+##     which, so it is dropped rather than read into the wrong columns
+## Rows are dropped before any 'where' filter on exact cell values (say
+## state STARTED) is checked, so a caller that needs rows with blank
+## cells (unassigned or initializing shards) must not ask for the columns
+## that are blank in them.  A filter value that appears nowhere in a line
+## drops it before it is split.
+##
+## Lines are read and decoded a batch at a time: split, filter, then each
+## column converted in one go into an array ('int' -> 64 bit integers,
+## 'float' -> doubles) or a list of strings.  Non-numeric cells in numeric
+## columns, and columns missing from the header, read as 0 or None.
+##
+## es_bench.py cat times this against the split-and-index loop it replaced.
+
+import gc
+import json
+import logging
+from array import array
+from operator import contains, itemgetter
+from itertools import chain, compress, imap, islice, izip, repeat
+from contextlib import contextmanager
+from collections import namedtuple
+
+import es_client
+
+## Lines decoded per batch.
+batchLines = 10000
+
+## data: dict of column -> array or list, all 'rows' long
+Table = namedtuple('Table', 'columns rows data')
+
+
+def _intCode():
+  for code in 'lq':
+    try:
+      if array(code).itemsize == 8:
+        return code
+    except ValueError:
+      pass
+  return 'd'
+
+_typecodes = {'int': _intCode(), 'float': 'd'}
+_converters = {'int': int, 'float': float}
+
+
+def _fit(fields, width):
+  """
+  Fold surplus tokens into the last column.
+  """
+  return fields[:width - 1] + [' '.join(fields[width - 1:])]
+
+
+def _split(chunk, width):
+  """
+  Lines split into fields; the lines that split into more than width
+  fields are fitted and those short of width dropped.
+  """
+  rows = map(type(chunk[0]).split, chunk)
+  widths = map(len, rows)
+  if widths.count(width) == len(rows):
+    return rows
+  fitted = [fields if size == width else _fit(fields, width)
+            for (fields, size) in izip(rows, widths) if size >= width]
+  short = len(rows) - len(fitted) - widths.count(0)
+  if short:
+    logging.debug("_cat: dropped %d rows with blank cells" % short)
+  return fitted
+
+
+def _convert(cells, kind):
+  """
+  cells decoded as 'int' or 'float', or left as strings.  A batch of
+  numbers is read as one JSON list, which is several times quicker than
+  calling int() per cell; a batch with anything else in it is converted
+  cell by cell.
+  """
+  if kind not in _converters:
+    return cells
+  try:
+    return array(_typecodes[kind], json.loads('[' + ','.join(cells) + ']'))
+  except (ValueError, TypeError, OverflowError):
+    convert = _converters[kind]
+    values = array(_typecodes[kind])
+    for cell in cells:
+      try:
+        values.append(convert(cell))
+      except (ValueError, TypeError, OverflowError):
+        values.append(0)
+    return values
+
+
+@contextmanager
+def gcPaused():
+  """
+  Hold off the cyclic garbage collector while the block builds large
+  numbers of acyclic containers (split rows, row lists); its passes over
+  them cost more than the building.  Only the thread that paused it
+  turns it back on.
+  """
+  paused = gc.isenabled()
+  gc.disable()
+  try:
+    yield
+  finally:
+    if paused:
+      gc.enable()
+
+
+def _positions(names, columns):
+  found = dict((name, pos) for (pos, name) in enumerate(names))
+  missing = [column for column in columns if column not in found]
+  if missing:
+    logging.warn("_cat header has no %s; read as blank" % ", ".join(missing))
+  return [found.get(column) for column in columns]
+
+
+def parseLines(lines, columns, types = None, where = None, header = True, batch = batchLines):
+  """
+  Decode _cat text lines into typed columns.  With header the first line
+  names the columns (v=true); without it the lines are in 'columns'
+  order.  types is a dict of column -> 'int' or 'float' (others are
+  strings); where is a dict of column -> accepted values.
+
+  returns Table
+  """
+  types = types or {}
+  where = where or {}
+  lines = iter(lines)
+  names = [column for column in where if column not in columns] + list(columns)
+  if header:
+    for line in lines:
+      if line.strip():
+        ## A server that ignored v=true sent a row; read it as one.
+        if set(line.split()) & set(names):
+          names = line.split()
+        else:
+          lines = chain([line], lines)
+        break
+  width = len(names)
+  positions = _positions(names, columns)
+  checks = [(pos, frozenset(accept)) for (pos, accept) in
+            zip(_positions(names, where.keys()), where.values())]
+  ## A line without the one accepted value of a filter anywhere in it
+  ## is dropped before it is split.
+  needles = [tuple(accept)[0] for (pos, accept) in checks if len(accept) == 1]
+
+  data = dict((column, array(_typecodes[types[column]]) if types.get(column) in _typecodes else [])
+              for column in columns)
+  count = 0
+  while True:
+    chunk = list(islice(lines, batch))
+    if not chunk:
+      break
+    with gcPaused():
+      count += _decode(chunk, width, zip(columns, positions), types, checks, needles, data)
+  return Table(tuple(columns), count, data)
+
+
+def _decode(chunk, width, wanted, types, checks, needles, data):
+  """
+  Decode one batch of lines into the data columns; wanted is a list of
+  (column, header position).
+
+  returns the number of rows added
+  """
+  for needle in needles:
+    chunk = list(compress(chunk, imap(contains, chunk, repeat(needle))))
+  if not chunk:
+    return 0
+  rows = _split(chunk, width)
+  for (pos, accept) in checks:
+    if pos is None:
+      return 0
+    rows = list(compress(rows, map(accept.__contains__, map(itemgetter(pos), rows))))
+  if not rows:
+    return 0
+  for (column, pos) in wanted:
+    cells = map(itemgetter(pos), rows) if pos is not None else [None] * len(rows)
+    data[column].extend(_convert(cells, types.get(column)))
+  return len(rows)
+
+
+def cat(esMaster, esPort, api, columns, types = None, where = None, params = None,
+        timeout = es_client.esTimeout):
+  """
+  Fetch and decode a _cat API.  Columns in 'where' that are not in
+  'columns' are fetched (first) for the filter only.
+
+  returns Table
+  """
+  wanted = tuple(column for column in (where or {}) if column not in columns) + tuple(columns)
+  query = {'v': 'true'}
+  if params:
+    query.update(params)
+  return parseLines(es_client.cat(esMaster, esPort, api, wanted, params=query, timeout=timeout),
+                    columns, types, where)
@@ -0,0 +1,145 @@
+## es_client.py - shared HTTP client for the ES tools
+##
+## All requests go through one requests Session so connections to the
+## master are pooled and reused instead of reconnecting per call.  _cat
+## calls ask only for the columns the caller parses (h=) and accept gzip,
+## which keeps responses from a busy master small.  GET and HEAD are
+## retried with exponential backoff on connection errors and 502/503/504;
+## POST, PUT and DELETE change cluster state and are only retried when the
+## connection could not be made, so the request never reached ES.
+
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+## Timeout in seconds (connect, read)
+esTimeout = (10, 90)
+
+## Retry policy for GET/HEAD
+esRetries = 3
+esBackoff = 0.5
+_retryMethods = frozenset(['GET', 'HEAD'])
+
+## Connections kept per host
+esPoolSize = 8
+
+_session = None
+
+## While profiling, the es_profile.Profile that is told about every
+## request and streamed body.
+profiler = None
+
+
+def session():
+  """
+  The shared, lazily created Session.
+  """
+  global _session
+  if _session is None:
+    options = dict(total=esRetries, backoff_factor=esBackoff, status_forcelist=(502, 503, 504))
+    try:
+      retry = Retry(allowed_methods=_retryMethods, **options)
+    except TypeError:
+      ## urllib3 before 1.26
+      retry = Retry(method_whitelist=_retryMethods, **options)
+    adapter = HTTPAdapter(pool_connections=esPoolSize, pool_maxsize=esPoolSize,
+                          max_retries=retry)
+    _session = requests.Session()
+    _session.mount('http://', adapter)
+    _session.mount('https://', adapter)
+    _session.headers.update({'Accept-Encoding': 'gzip'})
+  return _session
+
+
+def url(esMaster, esPort, path):
+  return 'http://%s:%s/%s' % (esMaster, esPort, path.lstrip('/'))
+
+
+def _send(method, esMaster, esPort, path, timeout, **kwargs):
+  """
+  One request through the shared session, timed for the profiler.
+  Raises requests.HTTPError on a non 2xx answer.
+
+  returns the Response
+  """
+  start = time.time()
+  resp = session().request(method, url(esMaster, esPort, path), timeout=timeout, **kwargs)
+  if profiler:
+    profiler.request(time.time() - start, resp)
+  resp.raise_for_status()
+  return resp
+
+
+def get(esMaster, esPort, path, params = None, stream = False, timeout = esTimeout):
+  """
+  GET an ES API path.  Raises requests.HTTPError on a non 2xx answer.
+
+  returns the Response
+  """
+  return _send('GET', esMaster, esPort, path, timeout, params=params, stream=stream)
+
+
+def post(esMaster, esPort, path, data = None, params = None, timeout = esTimeout):
+  """
+  POST to an ES API path.  Retried only if it could not connect.
+
+  returns the Response
+  """
+  return _send('POST', esMaster, esPort, path, timeout, data=data, params=params)
+
+
+def put(esMaster, esPort, path, data = None, params = None, timeout = esTimeout):
+  """
+  PUT to an ES API path.  Retried only if it could not connect.
+
+  returns the Response
+  """
+  return _send('PUT', esMaster, esPort, path, timeout, data=data, params=params)
+
+
+def delete(esMaster, esPort, path, params = None, timeout = esTimeout):
+  """
+  DELETE an ES API path.  Retried only if it could not connect.
+
+  returns the Response
+  """
+  return _send('DELETE', esMaster, esPort, path, timeout, params=params)
+
+
+def cat(esMaster, esPort, api, columns, params = None, timeout = esTimeout):
+  """
+  Stream a _cat API, asking only for 'columns' in that order.
+  Sizes are in bytes.
+
+  returns an iterator over the response lines
+  """
+  query = {'h': ','.join(columns), 'bytes': 'b'}
+  if params:
+    query.update(params)
+  resp = get(esMaster, esPort, '_cat/' + api, params=query, stream=True,
+             timeout=timeout)
+  if profiler:
+    return profiler.stream(resp, resp.iter_lines())
+  return resp.iter_lines()
+
+
+def gather(calls, workers = esPoolSize):
+  """
+  Run independent requests concurrently.  calls is a dict of
+  name -> (function, args).  The first exception raised by any call
+  is re-raised once all have finished.
+
+  returns dict of name -> result
+  """
+  pool = ThreadPool(min(workers, max(len(calls), 1)))
+  try:
+    pending = dict((name, pool.apply_async(func, fargs))
+                   for (name, (func, fargs)) in calls.items())
+    pool.close()
+    pool.join()
+    return dict((name, res.get()) for (name, res) in pending.items())
+  finally:
+    pool.terminate()
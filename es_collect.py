@@ -0,0 +1,55 @@
+## es_collect.py - shard and node data collection shared by the ES tools
+
+import logging
+from itertools import izip, repeat
+
+import es_cat
+import es_client
+
+## _cat columns requested; the multi-token node goes last (see es_cat.py).
+## docs, store and node are blank on unassigned and initializing copies,
+## whose rows es_cat drops, which is fine as only STARTED ones are wanted.
+shardColumns = ('index', 'shard', 'state', 'docs', 'store', 'node')
+nodeColumns = ('name', 'node.role', 'load')
+shardTypes = {'docs': 'int', 'store': 'int'}
+shardWhere = {'state': ('STARTED',)}
+
+
+def getShardData (esMaster, esPort, timeout = es_client.esTimeout):
+  """
+  Stream shard data for all STARTED shards from ES straight into memory.
+  Shard activity is 0 until filled in from indexing rates.
+
+  rows are [node, index, shard#, shard-activity, totalDocsInShard, sizeOfShardBytes]
+  returns total number of documents in ES and the list of rows
+  """
+  shards = es_cat.cat(esMaster, esPort, 'shards', shardColumns, types=shardTypes,
+                      where=shardWhere, timeout=timeout).data
+  return sum(shards['docs']), shardRows(shards)
+
+
+def shardRows(shards):
+  """
+  getShardData rows from decoded shardColumns.
+  """
+  with es_cat.gcPaused():
+    return map(list, izip(shards['node'], shards['index'], shards['shard'], repeat(0, len(shards['node'])),
+                          shards['docs'], shards['store']))
+
+
+def getNodeData (esMaster, esPort, timeout = es_client.esTimeout):
+  """
+  Get the load and zone for each datanode in the ES cluster.
+
+  returns dict of node -> zone and dict of node -> load
+  """
+  zones = {}
+  loads = {}
+  logging.info("Retrieving data node load average")
+  nodes = es_cat.cat(esMaster, esPort, 'nodes', nodeColumns, types={'load': 'float'},
+                     where={'node.role': ('d',)}, timeout=timeout).data
+  for (name, load) in izip(nodes['name'], nodes['load']):
+      zone = name.split('-')
+      zones[name] = zone[2][-1:]
+      loads[name] = load
+  return zones, loads
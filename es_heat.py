@@ -0,0 +1,210 @@
+## es_heat.py - composite node heat from _nodes/stats for the planners
+##
+## The load average the planners rank nodes by lags and counts merges,
+## searches and GC alike, so a node busy with one long GC or a merge
+## storm looks as hot as one that is overloaded with indexing, and
+## shards get moved off it for nothing.  Instead each data node is
+## sampled from _nodes/stats:
+##   index_queue, search_queue      thread pool queue (gauge)
+##   index_rejected, search_rejected  thread pool rejections per second
+##   heap                           heap used percent (gauge)
+##   gc                             GC ms per second, all collectors
+##   merge, refresh                 merge and refresh ms per second
+##   disk_io                        disk operations per second
+## Counters are turned into rates between two samples.  The last sample
+## is cached in a file, with the host:port it came from, so a run against
+## the same cluster soon after the previous one gets its rates from a
+## single new sample; otherwise two samples are taken 'interval' seconds
+## apart.
+##
+## Each metric is scaled by its highest value across the nodes and the
+## heat is the weighted mean of the scaled metrics, times 10 so it reads
+## on about the same scale as a load average.  The default weights count
+## queues and rejections (work the node cannot keep up with) most and
+## GC, merge and refresh time least, since those pass; they can be
+## overridden with 'metric=weight,...'.
+
+import os
+import json
+import time
+import logging
+
+import es_client
+
+## Metric weights in the heat score.
+heatWeights = {
+  'index_queue': 3.0, 'index_rejected': 3.0,
+  'search_queue': 2.0, 'search_rejected': 2.0,
+  'heap': 1.0, 'disk_io': 1.0,
+  'gc': 0.5, 'merge': 0.5, 'refresh': 0.5,
+}
+
+## Metrics read as is; the rest are counters turned into rates.
+gauges = ('index_queue', 'search_queue', 'heap')
+
+## A cached sample older than this is not used for rates.
+cacheMaxAge = 900
+
+_metrics = 'thread_pool,jvm,indices,fs'
+
+
+def parseWeights(text):
+  """
+  'metric=weight,...' on top of heatWeights.
+  """
+  weights = dict(heatWeights)
+  for item in text.split(','):
+    if not item.strip():
+      continue
+    (name, sep, value) = item.partition('=')
+    name = name.strip()
+    if name not in heatWeights or not sep:
+      raise ValueError("expected metric=weight with metric one of %s, got '%s'" %
+                       (", ".join(sorted(heatWeights)), item))
+    weights[name] = float(value)
+  return weights
+
+
+def _pool(pools, *names):
+  for name in names:
+    if name in pools:
+      return pools[name]
+  return {}
+
+
+def _isData(node):
+  if 'roles' in node:
+    return 'data' in node['roles']
+  return node.get('attributes', {}).get('data', 'true') != 'false'
+
+
+def sampleNodes(esMaster, esPort, timeout = es_client.esTimeout):
+  """
+  One _nodes/stats sample of the data nodes.
+
+  returns (timestamp, dict of node name -> dict of metric -> value)
+  """
+  start = time.time()
+  data = es_client.get(esMaster, esPort, '_nodes/stats/' + _metrics, timeout=timeout).json()
+  stamp = (start + time.time()) / 2.0
+
+  sample = {}
+  for node in data.get('nodes', {}).values():
+    if not _isData(node):
+      continue
+    pools = node.get('thread_pool', {})
+    ## The indexing pool is 'write' from 6.x, 'bulk' and 'index' before.
+    index = _pool(pools, 'write', 'bulk', 'index')
+    search = _pool(pools, 'search')
+    jvm = node.get('jvm', {})
+    indices = node.get('indices', {})
+    io = node.get('fs', {}).get('io_stats', {}).get('total', {})
+    sample[node['name']] = {
+      'index_queue': index.get('queue', 0), 'index_rejected': index.get('rejected', 0),
+      'search_queue': search.get('queue', 0), 'search_rejected': search.get('rejected', 0),
+      'heap': jvm.get('mem', {}).get('heap_used_percent', 0),
+      'gc': sum(c.get('collection_time_in_millis', 0)
+                for c in jvm.get('gc', {}).get('collectors', {}).values()),
+      'merge': indices.get('merges', {}).get('total_time_in_millis', 0),
+      'refresh': indices.get('refresh', {}).get('total_time_in_millis', 0),
+      'disk_io': io.get('operations', 0),
+    }
+  return stamp, sample
+
+
+def nodeRates(old, new):
+  """
+  Per-second rates of the counters between two samples; gauges are
+  taken from the newer one.  A counter that went backwards (node
+  restart) counts as 0.
+
+  returns dict of node -> dict of metric -> value
+  """
+  elapsed = max(new[0] - old[0], 0.001)
+  rates = {}
+  for (node, now) in new[1].items():
+    before = old[1].get(node)
+    rec = {}
+    for (metric, value) in now.items():
+      if metric in gauges:
+        rec[metric] = float(value)
+      elif before is None or value < before.get(metric, 0):
+        rec[metric] = 0.0
+      else:
+        rec[metric] = (value - before.get(metric, 0)) / elapsed
+    rates[node] = rec
+  return rates
+
+
+def heatScores(rates, weights = heatWeights):
+  """
+  returns dict of node -> heat
+  """
+  peaks = {}
+  for rec in rates.values():
+    for (metric, value) in rec.items():
+      peaks[metric] = max(peaks.get(metric, 0.0), value)
+  total = sum(weights.values()) or 1.0
+  heat = {}
+  for (node, rec) in rates.items():
+    score = sum(weights.get(metric, 0) * value / peaks[metric]
+                for (metric, value) in rec.items() if peaks[metric] > 0)
+    heat[node] = 10.0 * score / total
+  return heat
+
+
+def _readCache(cacheFile, cluster):
+  """
+  returns the cached sample, or None if there is none for cluster
+  """
+  try:
+    with open(cacheFile, 'r') as handle:
+      cached = json.load(handle)
+    if cached.get('cluster') != cluster:
+      return None
+    return (cached['stamp'], cached['nodes'])
+  except (IOError, ValueError, KeyError, AttributeError):
+    return None
+
+
+def _writeCache(cacheFile, cluster, sample):
+  tmpName = cacheFile + '.tmp'
+  try:
+    if not os.path.isdir(os.path.dirname(cacheFile) or '.'):
+      os.makedirs(os.path.dirname(cacheFile))
+    with open(tmpName, 'w') as handle:
+      json.dump({'cluster': cluster, 'stamp': sample[0], 'nodes': sample[1]}, handle)
+    os.rename(tmpName, cacheFile)
+  except (IOError, OSError), e:
+    logging.warn("Could not cache node stats in %s: %s" % (cacheFile, e))
+
+
+def collectHeat(esMaster, esPort, interval = 10, cacheFile = None, timeout = es_client.esTimeout):
+  """
+  Node metric rates, from the cached sample when it is recent enough
+  and from this cluster, or from two samples 'interval' seconds apart.
+
+  returns dict of node -> dict of metric -> value
+  """
+  cluster = "%s:%s" % (esMaster, esPort)
+  old = _readCache(cacheFile, cluster) if cacheFile else None
+  if old and not (1 <= time.time() - old[0] <= cacheMaxAge):
+    old = None
+  if old is None:
+    old = sampleNodes(esMaster, esPort, timeout)
+    time.sleep(interval)
+  else:
+    logging.info("Node stats rates since the sample of %ds ago." % (time.time() - old[0]))
+  new = sampleNodes(esMaster, esPort, timeout)
+  if cacheFile:
+    _writeCache(cacheFile, cluster, new)
+  return nodeRates(old, new)
+
+
+def logHeat(rates, heat):
+  logging.info("Node            heat  idx q/rej/s  srch q/rej/s  heap  gc ms/s  merge ms/s  refresh ms/s  io/s")
+  for node in sorted(heat, key=heat.get, reverse=True):
+    rec = rates[node]
+    logging.info("%s %6.2f  %5.0f %5.1f  %5.0f %5.1f  %3.0f%%  %7.1f  %10.1f  %12.1f  %5.0f" % (
+      node, heat[node], rec['index_queue'], rec['index_rejected'], rec['search_queue'], rec['search_rejected'],
+      rec['heap'], rec['gc'], rec['merge'], rec['refresh'], rec['disk_io']))
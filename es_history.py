@@ -0,0 +1,223 @@
+## es_history.py - run history and capacity forecasts for es_report.py
+##
+## Every report run can be recorded in a local sqlite database: the
+## per-customer numbers the report prints and, per node, shard count,
+## disk used/total and max heap.  Tables are indexed on (cluster,
+## customer, day) and (cluster, node, day), matching the trend queries'
+## cluster filter and customer/node order, so a window of days is cheap
+## to read.
+##
+## Forecasts are straight line fits (least squares over the runs in the
+## window) of:
+##   customer size, docs and shards per day
+##   node disk used per day -> days until the low/high disk watermark
+##   node shard count per day -> days until shardsPerHeapGb * heap gb
+## A handful of runs a day is plenty; one run gives no trend.
+
+import os
+import time
+import sqlite3
+import logging
+from itertools import izip
+
+import requests
+
+import es_cat
+import es_client
+import es_schedule
+
+defaultDb = os.path.expanduser("~/.es_report.sqlite")
+
+## Days of history used for trends.
+historyDays = 30
+
+## Customers listed in the growth section.
+reportTop = 20
+
+## Shard copies a node can carry per GB of heap before it is at risk.
+shardsPerHeapGb = 20
+
+## ES default disk watermarks.
+defaultWatermarks = ('85%', '90%')
+
+_schema = """
+create table if not exists runs (
+  id integer primary key, cluster text, stamp real, day text);
+create table if not exists customer_stats (
+  run integer, cluster text, customer text, day text, stamp real,
+  indexes integer, shards integer, docs integer, size integer,
+  newest text, oldest text, retention integer);
+drop index if exists customer_day;
+create index if not exists cluster_customer_day on customer_stats (cluster, customer, day);
+create table if not exists node_stats (
+  run integer, cluster text, node text, day text, stamp real,
+  shards integer, disk_used integer, disk_total integer, heap_max integer);
+drop index if exists node_day;
+create index if not exists cluster_node_day on node_stats (cluster, node, day);
+"""
+
+
+def openDb(path = defaultDb):
+  db = sqlite3.connect(path)
+  db.executescript(_schema)
+  return db
+
+
+def nodeCapacity(esMaster, esPort):
+  """
+  Shard count, disk and heap of each data node.
+
+  returns dict of node -> [shards, disk used, disk total, heap max]
+  """
+  nodes = {}
+  allocation = es_cat.cat(esMaster, esPort, 'allocation', ('node', 'shards', 'disk.used', 'disk.total'),
+                          types={'shards': 'int', 'disk.used': 'int', 'disk.total': 'int'}).data
+  for (node, shards, used, total) in izip(allocation['node'], allocation['shards'],
+                                          allocation['disk.used'], allocation['disk.total']):
+    ## The UNASSIGNED row and nodes without disk stats have no disk total.
+    if node != 'UNASSIGNED' and total:
+      nodes[node] = [shards, used, total, 0]
+  heaps = es_cat.cat(esMaster, esPort, 'nodes', ('name', 'heap.max'), types={'heap.max': 'int'}).data
+  for (node, heap) in izip(heaps['name'], heaps['heap.max']):
+    if node in nodes:
+      nodes[node][3] = heap
+  return nodes
+
+
+def diskWatermarks(esMaster, esPort):
+  """
+  The low and high disk watermarks.  Each is ('percent', used %) or
+  ('free', bytes that must stay free).
+
+  returns (low, high)
+  """
+  settings = {}
+  try:
+    data = es_client.get(esMaster, esPort, '_cluster/settings',
+                         params={'flat_settings': 'true', 'include_defaults': 'true'}).json()
+    for part in ('defaults', 'persistent', 'transient'):
+      settings.update(data.get(part, {}))
+  except requests.RequestException, e:
+    logging.warn("Could not read cluster settings, using default watermarks: %s" % e)
+
+  marks = []
+  for (name, default) in zip(('low', 'high'), defaultWatermarks):
+    value = str(settings.get('cluster.routing.allocation.disk.watermark.' + name, default)).strip()
+    if value.endswith('%'):
+      marks.append(('percent', float(value[:-1])))
+    else:
+      try:
+        marks.append(('percent', float(value) * 100))
+      except ValueError:
+        marks.append(('free', es_schedule.parseBytes(value)))
+  return tuple(marks)
+
+
+def recordRun(db, cluster, customers, nodes, stamp = None):
+  """
+  Store one run.  customers are es_aggregate.customerRows rows; nodes
+  is a nodeCapacity dict.
+
+  returns the run id
+  """
+  if stamp is None:
+    stamp = time.time()
+  day = time.strftime("%Y.%m.%d", time.gmtime(stamp))
+  with db:
+    run = db.execute("insert into runs (cluster, stamp, day) values (?, ?, ?)",
+                     (cluster, stamp, day)).lastrowid
+    db.executemany("insert into customer_stats values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   [(run, cluster, c, day, stamp, i, s, d, z, n, o, r)
+                    for (c, i, s, d, z, n, o, r) in customers])
+    db.executemany("insert into node_stats values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   [(run, cluster, node, day, stamp, rec[0], rec[1], rec[2], rec[3])
+                    for (node, rec) in nodes.items()])
+  return run
+
+
+def slope(points):
+  """
+  Least squares slope per day of (unix time, value) points.
+
+  returns None with fewer than two distinct times
+  """
+  if len(points) < 2:
+    return None
+  n = float(len(points))
+  meanX = sum(p[0] for p in points) / n
+  meanY = sum(p[1] for p in points) / n
+  var = sum((p[0] - meanX) ** 2 for p in points)
+  if var <= 0:
+    return None
+  return sum((p[0] - meanX) * (p[1] - meanY) for p in points) / var * 86400
+
+
+def _series(db, query, cluster, since):
+  """
+  Group query rows (key, stamp, values...) by key, oldest first.
+  """
+  series = {}
+  for row in db.execute(query, (cluster, time.strftime("%Y.%m.%d", time.gmtime(since)))):
+    series.setdefault(row[0], []).append(row[1:])
+  return series
+
+
+def customerGrowth(db, cluster, days = historyDays, now = None):
+  """
+  Per-customer growth over the last 'days' days, fastest growing
+  (by size) first.
+
+  returns list of (customer, size/day, docs/day, shards/day, size, shards)
+  """
+  since = (now or time.time()) - days * 86400
+  series = _series(db, "select customer, stamp, size, docs, shards from customer_stats "
+                       "where cluster = ? and day >= ? order by customer, stamp", cluster, since)
+  growth = []
+  for (customer, rows) in series.items():
+    size = slope([(r[0], r[1]) for r in rows])
+    if size is None:
+      continue
+    growth.append((customer, size, slope([(r[0], r[2]) for r in rows]),
+                   slope([(r[0], r[3]) for r in rows]), rows[-1][1], rows[-1][3]))
+  growth.sort(key=lambda g: g[1], reverse=True)
+  return growth
+
+
+def _daysUntil(current, limit, perDay):
+  if current >= limit:
+    return 0.0
+  if not perDay or perDay <= 0:
+    return None
+  return (limit - current) / perDay
+
+
+def nodeForecast(db, cluster, watermarks, days = historyDays, now = None):
+  """
+  Per-node disk and shard projections from the latest run and the
+  trend over the last 'days' days, soonest at risk first.
+
+  returns list of (node, disk used, disk total, disk/day, days to low,
+          days to high, shards, shards/day, shard limit, days to limit)
+  """
+  since = (now or time.time()) - days * 86400
+  series = _series(db, "select node, stamp, disk_used, disk_total, shards, heap_max from node_stats "
+                       "where cluster = ? and day >= ? order by node, stamp", cluster, since)
+  forecast = []
+  for (node, rows) in series.items():
+    (stamp, used, total, shards, heap) = rows[-1]
+    diskRate = slope([(r[0], r[1]) for r in rows])
+    shardRate = slope([(r[0], r[3]) for r in rows])
+    marks = []
+    for (kind, value) in watermarks:
+      limit = total * value / 100.0 if kind == 'percent' else total - value
+      marks.append(_daysUntil(used, limit, diskRate))
+    limit = int(shardsPerHeapGb * heap / 1073741824.0)
+    forecast.append((node, used, total, diskRate, marks[0], marks[1], shards, shardRate,
+                     limit, _daysUntil(shards, limit, shardRate) if limit else None))
+
+  def risk(f):
+    soonest = [d for d in (f[4], f[5], f[9]) if d is not None]
+    return min(soonest) if soonest else float('inf')
+
+  forecast.sort(key=risk)
+  return forecast
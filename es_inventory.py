@@ -0,0 +1,80 @@
+## es_inventory.py - cluster inventory and concurrent fan-out
+##
+## An inventory file lists one cluster per line:
+##   name  host[:port]  [timeout seconds]
+## Blank lines and lines starting with # are ignored.  Port defaults to
+## 9200 and timeout to defaultTimeout.
+##
+## fanOut runs one collection function per cluster, each in its own
+## thread, and waits for each cluster at most its timeout (counted from
+## the start of the fan-out).  A cluster that errors or runs out of time
+## is reported as such and does not hold up the others; its thread is a
+## daemon and is simply left behind.
+
+import time
+import logging
+import threading
+from collections import namedtuple
+
+defaultPort = 9200
+defaultTimeout = 120
+
+Cluster = namedtuple('Cluster', 'name host port timeout')
+
+
+def readInventory(path, timeout = defaultTimeout):
+  """
+  returns list of Cluster in file order
+  """
+  clusters = []
+  with open(path, 'r') as handle:
+    for (lineNo, line) in enumerate(handle, 1):
+      fields = line.split('#', 1)[0].split()
+      if not fields:
+        continue
+      if len(fields) < 2:
+        raise ValueError("%s:%d: expected 'name host[:port] [timeout]'" % (path, lineNo))
+      (host, sep, port) = fields[1].partition(':')
+      clusters.append(Cluster(fields[0], host, int(port) if port else defaultPort,
+                              float(fields[2]) if len(fields) > 2 else timeout))
+  return clusters
+
+
+def httpTimeout(cluster):
+  """
+  (connect, read) timeout for es_client calls made for cluster.
+  """
+  return (min(10, cluster.timeout), cluster.timeout)
+
+
+def fanOut(clusters, func):
+  """
+  Call func(cluster) for every cluster concurrently.
+
+  returns list of (cluster, result, error message or None) in inventory order
+  """
+  results = {}
+
+  def run(cluster):
+    try:
+      results[cluster.name] = (func(cluster), None)
+    except Exception, e:
+      logging.debug("%s failed" % cluster.name, exc_info=True)
+      results[cluster.name] = (None, "%s: %s" % (e.__class__.__name__, e))
+
+  start = time.time()
+  threads = []
+  for cluster in clusters:
+    thread = threading.Thread(target=run, args=(cluster,), name="fanout-" + cluster.name)
+    thread.daemon = True
+    thread.start()
+    threads.append((cluster, thread))
+
+  out = []
+  for (cluster, thread) in threads:
+    thread.join(max(0, start + cluster.timeout - time.time()))
+    (result, error) = results.get(cluster.name, (None, "timed out after %ds" % cluster.timeout))
+    if error:
+      logging.error("Cluster %s (%s:%d) unavailable: %s" % (cluster.name, cluster.host, cluster.port, error))
+    out.append((cluster, result, error))
+  return out
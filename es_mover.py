@@ -0,0 +1,277 @@
+## es_mover.py - execute a plan of shard moves with adaptive throttling
+##
+## A plan is a list of moves:
+##   {"index", "shard", "from_node", "to_node", "bytes", "group", "status"}
+## status goes pending -> submitted -> done (or failed).  Moves sharing a
+## group (for example both halves of a swap) are always sent in the same
+## _cluster/reroute call.  A reroute that gets no answer (timeout, dropped
+## connection) leaves its moves unknown until the shard placement shows
+## whether ES took them; those it did not are sent again.
+##
+## Instead of fixed sleeps, the executor keeps a target number of shards
+## relocating.  Each poll it looks at the moves in flight, the recovery
+## throughput they achieve and the heap of the nodes involved:
+##   heap above heapHigh        -> halve the target
+##   throughput held or rose    -> raise the target by one
+##   throughput fell            -> lower the target by one
+## and submits new batches to fill the gap.  The plan is written to a
+## checkpoint file after every change so an interrupted run can resume.
+## A poll that cannot reach the cluster is skipped, not fatal.
+
+import os
+import json
+import time
+import logging
+from itertools import izip
+
+import requests
+
+import es_cat
+import es_client
+
+## In-flight relocation target bounds and starting point.
+minInFlight = 2
+maxInFlight = 48
+startInFlight = 8
+
+## Moves per reroute call.
+batchSize = 12
+
+## Back off when any involved node's heap is above this percent.
+heapHigh = 85
+
+## Seconds between polls.
+pollInterval = 10
+
+## Polls after which a submitted move that is neither relocating nor on
+## its destination is counted as failed.
+failPolls = 3
+
+_rerouteParams = {'timeout': '5m', 'master_timeout': '5m'}
+
+## (connect, read) timeout for reroute calls: longer than ES is asked to
+## wait above, so a slow master answers before we give up on it.
+_rerouteTimeout = (10, 330)
+
+
+def newMove(index, shard, source, destination, size = 0, group = None):
+  return {'index': index, 'shard': str(shard), 'from_node': source,
+          'to_node': destination, 'bytes': int(size), 'group': group,
+          'status': 'pending'}
+
+
+def saveCheckpoint(fileName, plan):
+  if not fileName:
+    return
+  tmpName = fileName + '.tmp'
+  with open(tmpName, 'w') as handle:
+    json.dump({'saved': time.time(), 'plan': plan}, handle)
+  os.rename(tmpName, fileName)
+
+
+def loadCheckpoint(fileName):
+  """
+  returns the saved plan, or None if there is no checkpoint
+  """
+  if not fileName or not os.path.exists(fileName):
+    return None
+  with open(fileName, 'r') as handle:
+    return json.load(handle)['plan']
+
+
+def relocatingCount(esMaster, esPort):
+  relo = es_cat.cat(esMaster, esPort, 'health', ('relo',), types={'relo': 'int'}).data['relo']
+  return relo[0] if relo else 0
+
+
+def nodeHeap(esMaster, esPort):
+  """
+  returns dict of node -> heap percent
+  """
+  nodes = es_cat.cat(esMaster, esPort, 'nodes', ('name', 'heap.percent'), types={'heap.percent': 'int'}).data
+  return dict(izip(nodes['name'], nodes['heap.percent']))
+
+
+def shardPlacement(esMaster, esPort, indexes):
+  """
+  Where copies of the given indexes are.  Unassigned copies are left out.
+
+  returns dict of (index, shard) -> list of (state, node, relocating to)
+  """
+  placement = {}
+  if not indexes:
+    return placement
+  shards = es_cat.cat(esMaster, esPort, 'shards/' + ','.join(sorted(indexes)),
+                      ('index', 'shard', 'state', 'node')).data
+  for (index, shard, state, node) in izip(shards['index'], shards['shard'], shards['state'], shards['node']):
+    ## A relocating copy's node cell reads "node -> ip id target".
+    names = node.split()
+    target = names[-1] if state == 'RELOCATING' else None
+    placement.setdefault((index, shard), []).append((state, names[0], target))
+  return placement
+
+
+def submitBatch(esMaster, esPort, groups):
+  """
+  Send groups of moves in one reroute call.  If ES rejects the call,
+  each group is retried alone so one bad move does not sink the batch
+  and the moves of a group still go together.  Moves whose reroute got
+  no answer are marked unknown.
+
+  returns list of moves ES accepted
+  """
+  def reroute(moves):
+    body = {'commands': [{'move': {'index': m['index'], 'shard': int(m['shard']),
+                                   'from_node': m['from_node'], 'to_node': m['to_node']}}
+                         for m in moves]}
+    es_client.post(esMaster, esPort, '_cluster/reroute', data=json.dumps(body),
+                   params=_rerouteParams, timeout=_rerouteTimeout)
+
+  def unanswered(moves, e):
+    logging.warn("Reroute of %d moves got no answer (%s), checking placement." % (len(moves), e))
+    for move in moves:
+      move['status'] = 'unknown'
+
+  batch = [move for group in groups for move in group]
+  try:
+    reroute(batch)
+    return batch
+  except requests.HTTPError, e:
+    logging.warn("Reroute of %d moves rejected (%s), retrying one group at a time." % (len(batch), e))
+  except requests.RequestException, e:
+    unanswered(batch, e)
+    return []
+
+  accepted = []
+  for group in groups:
+    try:
+      reroute(group)
+      accepted.extend(group)
+    except requests.HTTPError, e:
+      for move in group:
+        logging.warn("Move %s/%s %s -> %s rejected: %s" % (move['index'], move['shard'], move['from_node'],
+                                                            move['to_node'], e))
+        move['status'] = 'failed'
+    except requests.RequestException, e:
+      unanswered(group, e)
+  return accepted
+
+
+def _groups(plan):
+  """
+  Pending moves bundled by group, in plan order.
+  """
+  groups = []
+  seen = {}
+  for move in plan:
+    if move['status'] != 'pending':
+      continue
+    key = move.get('group')
+    if key is None:
+      groups.append([move])
+    elif key in seen:
+      seen[key].append(move)
+    else:
+      seen[key] = [move]
+      groups.append(seen[key])
+  return groups
+
+
+def executeMoves(esMaster, esPort, plan, checkpoint = None, target = startInFlight,
+                 poll = pollInterval):
+  """
+  Run the plan to completion, keeping about 'target' shards relocating
+  and adapting that target as described above.
+
+  returns the plan with final statuses
+  """
+  rate = None
+  lastCheck = time.time()
+  waited = {}
+
+  while True:
+    inFlight = [m for m in plan if m['status'] == 'submitted']
+    unknown = [m for m in plan if m['status'] == 'unknown']
+    pending = _groups(plan)
+    if not inFlight and not unknown and not pending:
+      break
+
+    involved = set(m['from_node'] for m in plan) | set(m['to_node'] for m in plan)
+    try:
+      placement = shardPlacement(esMaster, esPort, set(m['index'] for m in inFlight + unknown))
+      heap = nodeHeap(esMaster, esPort)
+      relocating = relocatingCount(esMaster, esPort)
+    except requests.RequestException, e:
+      logging.warn("Could not poll the cluster (%s), trying again in %ds." % (e, poll))
+      time.sleep(poll)
+      continue
+
+    ## Finished moves; unknown ones that ES took count as submitted,
+    ## the rest go back to pending once they have waited as long as a
+    ## submitted move would before failing.
+    doneBytes = 0
+    for move in inFlight + unknown:
+      copies = placement.get((move['index'], move['shard']), [])
+      key = (move['index'], move['shard'], move['from_node'])
+      if any(state == 'STARTED' and node == move['to_node'] for (state, node, to) in copies):
+        move['status'] = 'done'
+        doneBytes += move['bytes']
+        waited.pop(key, None)
+      elif any(state == 'RELOCATING' and node == move['from_node'] for (state, node, to) in copies):
+        move['status'] = 'submitted'
+        waited.pop(key, None)
+      else:
+        waited[key] = waited.get(key, 0) + 1
+        if waited[key] < failPolls:
+          continue
+        waited.pop(key, None)
+        if move['status'] == 'unknown':
+          logging.info("Move %s/%s %s -> %s was not taken, sending again." % (move['index'], move['shard'],
+                                                                               move['from_node'], move['to_node']))
+          move['status'] = 'pending'
+        else:
+          logging.warn("Move %s/%s %s -> %s did not happen." % (move['index'], move['shard'],
+                                                                 move['from_node'], move['to_node']))
+          move['status'] = 'failed'
+    pending = _groups(plan)
+
+    now = time.time()
+    newRate = doneBytes / max(now - lastCheck, 1e-3)
+    lastCheck = now
+
+    ## Adapt the in-flight target
+    maxHeap = max([heap.get(n, 0) for n in involved] or [0])
+    if maxHeap > heapHigh:
+      target = max(minInFlight, target // 2)
+    elif rate is None or newRate >= rate * 0.95:
+      target = min(maxInFlight, target + 1)
+    else:
+      target = max(minInFlight, target - 1)
+    rate = newRate if rate is None else 0.5 * newRate + 0.5 * rate
+
+    ## Fill up to the target
+    free = target - relocating
+    batch = []
+    sent = 0
+    while pending and free > 0 and (not batch or sent + len(pending[0]) <= batchSize):
+      group = pending.pop(0)
+      batch.append(group)
+      sent += len(group)
+      free -= len(group)
+    if batch:
+      for move in submitBatch(esMaster, esPort, batch):
+        move['status'] = 'submitted'
+
+    counts = {}
+    for move in plan:
+      counts[move['status']] = counts.get(move['status'], 0) + 1
+    logging.info("relocating %d, target %d, heap %d%%, %.1f mb/s; sent %d, done %d/%d, failed %d" %
+                 (relocating, target, maxHeap, rate / 1048576.0, sent, counts.get('done', 0),
+                  len(plan), counts.get('failed', 0)))
+    saveCheckpoint(checkpoint, plan)
+
+    if [m for m in plan if m['status'] in ('submitted', 'unknown', 'pending')]:
+      time.sleep(poll)
+
+  saveCheckpoint(checkpoint, plan)
+  return plan
@@ -0,0 +1,402 @@
+## es_planner.py - indexed shard move planner
+##
+## Holds an in-memory model of the cluster: node load, the shards on each
+## node, and an index -> node -> shard count map, so checking whether a
+## node already holds an index is a dict lookup instead of a scan of the
+## node's shard list.  Nodes sit in max/min heaps keyed by load.  Every
+## planned move is applied to the model (counts, shard lists, load) before
+## the next one is chosen, so a run of moves stays consistent.
+##
+## A shard's share of its node's load is taken as its share of the node's
+## shard activity; that share moves with the shard.
+##
+## With a zone map, no move may put a shard on a node in a zone that
+## already holds another copy (primary or replica) of the same shard, and
+## destinations in the source's zone are preferred to keep recovery
+## traffic inside the zone.
+
+import heapq
+import bisect
+from collections import namedtuple
+
+## Shard entries are [index, shard#, activity, bytes].
+Model = namedtuple('Model', 'load shards counts activity exclude version zones copies')
+Move = namedtuple('Move', 'index shard source destination')
+
+
+def buildModel(usage, shards, exclude = (), zones = None):
+  """
+  usage is tellMeWhatToMove's node -> [load, docs, disk, shards];
+  shards is node -> list of shard entries.  Nodes in exclude are never
+  chosen as destinations.  zones is an optional node -> zone dict.
+
+  returns Model
+  """
+  load = {}
+  nodeShards = {}
+  counts = {}
+  activity = {}
+  copies = {}
+  for node in usage:
+    load[node] = float(usage[node][0])
+    nodeShards[node] = list(shards.get(node, []))
+    activity[node] = 0
+    for entry in nodeShards[node]:
+      byNode = counts.setdefault(entry[0], {})
+      byNode[node] = byNode.get(node, 0) + 1
+      activity[node] += entry[2]
+      copies.setdefault((entry[0], entry[1]), []).append(node)
+  return Model(load, nodeShards, counts, activity, set(exclude), dict((n, 0) for n in usage),
+               zones or {}, copies)
+
+
+def onNode(model, index, node):
+  """
+  returns number of shards of index on node
+  """
+  return model.counts.get(index, {}).get(node, 0)
+
+
+def shardLoad(model, node, entry):
+  """
+  Estimated part of node's load caused by this shard.
+  """
+  if model.activity[node] <= 0:
+    return 0.0
+  return model.load[node] * entry[2] / float(model.activity[node])
+
+
+def applyMove(model, entry, source, destination):
+  """
+  Update the model as though entry had moved from source to destination.
+
+  returns the load that moved
+  """
+  moved = shardLoad(model, source, entry)
+  model.shards[source].remove(entry)
+  model.shards[destination].append(entry)
+
+  byNode = model.counts.setdefault(entry[0], {})
+  byNode[source] -= 1
+  if not byNode[source]:
+    del byNode[source]
+  byNode[destination] = byNode.get(destination, 0) + 1
+  nodes = model.copies[(entry[0], entry[1])]
+  nodes[nodes.index(source)] = destination
+
+  model.activity[source] -= entry[2]
+  model.activity[destination] += entry[2]
+  model.load[source] -= moved
+  model.load[destination] += moved
+  model.version[source] += 1
+  model.version[destination] += 1
+  return moved
+
+
+def zoneOk(model, entry, source, destination):
+  """
+  True unless destination's zone already holds another copy of the shard.
+  """
+  zone = model.zones.get(destination)
+  if not zone:
+    return True
+  for node in model.copies.get((entry[0], entry[1]), ()):
+    if node != source and model.zones.get(node) == zone:
+      return False
+  return True
+
+
+def sameZone(model, source, destination):
+  zone = model.zones.get(source)
+  return bool(zone) and model.zones.get(destination) == zone
+
+
+def _heaps(model):
+  hot = [(-model.load[n], model.version[n], n) for n in model.load]
+  cool = [(model.load[n], model.version[n], n) for n in model.load if n not in model.exclude]
+  heapq.heapify(hot)
+  heapq.heapify(cool)
+  return hot, cool
+
+
+def _push(model, hot, cool, node):
+  if hot is not None:
+    heapq.heappush(hot, (-model.load[node], model.version[node], node))
+  if node not in model.exclude:
+    heapq.heappush(cool, (model.load[node], model.version[node], node))
+
+
+def findDestination(model, index, source, limit = 1, cool = None, accept = None):
+  """
+  Coolest node, other than source, with fewer than 'limit' shards of
+  index.  accept is an optional extra test of a candidate node.
+
+  returns node or None
+  """
+  if cool is None:
+    cool = _heaps(model)[1]
+  popped = []
+  found = None
+  while cool:
+    item = heapq.heappop(cool)
+    (load, version, node) = item
+    if version != model.version[node]:
+      continue
+    popped.append(item)
+    if (node != source and onNode(model, index, node) < limit and
+        (accept is None or accept(node))):
+      found = node
+      break
+  for item in popped:
+    heapq.heappush(cool, item)
+  return found
+
+
+def _zonePreference(model, entry, source):
+  """
+  Destination tests to try in order: same zone as source first, as long
+  as the node stays cooler than source with the shard on it, then any
+  zone without another copy of the shard.  findDestination tries the
+  nodes coolest first within each.
+  """
+  if not model.zones:
+    return [None]
+  share = shardLoad(model, source, entry)
+  return [lambda n: (sameZone(model, source, n) and model.load[n] + share < model.load[source] and
+                     zoneOk(model, entry, source, n)),
+          lambda n: zoneOk(model, entry, source, n)]
+
+
+def planLoadMoves(model, limit = 10, perNode = 1):
+  """
+  Repeatedly move the most active remaining shard off the hottest node
+  to the coolest node with fewer than perNode shards of that index, as
+  long as the move lowers the peak.  Shards without activity are never
+  moved, as moving them lowers nothing.  Nodes in the source's zone are
+  tried first.  A shard is moved at most once.
+
+  returns list of Move, and up to 'limit' (index, node) shards that had
+          nowhere to go
+  """
+  moves = []
+  stuck = []
+  (hot, cool) = _heaps(model)
+  candidates = dict((node, sorted(model.shards[node], key=lambda e: e[2], reverse=True))
+                    for node in model.shards)
+  cursor = dict((node, 0) for node in model.shards)
+
+  while len(moves) < limit and hot:
+    (negLoad, version, node) = heapq.heappop(hot)
+    if version != model.version[node]:
+      continue
+
+    planned = False
+    queue = candidates[node]
+    while cursor[node] < len(queue):
+      entry = queue[cursor[node]]
+      cursor[node] += 1
+      share = shardLoad(model, node, entry)
+      if share <= 0:
+        ## Shards are in activity order: none left here carries load.
+        break
+      dest = None
+      possible = False
+      for accept in _zonePreference(model, entry, node):
+        found = findDestination(model, entry[0], node, perNode, cool, accept)
+        if found is not None:
+          possible = True
+          if max(model.load[found] + share, model.load[node] - share) < model.load[node]:
+            dest = found
+            break
+      if not possible:
+        if len(stuck) < limit:
+          stuck.append((entry[0], node))
+        continue
+      if dest is None:
+        continue
+      applyMove(model, entry, node, dest)
+      moves.append(Move(entry[0], entry[1], node, dest))
+      _push(model, hot, cool, node)
+      _push(model, hot, cool, dest)
+      planned = True
+      break
+
+    if not planned:
+      ## Nothing on the hottest node helps; the plan is done.
+      break
+
+  return moves, stuck
+
+
+def _swapPartner(model, hotEntry, hotNode, coolNode, bySize, sizes, tolerance, perNode, floor = 0):
+  """
+  Least active shard in bySize (coolNode's shards not yet moved, sorted
+  by size) within 'tolerance' of hotEntry's size that can go to hotNode.
+  floor is the lowest activity in bySize; a shard that low ends the search.
+  """
+  low = hotEntry[3] * (1 - tolerance)
+  high = hotEntry[3] / (1 - tolerance) if tolerance < 1 else float('inf')
+  best = None
+  i = bisect.bisect_left(sizes, low)
+  while i < len(sizes) and sizes[i] <= high:
+    entry = bySize[i]
+    i += 1
+    if entry[0] == hotEntry[0]:
+      continue
+    if best is not None and entry[2] >= best[2]:
+      continue
+    if onNode(model, entry[0], hotNode) >= perNode:
+      continue
+    if not zoneOk(model, entry, coolNode, hotNode):
+      continue
+    best = entry
+    if best[2] <= floor:
+      break
+  return best
+
+
+def _unlist(entries, entry, start = 0):
+  """
+  Remove entry itself (not an equal one) from entries, looking from start.
+  """
+  for i in xrange(start, len(entries)):
+    if entries[i] is entry:
+      del entries[i]
+      return i
+
+
+def planSwapMoves(model, limit = 10, perNode = 1, tolerance = 0.25):
+  """
+  Pair the most active shard on the hottest node with the least active
+  shard of similar size (within tolerance) on the coolest node that can
+  take it, and trade them.  Shard counts per node stay the same and disk
+  use stays close, so ES's count based balancer has nothing to undo.
+  Swaps continue while they lower the peak, up to 'limit' moves (two per
+  swap).  Cool nodes in the hot node's zone are tried first.  A shard is
+  swapped at most once.
+
+  Each node's shards not yet swapped are kept sorted by size and by
+  activity, once, and a swap only takes its two shards out of them.
+  Hot shards are tried most active first, so once one carries no more
+  load than the cool node's least active shard the rest cannot help.
+
+  returns list of (Move, Move) pairs
+  """
+  swaps = []
+  nodes = [n for n in model.load if n not in model.exclude]
+  bySize = {}
+  sizes = {}
+  byActivity = {}
+  for node in nodes:
+    bySize[node] = sorted(model.shards[node], key=lambda e: e[3])
+    sizes[node] = [e[3] for e in bySize[node]]
+    byActivity[node] = sorted(model.shards[node], key=lambda e: e[2], reverse=True)
+
+  def unlist(node, entry):
+    pos = _unlist(bySize[node], entry, bisect.bisect_left(sizes[node], entry[3]))
+    del sizes[node][pos]
+    _unlist(byActivity[node], entry)
+
+  while (len(swaps) + 1) * 2 <= limit and len(nodes) > 1:
+    nodes.sort(key=lambda n: model.load[n])
+    hotNode = nodes[-1]
+    swapped = False
+    ## Cooler nodes in the hot node's zone first.
+    for coolNode in sorted(nodes[:-1], key=lambda n: (not sameZone(model, hotNode, n), model.load[n])):
+      if model.load[coolNode] >= model.load[hotNode] or not byActivity[coolNode]:
+        continue
+      floor = byActivity[coolNode][-1]
+      for hotEntry in byActivity[hotNode]:
+        if shardLoad(model, hotNode, hotEntry) <= shardLoad(model, coolNode, floor):
+          break
+        if onNode(model, hotEntry[0], coolNode) >= perNode:
+          continue
+        if not zoneOk(model, hotEntry, hotNode, coolNode):
+          continue
+        coolEntry = _swapPartner(model, hotEntry, hotNode, coolNode, bySize[coolNode], sizes[coolNode],
+                                 tolerance, perNode, floor[2])
+        if coolEntry is None:
+          continue
+        delta = shardLoad(model, hotNode, hotEntry) - shardLoad(model, coolNode, coolEntry)
+        if delta <= 0 or model.load[coolNode] + delta >= model.load[hotNode]:
+          continue
+        applyMove(model, hotEntry, hotNode, coolNode)
+        applyMove(model, coolEntry, coolNode, hotNode)
+        unlist(hotNode, hotEntry)
+        unlist(coolNode, coolEntry)
+        swaps.append((Move(hotEntry[0], hotEntry[1], hotNode, coolNode),
+                      Move(coolEntry[0], coolEntry[1], coolNode, hotNode)))
+        swapped = True
+        break
+      if swapped:
+        break
+    if not swapped:
+      break
+
+  return swaps
+
+
+def planDedupMoves(model, perNode = 1):
+  """
+  For every node holding more than perNode shards of one index, move the
+  extra shards to the coolest node (same zone first) with fewer than
+  perNode shards of that index.
+
+  returns list of Move, and list of (index, node) shards with nowhere to go
+  """
+  moves = []
+  stuck = []
+  cool = _heaps(model)[1]
+  for node in sorted(model.load, key=lambda n: model.load[n], reverse=True):
+    byIndex = {}
+    for entry in model.shards[node]:
+      byIndex.setdefault(entry[0], []).append(entry)
+    for index in sorted(byIndex):
+      extra = sorted(byIndex[index], key=lambda e: e[2], reverse=True)[perNode:]
+      for entry in extra:
+        dest = None
+        for accept in _zonePreference(model, entry, node):
+          dest = findDestination(model, index, node, perNode, cool, accept)
+          if dest is not None:
+            break
+        if dest is None:
+          stuck.append((index, node))
+          continue
+        applyMove(model, entry, node, dest)
+        moves.append(Move(entry[0], entry[1], node, dest))
+        _push(model, None, cool, node)
+        _push(model, None, cool, dest)
+  return moves, stuck
+
+
+def planDrain(model, source, perNode = 1):
+  """
+  Move every shard off source, smallest first, each to the coolest node
+  (same zone first) with fewer than perNode shards of its index, or
+  failing that to the coolest node without a copy of that shard.  Build
+  the model with shard counts as node load and activity 1 per shard so
+  the drain evens out shard counts.
+
+  returns list of Move, and list of (index, node) shards with nowhere to go
+  """
+  moves = []
+  stuck = []
+  model.exclude.add(source)
+  cool = _heaps(model)[1]
+  for entry in sorted(model.shards.get(source, []), key=lambda e: e[3]):
+    dest = None
+    for accept in _zonePreference(model, entry, source):
+      dest = findDestination(model, entry[0], source, perNode, cool, accept)
+      if dest is not None:
+        break
+    if dest is None:
+      copies = model.copies[(entry[0], entry[1])]
+      dest = findDestination(model, entry[0], source, float('inf'), cool,
+                             lambda n: n not in copies and zoneOk(model, entry, source, n))
+    if dest is None:
+      stuck.append((entry[0], source))
+      continue
+    applyMove(model, entry, source, dest)
+    moves.append(Move(entry[0], entry[1], source, dest))
+    _push(model, None, cool, dest)
+  return moves, stuck
@@ -0,0 +1,230 @@
+## es_profile.py - per phase timing for es_report.py and tellMeWhatToMove.py
+##
+## A run is split into named phases (fetch, parse, aggregate, plan,
+## output, ...).  For each phase --profile records:
+##   wall, cpu      seconds; cpu is user + system for the whole process,
+##                  so it includes threads working for the phase
+##   wait           seconds spent waiting on ES: request round trips and
+##                  blocking reads of streamed bodies, from any thread
+##   requests, bytes  ES requests made and response bytes read off the wire
+##   rows           rows handled, as counted by the phase
+##   maxrss_mb      peak resident size of the process at the end of the phase
+## wall much larger than cpu with wait close to wall means ES is slow to
+## answer; cpu close to wall with little wait means the time is ours.
+##
+## While profiling es_client.profiler points at the Profile, so every
+## request and _cat line stream is accounted for without the callers
+## knowing.  Phases can nest; a nested phase's figures are also counted
+## in the enclosing one.  Phases named in cprofile (or 'all') are run
+## under cProfile and dumped to <summary>.<phase>.prof; cProfile only
+## sees the main thread.
+
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import es_client
+
+_fields = ('calls', 'wall', 'cpu', 'wait', 'requests', 'bytes', 'rows', 'maxrss_mb')
+
+
+def _cpu():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+def _rssMb():
+  ## ru_maxrss is kB on Linux, bytes on OS X.
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def _newPhase():
+  return dict((field, 0) for field in _fields)
+
+
+class Profile(object):
+  """
+  Phase figures for one run.  A Profile made with enabled False records
+  nothing, so callers can always wrap their phases.
+  """
+  def __init__(self, tool, enabled = True, cprofile = ()):
+    self.tool = tool
+    self.enabled = enabled
+    self.cprofile = set(cprofile)
+    self.phases = OrderedDict()
+    self.profilers = {}
+    self.stack = []
+    self.pending = []
+    self.frames = []
+    self.switched = False
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.startCpu = _cpu()
+    self.outside = _newPhase()
+    self.totals = _newPhase()
+    if enabled:
+      es_client.profiler = self
+
+  def _charge(self, **amounts):
+    with self.lock:
+      self._add(amounts)
+
+  def _add(self, amounts):
+    for rec in (self.stack or [self.outside]) + [self.totals]:
+      for (field, amount) in amounts.items():
+        rec[field] += amount
+
+  def _settle(self, only = None):
+    """
+    Charge the bytes of pending responses whose body has been read
+    (or just 'only').
+    """
+    with self.lock:
+      for resp in list(self.pending):
+        if resp is only or (only is None and getattr(resp, '_content_consumed', False)):
+          self.pending.remove(resp)
+          self._add({'bytes': resp.raw.tell() if resp.raw else 0})
+
+  def start(self, name):
+    """
+    Begin phase 'name'; entering a phase again adds to it.
+    """
+    if not self.enabled:
+      return
+    rec = self.phases.setdefault(name, _newPhase())
+    prof = None
+    if name in self.cprofile or 'all' in self.cprofile:
+      import cProfile
+      prof = self.profilers.setdefault(name, cProfile.Profile())
+    with self.lock:
+      self.stack.append(rec)
+      self.frames.append((time.time(), _cpu(), prof))
+    if prof:
+      prof.enable()
+
+  def stop(self):
+    """
+    End the innermost phase.
+    """
+    if not self.enabled or not self.stack:
+      return
+    (wall, cpu, prof) = self.frames[-1]
+    if prof:
+      prof.disable()
+    rec = self.stack[-1]
+    rec['wall'] += time.time() - wall
+    rec['cpu'] += _cpu() - cpu
+    rec['calls'] += 1
+    rec['maxrss_mb'] = _rssMb()
+    self._settle()
+    with self.lock:
+      self.stack.pop()
+      self.frames.pop()
+
+  def switch(self, name = None):
+    """
+    For straight line scripts: end the phase begun by the last switch
+    and begin 'name' (if given).
+    """
+    if self.switched:
+      self.stop()
+      self.switched = False
+    if name:
+      self.start(name)
+      self.switched = self.enabled
+
+  @contextmanager
+  def phase(self, name):
+    """
+    Time the block as phase 'name'.
+    """
+    self.start(name)
+    try:
+      yield
+    finally:
+      self.stop()
+
+  def count(self, rows):
+    """
+    Add to the row count of the innermost phase.
+    """
+    if self.enabled and self.stack:
+      self.stack[-1]['rows'] += rows
+
+  def request(self, seconds, resp):
+    """
+    es_client reports each request with its round trip time.  Bytes
+    are charged once the body has been read.
+    """
+    with self.lock:
+      self._add({'requests': 1, 'wait': seconds})
+      self.pending.append(resp)
+    if getattr(resp, '_content_consumed', False):
+      self._settle(resp)
+
+  def stream(self, resp, iterable):
+    """
+    Wrap a streamed body iterator, charging blocked time to wait and
+    the bytes read to the phase in progress when it ends.
+    """
+    if not self.enabled:
+      return iterable
+    return self._stream(resp, iterable)
+
+  def _stream(self, resp, iterable):
+    iterator = iter(iterable)
+    waited = 0.0
+    try:
+      while True:
+        start = time.time()
+        try:
+          item = next(iterator)
+        except StopIteration:
+          break
+        finally:
+          waited += time.time() - start
+        yield item
+    finally:
+      self._charge(wait=waited)
+      self._settle(resp)
+
+  def summary(self):
+    self.switch()
+    self._settle()
+    total = dict(wall=time.time() - self.started, cpu=_cpu() - self.startCpu, maxrss_mb=_rssMb())
+    for field in ('wait', 'requests', 'bytes'):
+      total[field] = self.totals[field]
+    return {'tool': self.tool, 'argv': sys.argv[1:], 'started': self.started, 'total': total,
+            'phases': [dict(rec, name=name) for (name, rec) in self.phases.items()],
+            'unphased': self.outside}
+
+  def write(self, path):
+    """
+    Write the JSON summary to path ('-' for stderr) and any cProfile
+    dumps beside it.
+    """
+    if not self.enabled:
+      return
+    summary = self.summary()
+    if path == '-':
+      json.dump(summary, sys.stderr, indent=1)
+      sys.stderr.write("\n")
+    else:
+      with open(path, 'w') as handle:
+        json.dump(summary, handle, indent=1)
+      for (name, prof) in self.profilers.items():
+        prof.dump_stats("%s.%s.prof" % (path, name))
+    self.log(summary)
+
+  def log(self, summary):
+    logging.info("Phase             calls     wall      cpu     wait  requests        bytes       rows  rss mb")
+    for rec in summary['phases'] + [dict(summary['total'], name='total', calls=1, rows=0)]:
+      logging.info("%-16s %6d %8.2f %8.2f %8.2f %9d %12d %10d %7.1f" % (
+        rec['name'], rec['calls'], rec['wall'], rec['cpu'], rec['wait'], rec['requests'], rec['bytes'],
+        rec['rows'], rec['maxrss_mb']))
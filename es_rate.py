@@ -0,0 +1,161 @@
+## es_rate.py - indexing rate estimation from _stats counters
+##
+## Samples the per shard copy indexing counters (index_total,
+## index_time_in_millis) N times, interval seconds apart.  Counters only
+## ever go up while a copy stays on a node, so unlike the doc count they
+## are not disturbed by deletes or merges.  A copy that relocates shows
+## up as a new (index, shard, node) key whose counter starts over; any
+## interval where a counter goes backwards is ignored.
+##
+## Each interval gives one rate.  Rates are smoothed with an EWMA and a
+## 95% confidence interval is derived from the spread of the interval
+## rates (or, with a single interval, from the event count).  More
+## samples or a longer interval give a tighter estimate at the cost of
+## collection time.
+
+import math
+import time
+import logging
+from itertools import izip
+
+import es_cat
+import es_client
+
+## Smoothing factor for the EWMA of interval rates.
+ewmaAlpha = 0.5
+
+## Two sided 95% normal quantile.
+zScore = 1.96
+
+## Per shard copy rate record layout.
+RATE, LOW, HIGH, BUSY = range(4)
+
+
+def nodeNames(esMaster, esPort, timeout = es_client.esTimeout):
+  """
+  returns dict of node id -> node name
+  """
+  nodes = es_cat.cat(esMaster, esPort, 'nodes', ('id', 'name'), params={'full_id': 'true'},
+                     timeout=timeout).data
+  return dict(izip(nodes['id'], nodes['name']))
+
+
+def sampleIndexing(esMaster, esPort, names, timeout = es_client.esTimeout):
+  """
+  Take one sample of the indexing counters of every started shard copy.
+
+  returns (timestamp, dict of (index, shard, node) -> (index_total, index_time_in_millis))
+  """
+  start = time.time()
+  data = es_client.get(esMaster, esPort, '_stats/indexing',
+                       params={'level': 'shards'}, timeout=timeout).json()
+  ## Counters were read somewhere during the request; use the midpoint.
+  stamp = (start + time.time()) / 2.0
+
+  counters = {}
+  for (index, idata) in data.get('indices', {}).items():
+    for (shard, copies) in idata.get('shards', {}).items():
+      for copy in copies:
+        routing = copy.get('routing', {})
+        if routing.get('state', 'STARTED') != 'STARTED':
+          continue
+        node = names.get(routing.get('node'), routing.get('node'))
+        indexing = copy.get('indexing', {})
+        counters[(index, shard, node)] = (indexing.get('index_total', 0),
+                                          indexing.get('index_time_in_millis', 0))
+  return stamp, counters
+
+
+def collectSamples(esMaster, esPort, samples = 3, interval = 10, timeout = es_client.esTimeout):
+  """
+  Take 'samples' counter samples, 'interval' seconds apart.
+
+  returns list of (timestamp, counters)
+  """
+  names = nodeNames(esMaster, esPort, timeout)
+  taken = []
+  for i in range(samples):
+    if i:
+      time.sleep(max(0, taken[-1][0] + interval - time.time()))
+    taken.append(sampleIndexing(esMaster, esPort, names, timeout))
+    logging.info("Indexing sample %d of %d: %d shard copies" % (i + 1, samples, len(taken[-1][1])))
+  return taken
+
+
+def estimateRates(samples, alpha = ewmaAlpha):
+  """
+  Indexing rate per shard copy from a list of samples.
+
+  returns dict of (index, shard, node) -> [docs/s, low, high, busy ms/s]
+  """
+  rates = {}
+  prev = None
+  history = {}
+  for (stamp, counters) in samples:
+    if prev is not None:
+      dt = stamp - prev[0]
+      if dt <= 0:
+        continue
+      for (key, (total, busy)) in counters.items():
+        last = prev[1].get(key)
+        if last is None or total < last[0]:
+          continue
+        history.setdefault(key, []).append(((total - last[0]) / dt,
+                                            max(0, busy - last[1]) / dt,
+                                            total - last[0], dt))
+    prev = (stamp, counters)
+
+  for (key, intervals) in history.items():
+    ewma = None
+    ewmaBusy = None
+    for (rate, busy, count, dt) in intervals:
+      if ewma is None:
+        ewma = rate
+        ewmaBusy = busy
+      else:
+        ewma = alpha * rate + (1 - alpha) * ewma
+        ewmaBusy = alpha * busy + (1 - alpha) * ewmaBusy
+
+    k = len(intervals)
+    if k >= 2:
+      mean = sum(i[0] for i in intervals) / k
+      var = sum((i[0] - mean) ** 2 for i in intervals) / (k - 1)
+      err = zScore * math.sqrt(var / k)
+    else:
+      ## Poisson error on the single interval's event count.
+      err = zScore * math.sqrt(intervals[0][2]) / intervals[0][3]
+    rates[key] = [ewma, max(0.0, ewma - err), ewma + err, ewmaBusy]
+  return rates
+
+
+def nodeRates(rates):
+  """
+  Sum shard copy rates per node.  Bounds are combined assuming the
+  shard errors are independent.
+
+  returns dict of node -> [docs/s, low, high, busy ms/s]
+  """
+  nodes = {}
+  errs = {}
+  for ((index, shard, node), rec) in rates.items():
+    if node not in nodes:
+      nodes[node] = [0.0, 0.0, 0.0, 0.0]
+      errs[node] = 0.0
+    nodes[node][RATE] += rec[RATE]
+    nodes[node][BUSY] += rec[BUSY]
+    errs[node] += ((rec[HIGH] - rec[LOW]) / 2.0) ** 2
+
+  for node in nodes:
+    err = math.sqrt(errs[node])
+    nodes[node][LOW] = max(0.0, nodes[node][RATE] - err)
+    nodes[node][HIGH] = nodes[node][RATE] + err
+  return nodes
+
+
+def collectRates(esMaster, esPort, samples = 3, interval = 10):
+  """
+  Sample and estimate in one call.
+
+  returns dict of (index, shard, node) -> [docs/s, low, high, busy ms/s]
+  """
+  return estimateRates(collectSamples(esMaster, esPort, samples, interval))
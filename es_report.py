@@ -2,8 +2,20 @@
 
 ## es_report.py - generate a report on the state of an ES cluster
 ##
-## TODO:
-##   Send reports data to some metrics service.
+## With -w/--watch it runs as a daemon instead, polling _cat/indices and
+## publishing totals and per-customer gauges (see es_watch.py).
+##
+## With -A/--advise a Consolidation Advice section lists shrink and
+## roll-up plans for customers with small daily indexes and the shards
+## and cluster state they would save; --apply runs them (see
+## es_advisor.py).
+##
+## With --profile the time, CPU, ES wait, bytes and rows of each phase
+## of the run are written as JSON (see es_profile.py).
+##
+## With -I/--inventory every cluster in the inventory file is queried
+## concurrently (see es_inventory.py) and one consolidated report is
+## printed, with cross-cluster totals and the hottest clusters and nodes.
 ##
 ## Information we are attempting to extract:
 ##   Cluster state size 
@@ -16,96 +28,222 @@
 ##   number of shards per customer
 ##   number of documents per customer
 
-import re
-import urllib2
+import atexit
 import requests
 import argparse
+import es_client
+import es_cat
+import es_state
+import es_aggregate
+import es_collect
+import es_inventory
+import es_watch
+import es_history
+import es_advisor
+import es_profile
 import logging
 from collections import namedtuple
-from operator import attrgetter
-from datetime import datetime
+from operator import attrgetter, itemgetter
 
 ## Default values
 defESNode="localhost"
 defClusterDescriptor="Production"
 
-## Timeout in seconds
-esTimeout = 90
-
 orphanCount = 0
 orphanIdx = []
 
-esIdx = []
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger()
 
 ## Argument parsing...
 parser = argparse.ArgumentParser(description='Generate a customer index report against ElasticSearch.')
-parser.add_argument("-c", "--cluster", default="%s", help="Which ES Cluster this report is for." defClusterDescriptor)
-parser.add_argument("-H", "--host", default="%s", help="An ES host in to query." % defESNode)
+parser.add_argument("-c", "--cluster", default=defClusterDescriptor, help="Which ES Cluster this report is for.")
+parser.add_argument("-H", "--host", default=defESNode, help="An ES host in to query.")
 parser.add_argument("-P", "--port", default="9200", help="ES HTTP API Port (default: 9200)", type=int)
+parser.add_argument("-s", "--stream", action='store_true', help="Stream the cluster state and break its size down by section and customer.")
+parser.add_argument("-w", "--watch", default=0, type=int, help="Poll every WATCH seconds and publish metrics instead of printing a report.")
+parser.add_argument("--prometheus", default=0, type=int, help="With -w, serve Prometheus metrics on this port at /metrics.")
+parser.add_argument("--statsd", default=None, help="With -w, send gauges to this statsd host:port.")
+parser.add_argument("-I", "--inventory", default=None, help="Cluster inventory file (name host[:port] [timeout] per line); report on all of them at once.")
+parser.add_argument("-d", "--db", nargs='?', const=es_history.defaultDb, default=None, help="Record this run in a history database (default %s) and add growth and capacity forecasts." % es_history.defaultDb)
+parser.add_argument("--days", default=es_history.historyDays, type=int, help="Days of history used for forecasts. (default %d)" % es_history.historyDays)
+parser.add_argument("-A", "--advise", action='store_true', help="Advise shard consolidation for customers with small daily indexes.")
+parser.add_argument("--small", default=es_advisor.smallIndexBytes / (1024 * 1024), type=int, help="With -A, average daily primary size in mb below which a customer is advised. (default %d)" % (es_advisor.smallIndexBytes / (1024 * 1024)))
+parser.add_argument("--apply", action='store_true', help="With -A, run the advised plans.")
+parser.add_argument("--parallel", default=2, type=int, help="With --apply, plans run at once. (default 2)")
+parser.add_argument("-y", "--yes", action='store_true', help="With --apply, do not ask for confirmation.")
+parser.add_argument("--profile", default=None, help="Write per phase wall and cpu time, ES wait, requests, bytes, rows and peak rss as JSON to this file ('-' for stderr).")
+parser.add_argument("--cprofile", default="", help="With --profile, comma separated phases (or 'all') to run under cProfile, dumped to PROFILE.<phase>.prof.")
 parser.add_argument("-v", "--verbose", action='store_true', help="Increase verbosity.")
 
 args = parser.parse_args()
 if args.verbose:
     logger.setLevel(logging.INFO)
+if args.watch > 0 and not (args.prometheus or args.statsd):
+  parser.error("-w needs --prometheus and/or --statsd to publish to")
 
 esHost = args.host
 esPort = args.port
 clusterName = args.cluster
 
+profile = es_profile.Profile('es_report', bool(args.profile), [p for p in args.cprofile.split(',') if p])
+if args.profile:
+  atexit.register(profile.write, args.profile)
+
+if args.watch > 0:
+  es_watch.watch(esHost, esPort, clusterName, args.watch, args.prometheus, args.statsd)
+  exit()
+
+
+#########################################
+## Multi-cluster report
+def stateSize(host, port, stream, timeout):
+  reqData = es_client.get(host, port, "_cluster/state", stream=True, timeout=timeout)
+  if stream:
+    return es_state.stateBreakdown(profile.stream(reqData, reqData.iter_content(es_state.stateChunk)))[0]
+  return len(reqData.content)
+
+def clusterReport(cluster):
+  """
+  State size, index rows and node loads of one inventory cluster,
+  fetched concurrently.
+  """
+  timeout = es_inventory.httpTimeout(cluster)
+  return es_client.gather({
+    'state': (stateSize, (cluster.host, cluster.port, args.stream, timeout)),
+    'indices': (es_watch.readIndices, (cluster.host, cluster.port, timeout)),
+    'nodes': (es_collect.getNodeData, (cluster.host, cluster.port, timeout)),
+  })
+
+if args.inventory:
+  clusters = es_inventory.readInventory(args.inventory)
+  profile.switch('fan out')
+  results = es_inventory.fanOut(clusters, clusterReport)
+  profile.count(len(clusters))
+  profile.switch('output')
+
+  print "\nOverall Elastic Search Information: %d clusters" % len(clusters)
+  print "%20s\t%10s\t%8s\t%8s\t%12s\t%10s\t%s" % ("cluster", "state", "indexes", "shards", "docs", "data", "orphans")
+  allTotals = [0, 0, 0, 0, 0, 0]
+  nodeRank = []
+  clusterRank = []
+  custRows = []
+  for (cluster, data, error) in results:
+    if error:
+      print "%20s\tunreachable: %s" % (cluster.name, error)
+      continue
+    stats = {}
+    totals = [data['state'], 0, 0, 0, 0, 0]
+    for (customer, idxDate, shards, docs, size) in data['indices'].values():
+      totals[1] += 1
+      totals[2] += shards
+      totals[3] += docs
+      totals[4] += size
+      if idxDate == es_aggregate.orphanDate:
+        totals[5] += 1
+      else:
+        es_aggregate.addIndex(stats, customer, idxDate, shards, docs, size)
+    for i in range(6):
+      allTotals[i] += totals[i]
+    print "%20s\t%7.2f mb\t%8d\t%8d\t%12d\t%7d gb\t%d" % (cluster.name, float(totals[0]) / (1024.00 * 1024.00), totals[1], totals[2], totals[3], totals[4] / (1024 * 1024 * 1024), totals[5])
+
+    (zones, loads) = data['nodes']
+    for (node, load) in loads.items():
+      nodeRank.append((load, cluster.name, node))
+    if loads:
+      clusterRank.append((sum(loads.values()) / len(loads), max(loads.values()), len(loads), cluster.name))
+    custRows.extend((cluster.name,) + row for row in es_aggregate.customerRows(stats))
+
+  print "%20s\t%7.2f mb\t%8d\t%8d\t%12d\t%7d gb\t%d" % ("All clusters", float(allTotals[0]) / (1024.00 * 1024.00), allTotals[1], allTotals[2], allTotals[3], allTotals[4] / (1024 * 1024 * 1024), allTotals[5])
+
+  print "\nHottest Clusters (mean data node load)"
+  print "%20s\t%6s\t%6s\t%5s" % ("cluster", "mean", "max", "nodes")
+  for (mean, peak, count, name) in sorted(clusterRank, reverse=True):
+    print "%20s\t%6.2f\t%6.2f\t%5d" % (name, mean, peak, count)
+
+  print "\nHottest Nodes"
+  print "%4s\t%20s\t%30s\t%6s" % ("rank", "cluster", "node", "load")
+  for (rank, (load, name, node)) in enumerate(sorted(nodeRank, reverse=True)[:10], 1):
+    print "%4d\t%20s\t%30s\t%6.2f" % (rank, name, node, load)
+
+  print "\nCustomer Metrics"
+  print "%20s\t%60s\tindexes\tshards\t    docs\t data size\tnewest - oldest = retention" % ("cluster", "Customer Environment")
+  for (name, cust, idxCount, shardCount, docCount, size, newest, oldest, retension) in custRows:
+    print "%20s\t%60s\t%d\t%d\t%8d\t%8.2f mb\t%s - %s = %d" % (name, cust, idxCount, shardCount, docCount, float(size) / (1024.00 * 1024.00), newest, oldest, retension)
+  exit()
+
 
 print "\nOverall %s Elastic Search Information" % clusterName
 #########################################
 ## Get cluster state size... Actually do a try instead of assuming it works.
+profile.switch('state')
 try:
-  req = urllib2.Request("http://%s:%s/_cluster/state" % (esHost, esPort))
-  reqData = urllib2.urlopen(url=req, timeout=esTimeout)
-except urllib2.URLError, e:
-  logging.error("URL failed: %s" % e.reason)
-  exit()
-except urllib2.HTTPError, e:
-  logging.error("Server Error: %s" % e.code)
+  reqData = es_client.get(esHost, esPort, "_cluster/state", stream=True)
+except requests.HTTPError, e:
+  logging.error("Server Error: %s" % e.response.status_code)
   exit(-1)
+except requests.RequestException, e:
+  logging.error("URL failed: %s" % e)
+  exit()
 else:
-  clusterSize = float(len(reqData.read())) / (1024.00 * 1024.00)
+  if args.stream or args.advise:
+    (stateBytes, stateSections, stateCustomers) = es_state.stateBreakdown(profile.stream(reqData, reqData.iter_content(es_state.stateChunk)))
+  else:
+    stateBytes = len(reqData.content)
+  clusterSize = float(stateBytes) / (1024.00 * 1024.00)
   print "Cluster State Size: %8.2f mb" % clusterSize
 
+  if args.stream and stateBytes > 0:
+    for (section, size) in sorted(stateSections.items(), key=itemgetter(1), reverse=True):
+      print "%20s: %8.2f mb\t%5.2f%%" % (section, float(size) / (1024.00 * 1024.00), float(size * 100) / float(stateBytes))
+
+    print "\n\nCluster State by Customer"
+    print "%60s\t%s\t%s" % ("customer", "size", "percent")
+    for (customer, size) in sorted(stateCustomers.items(), key=itemgetter(1), reverse=True):
+      print "%60s\t%8.2f mb\t%5.2f%%" % (customer, float(size) / (1024.00 * 1024.00), float(size * 100) / float(stateBytes))
+
 
 #########################################
 ## Get Index Part of the report
+profile.switch('indices')
 totIdx = 0
 totShards = 0
 totDocs = 0
 totSize = 0
 
 idxInfo = namedtuple("idxInfo", 'name shards documents size customer date')
-req = requests.get("http://%s:%s/_cat/indices?bytes=b" % (esHost, esPort), stream=True, timeout=esTimeout)
-
-for esIndex in req.iter_lines():
-  fields = esIndex.split()
-
-  if len(fields) >= 7:
-    regRes = re.match(r'(.*)-(\d{4}\.\d{2}\.\d{2})', fields[2])
-    if regRes:
-      customer = regRes.group(1)
-      idxDate = regRes.group(2)
-    else:
-      customer = fields[2]
-      idxDate = "1970.01.01"
-
-    node = idxInfo(fields[2], fields[3], int(fields[5]) - int(fields[6]), fields[7], customer, idxDate)
-    totIdx += 1
-    totShards += int(node.shards)
-    totDocs += int(node.documents)
-    totSize += int(node.size)
-    
-    if idxDate == "1970.01.01":
-      orphanCount += 1
-      orphanIdx.append(node)
-    else:
-      esIdx.append(node)
+custStats = {}
+catColumns = ('index', 'pri', 'docs.count', 'docs.deleted', 'store.size')
+if args.advise:
+  catColumns += ('rep', 'pri.store.size')
+catTypes = dict((column, 'int') for column in catColumns[1:])
+advIndexes = {}
+totCopies = 0
 
+## Closed indexes have blank counts and sizes; only open ones are read.
+indices = es_cat.cat(esHost, esPort, "indices", catColumns, types=catTypes, where={'status': ('open',)}).data
+for (pos, name) in enumerate(indices['index']):
+  (customer, idxDate) = es_aggregate.splitIndexName(name)
+  shards = indices['pri'][pos]
+  docs = indices['docs.count'][pos] - indices['docs.deleted'][pos]
+  size = indices['store.size'][pos]
+  totIdx += 1
+  totShards += shards
+  totDocs += docs
+  totSize += size
+  if args.advise:
+    replicas = indices['rep'][pos]
+    advIndexes[name] = (customer, idxDate, shards, replicas, docs, indices['pri.store.size'][pos])
+    totCopies += shards * (1 + replicas)
+
+  if idxDate == es_aggregate.orphanDate:
+    orphanCount += 1
+    orphanIdx.append(idxInfo(name, shards, docs, size, customer, idxDate))
+  else:
+    es_aggregate.addIndex(custStats, customer, idxDate, shards, docs, size)
+
+profile.count(totIdx)
+profile.switch('output')
 print "Indexes: %d\nShards: %d\nDocuments: %d" % (totIdx, totShards, totDocs)
 print "Data Under Management: {0:0d} gb".format(totSize / (1024 * 1024 * 1024))
 print "Orphaned Indexes: %d     (should be zero)" % orphanCount
@@ -118,38 +256,98 @@ if orphanCount > 0:
 
 print "\nCustomer Metrics"
 print "                                       Customer Environment\tindexes\tshards\t    docs\t data size\tnewest - oldest = retention"
-curCust = False
-idxCount = 0
-shardCount = 0
-docCount = 0
-size = 0
-oldest = "2038.12.31"
-newest = "1970.01.01"
-for a in sorted(esIdx, key=attrgetter('customer')):
-  if (a.customer != curCust) and (curCust):
-      retension = datetime.strptime(newest, "%Y.%m.%d") - datetime.strptime(oldest, "%Y.%m.%d")
-      print "%60s\t%d\t%d\t%8d\t%8.2f mb\t%s - %s = %d" % (curCust, idxCount, shardCount, docCount, float(size) / (1024.00 * 1024.00), newest, oldest, retension.days + 1)
-
-      idxCount = 0
-      docCount = 0
-      shardCount = 0
-      size = 0
-      oldest = "2038.12.31"
-      newest = "1970.01.01"
-
-  curCust = a.customer
-  idxCount += 1
-  docCount += int(a.documents)
-  shardCount += int(a.shards)
-  size += int(a.size)
-  cDate = datetime.strptime(a.date, "%Y.%m.%d")
-  if cDate < datetime.strptime(oldest,"%Y.%m.%d"):
-      oldest = a.date
-  if cDate > datetime.strptime(newest, "%Y.%m.%d"):
-      newest = a.date
+## The last customer in name order has never been listed; that is kept
+## so the report output does not change.
+profile.switch('aggregate')
+custRows = list(es_aggregate.customerRows(custStats))
+profile.count(len(custRows))
+profile.switch('output')
+for (cust, idxCount, shardCount, docCount, size, newest, oldest, retension) in custRows[:-1]:
+  print "%60s\t%d\t%d\t%8d\t%8.2f mb\t%s - %s = %d" % (cust, idxCount, shardCount, docCount, float(size) / (1024.00 * 1024.00), newest, oldest, retension)
 
 if orphanCount > 0:
   print "\n\nOrphaned Indexes"
   print "%48s\t%s\t%s\t%s" % ("index", "shards", "docs", "size")
   for a in sorted(orphanIdx, key=attrgetter('customer')):
     print "%48s\t%s\t%s\t%0.2f mb" % (a.customer, a.shards, a.documents, float(a.size) / (1024.00 * 1024.00))
+
+
+#########################################
+## History and forecasts
+def days(value):
+  if value is None:
+    return "-"
+  return "%d" % value
+
+if args.db:
+  profile.switch('history')
+  try:
+    nodeCap = es_history.nodeCapacity(esHost, esPort)
+    watermarks = es_history.diskWatermarks(esHost, esPort)
+  except requests.RequestException, e:
+    logging.error("Could not read node capacity: %s" % e)
+    exit(-1)
+  historyDb = es_history.openDb(args.db)
+  es_history.recordRun(historyDb, clusterName, custRows, nodeCap)
+
+  growth = es_history.customerGrowth(historyDb, clusterName, args.days)
+  print "\n\nCustomer Growth per Day (last %d days, top %d by size)" % (args.days, es_history.reportTop)
+  print "%60s\t%10s\t%12s\t%8s\t%10s" % ("customer", "size/day", "docs/day", "shards/day", "size")
+  for (cust, sizeRate, docRate, shardRate, size, shards) in growth[:es_history.reportTop]:
+    print "%60s\t%7.2f mb\t%12d\t%8.1f\t%7.2f gb" % (cust, sizeRate / (1024.00 * 1024.00), docRate, shardRate, float(size) / (1024.00 * 1024.00 * 1024.00))
+
+  forecast = es_history.nodeForecast(historyDb, clusterName, watermarks, args.days)
+  print "\n\nNode Capacity Forecast (days until low / high disk watermark, shards against %d per gb heap)" % es_history.shardsPerHeapGb
+  print "%20s\t%6s\t%8s\t%5s\t%5s\t%7s\t%8s\t%6s\t%5s" % ("node", "disk", "gb/day", "low", "high", "shards", "shards/day", "limit", "days")
+  for (node, used, total, diskRate, toLow, toHigh, shards, shardRate, limit, toLimit) in forecast:
+    print "%20s\t%5.1f%%\t%8.2f\t%5s\t%5s\t%7d\t%8.1f\t%6d\t%5s" % (node, float(used * 100) / max(total, 1), (diskRate or 0) / (1024.00 * 1024.00 * 1024.00),
+                                                                 days(toLow), days(toHigh), shards, shardRate or 0, limit, days(toLimit))
+
+  if forecast:
+    (node, used, total, diskRate, toLow, toHigh, shards, shardRate, limit, toLimit) = forecast[0]
+    if toHigh is not None or toLimit is not None:
+      print "\nNext at risk: %s (high watermark in %s days, shard limit in %s days)" % (node, days(toHigh), days(toLimit))
+      if toLimit is not None and (toHigh is None or toLimit <= toHigh):
+        culprits = [g for g in sorted(growth, key=lambda g: g[3], reverse=True)[:3] if g[3] > 0]
+        if culprits:
+          print "Fastest shard growth: %s" % ", ".join("%s (%.1f/day)" % (g[0], g[3]) for g in culprits)
+      else:
+        culprits = [g for g in growth[:3] if g[1] > 0]
+        if culprits:
+          print "Fastest size growth: %s" % ", ".join("%s (%.2f gb/day)" % (g[0], g[1] / (1024.00 * 1024.00 * 1024.00)) for g in culprits)
+
+
+#########################################
+## Consolidation advice
+if args.advise:
+  profile.switch('advise')
+  plans = es_advisor.advise(advIndexes, args.small * 1024 * 1024)
+  profile.count(len(plans))
+  costs = es_advisor.stateCosts(stateSections, totIdx, totCopies)
+  print "\n\nConsolidation Advice (customers averaging under %d mb per day)" % args.small
+  print "%60s\t%7s\t%7s\t%6s\t%8s\t%10s\t%s" % ("target", "action", "sources", "shards", "copies", "state", "size")
+  savedCopies = 0
+  savedState = 0.0
+  for plan in plans:
+    (copies, stateSaved) = es_advisor.savings(plan, costs)
+    savedCopies += copies
+    savedState += stateSaved
+    print "%60s\t%7s\t%7d\t%6d\t%3d -> %d\t%7.2f kb\t%8.2f mb" % (plan.target, plan.action, len(plan.sources), plan.shards,
+                                                             plan.shardsBefore, plan.shardsAfter, stateSaved / 1024.00,
+                                                             float(plan.bytes) / (1024.00 * 1024.00))
+  print "\n%d plans for %d customers: %d indexes and %d shard copies fewer, about %.2f mb less cluster state" % (
+    len(plans), len(set(p.customer for p in plans)), sum(len(p.sources) - 1 for p in plans), savedCopies, savedState / (1024.00 * 1024.00))
+
+  if args.apply and plans:
+    if not args.yes:
+      try:
+        answer = raw_input("\nApply %d plans against %s:%d? [y/N] " % (len(plans), esHost, esPort))
+      except EOFError:
+        answer = ""
+      if answer.strip().lower() != 'y':
+        exit()
+    profile.switch('apply')
+    failed = [(plan, error) for (plan, error) in es_advisor.applyPlans(esHost, esPort, plans, args.parallel) if error]
+    print "\n%d of %d plans applied" % (len(plans) - len(failed), len(plans))
+    for (plan, error) in failed:
+      print "%60s\tfailed: %s" % (plan.target, error)
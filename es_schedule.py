@@ -0,0 +1,167 @@
+## es_schedule.py - order shard moves to finish a drain or rebalance soonest
+##
+## Cost model: a relocation copies the shard's bytes at the recovery
+## throttle (indices.recovery.max_bytes_per_sec), which each node shares
+## between the recoveries it runs at once.  A node runs at most
+## 'outgoing' recoveries as a source and 'incoming' as a destination
+## (cluster.routing.allocation.node_concurrent_*recoveries).  So a move of
+## B bytes takes about B / (throttle / slots) seconds plus a fixed cost.
+##
+## Moves are list scheduled longest first: whenever a slot frees up the
+## longest pending move whose source and destination both have a free
+## slot starts.  The result is a projected start/end for every move and
+## the total wall clock time, next to a lower bound for comparison.
+
+import heapq
+import logging
+
+import requests
+
+import es_client
+
+## ES defaults when the cluster does not report its settings.
+defaultBytesPerSec = 40 * 1024 * 1024
+defaultRecoveries = 2
+
+## Fixed seconds per relocation (cluster state updates, file listing, ...)
+moveOverhead = 2.0
+
+_units = (('pb', 1024 ** 5), ('tb', 1024 ** 4), ('gb', 1024 ** 3), ('mb', 1024 ** 2),
+          ('kb', 1024), ('p', 1024 ** 5), ('t', 1024 ** 4), ('g', 1024 ** 3),
+          ('m', 1024 ** 2), ('k', 1024), ('b', 1))
+
+
+def parseBytes(value):
+  """
+  ES byte size setting ("40mb", "1gb", "512") -> bytes
+  """
+  text = str(value).strip().lower()
+  for (unit, scale) in _units:
+    if text.endswith(unit):
+      return int(float(text[:-len(unit)]) * scale)
+  return int(float(text))
+
+
+def recoverySettings(esMaster, esPort):
+  """
+  Read the recovery throttle and per node recovery limits, with ES
+  defaults for anything not set.
+
+  returns (bytes/s, incoming slots, outgoing slots)
+  """
+  settings = {}
+  try:
+    data = es_client.get(esMaster, esPort, '_cluster/settings',
+                         params={'flat_settings': 'true', 'include_defaults': 'true'}).json()
+    ## transient overrides persistent overrides defaults
+    for part in ('defaults', 'persistent', 'transient'):
+      settings.update(data.get(part, {}))
+  except requests.RequestException, e:
+    logging.warn("Could not read cluster settings, using defaults: %s" % e)
+
+  rate = parseBytes(settings.get('indices.recovery.max_bytes_per_sec', defaultBytesPerSec))
+  both = int(settings.get('cluster.routing.allocation.node_concurrent_recoveries', defaultRecoveries))
+  incoming = int(settings.get('cluster.routing.allocation.node_concurrent_incoming_recoveries', both))
+  outgoing = int(settings.get('cluster.routing.allocation.node_concurrent_outgoing_recoveries', both))
+  return rate, max(1, incoming), max(1, outgoing)
+
+
+def moveDuration(size, rate, slots):
+  """
+  Seconds to relocate 'size' bytes when a node's 'rate' is split 'slots' ways.
+  """
+  return moveOverhead + float(size) * slots / max(rate, 1)
+
+
+def scheduleMoves(plan, rate, incoming, outgoing):
+  """
+  Project a timeline for es_mover plan moves.
+
+  returns (list of (start, end, move) ordered by start, makespan, lower bound)
+  """
+  slots = max(incoming, outgoing)
+  bySource = {}
+  busyOut = {}
+  busyIn = {}
+  load = {}
+  for move in plan:
+    duration = moveDuration(move['bytes'], rate, slots)
+    bySource.setdefault(move['from_node'], []).append((duration, move))
+    load[move['from_node']] = load.get(move['from_node'], 0.0) + duration / outgoing
+    load[move['to_node']] = load.get(move['to_node'], 0.0) + duration / incoming
+  for node in bySource:
+    bySource[node].sort(key=lambda d: d[0], reverse=True)
+
+  timeline = []
+  running = []
+  now = 0.0
+  left = len(plan)
+  while left:
+    for node in bySource:
+      queue = bySource[node]
+      i = 0
+      while busyOut.get(node, 0) < outgoing and i < len(queue):
+        (duration, move) = queue[i]
+        dest = move['to_node']
+        if busyIn.get(dest, 0) < incoming:
+          queue.pop(i)
+          busyOut[node] = busyOut.get(node, 0) + 1
+          busyIn[dest] = busyIn.get(dest, 0) + 1
+          heapq.heappush(running, (now + duration, len(timeline), move))
+          timeline.append((now, now + duration, move))
+          left -= 1
+        else:
+          i += 1
+    if not running:
+      break
+    (end, seq, move) = heapq.heappop(running)
+    now = end
+    busyOut[move['from_node']] -= 1
+    busyIn[move['to_node']] -= 1
+
+  makespan = max([finish for (begin, finish, moved) in timeline] or [0.0])
+  return timeline, makespan, max(load.values() or [0.0])
+
+
+def orderPlan(plan, timeline):
+  """
+  Reorder plan to the projected start order, keeping grouped moves
+  together (a group goes where its first member starts) and moves that
+  are no longer pending at the front.
+  """
+  first = {}
+  for (seq, (start, end, move)) in enumerate(timeline):
+    key = move.get('group')
+    key = id(move) if key is None else ('group', key)
+    first.setdefault(key, seq)
+
+  def rank(move):
+    if move['status'] != 'pending':
+      return -1
+    key = move.get('group')
+    return first.get(id(move) if key is None else ('group', key), len(timeline))
+
+  plan.sort(key=rank)
+  return plan
+
+
+def _clock(seconds):
+  seconds = int(seconds)
+  return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def logTimeline(timeline, makespan, bound, rate, incoming, outgoing, verbose = True):
+  """
+  Show the projected timeline before anything is submitted.
+  """
+  logging.info("Recovery throttle %.1f mb/s per node, %d incoming / %d outgoing per node." %
+               (rate / 1048576.0, incoming, outgoing))
+  if verbose:
+    logging.info("   start -      end  move")
+    for (start, end, move) in timeline:
+      logging.info("%s - %s  %s %s : %s -> %s (%.1f mb)" % (_clock(start), _clock(end), move['from_node'],
+                                                            move['index'], move['shard'], move['to_node'],
+                                                            move['bytes'] / 1048576.0))
+  logging.info("Projected: %d moves, %.1f gb, done in %s (lower bound %s)." %
+               (len(timeline), sum(m['bytes'] for (s, e, m) in timeline) / 1073741824.0,
+                _clock(makespan), _clock(bound)))
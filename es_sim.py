@@ -0,0 +1,756 @@
+#!/usr/bin/env python
+
+## es_sim.py - offline cluster simulator and local stand-in ES endpoint
+##
+## Generates a synthetic cluster: data nodes spread over zones, customers
+## with daily customer-YYYY.MM.DD indexes, shard sizes following each
+## customer's daily volume, and indexing skewed across customers (zipf)
+## with only the newest daily index receiving writes.  Node load is a
+## base load plus a share proportional to the indexing rate of the shard
+## copies the node holds, so moving a hot shard really moves load.
+##
+## The cluster can be served over HTTP with just enough of the ES API for
+## the tools in this repo:
+##   GET  _cat/shards[/indexes], _cat/nodes, _cat/indices[/indexes], _cat/health,
+##        _cat/allocation
+##   GET  _cluster/state, _cluster/settings, _stats/indexing, _nodes/stats
+##   POST _cluster/reroute (move commands)
+## A reroute move relocates the copy: it shows as RELOCATING on the
+## source (and INITIALIZING on the target) until its recovery finishes,
+## which takes bytes / recovery throttle, queued behind the target's
+## incoming recovery slots.  --speed runs the simulated clock faster.
+##
+## Shard copies are held column wise in arrays, one row per copy, laid
+## out index by index and shard by shard (primary first), so a million
+## copies fit in a few tens of MB.
+"""
+usage: es_sim.py [-h] [-p PORT] [-N NODES] [-Z ZONES] [-C CUSTOMERS] [-D DAYS]
+                 [-S SHARDS] [--primaries PRIMARIES] [-R REPLICAS]
+                 [--skew SKEW] [--speed SPEED] [--seed SEED]
+
+Serve a simulated ES cluster on localhost.
+"""
+
+import json
+import time
+import random
+import urlparse
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from array import array
+from datetime import date, timedelta
+from collections import namedtuple
+
+## Simulated recovery settings (ES defaults).
+simSettings = {
+  'indices.recovery.max_bytes_per_sec': '40mb',
+  'cluster.routing.allocation.node_concurrent_recoveries': '2',
+  'cluster.routing.allocation.node_concurrent_incoming_recoveries': '2',
+  'cluster.routing.allocation.node_concurrent_outgoing_recoveries': '2',
+}
+
+## Fixed seconds per relocation on top of copying the bytes.
+moveOverhead = 2.0
+
+## Simulated index_time_in_millis per document indexed.
+msPerDoc = 0.05
+
+## Cluster-wide mean node load the generator aims for.
+meanLoad = 3.0
+
+## Copies are laid out [primary, replica, ...] per shard; ids index
+## 'nodes' and 'indices'.  'clock' holds the simulated time base and
+## when the cluster was made (hot indexes grow from then on), 'slots'
+## the time each node's incoming recovery slots free up.
+Cluster = namedtuple('Cluster', 'name nodes zones ids base loadScale disk heap indices idxStart idxPri '
+                     'replicas cIndex cNode cTarget cDocs cBytes cRate cBorn cFinish '
+                     'clock slots settings lock')
+
+
+def generateCluster(nodes = 9, zones = 3, customers = 500, days = 30, primaries = 5,
+                    replicas = 1, skew = 1.2, docsPerDay = 200000000, docBytes = 600,
+                    speed = 1.0, seed = 1, end = date(2016, 6, 30)):
+  """
+  Build a synthetic cluster.  Each customer has 1 to 'primaries' primary
+  shards per daily index and 'replicas' replicas; customer volume falls
+  off as 1 / rank ** skew.  Copies of a shard never share a node, nor a
+  zone while there are enough zones.
+
+  returns Cluster
+  """
+  rnd = random.Random(seed)
+  zoneNames = [chr(ord('a') + z) for z in range(zones)]
+  names = ["es-%d-zone%s" % (n + 1, zoneNames[n % zones]) for n in range(nodes)]
+  nodeZones = [zoneNames[n % zones] for n in range(nodes)]
+  ids = ["simnode%04d%s" % (n + 1, "".join(rnd.choice("abcdefghijklmnop") for i in range(8)))
+         for n in range(nodes)]
+  base = array('d', [rnd.uniform(0.2, 1.0) for n in range(nodes)])
+
+  ranks = range(customers)
+  rnd.shuffle(ranks)
+  weights = [1.0 / (r + 1) ** skew for r in ranks]
+  totalWeight = sum(weights) or 1.0
+
+  now = time.time()
+  copies = replicas + 1
+  spread = copies <= zones
+  counts = [0] * nodes
+  indices = []
+  idxStart = array('i')
+  idxPri = array('i')
+  cIndex = array('i')
+  cNode = array('i')
+  cDocs = array('d')
+  cBytes = array('d')
+  cRate = array('d')
+  cBorn = array('d')
+
+  for c in range(customers):
+    pri = rnd.randint(1, primaries)
+    daily = docsPerDay * weights[c] / totalWeight
+    for d in range(days):
+      name = "cust%05d-prod-%s" % (c, (end - timedelta(days=days - 1 - d)).strftime("%Y.%m.%d"))
+      newest = d == days - 1
+      idx = len(indices)
+      indices.append(name)
+      idxStart.append(len(cNode))
+      idxPri.append(pri)
+      for s in range(pri):
+        docs = int(daily * rnd.uniform(0.7, 1.3) / pri * (0.5 if newest else 1.0))
+        size = docs * docBytes * rnd.uniform(0.8, 1.2)
+        rate = daily / 86400.0 / pri if newest else 0.0
+        used = []
+        for k in range(copies):
+          node = _place(rnd, counts, used, nodeZones, spread)
+          used.append(node)
+          counts[node] += 1
+          cIndex.append(idx)
+          cNode.append(node)
+          cDocs.append(docs)
+          cBytes.append(size)
+          cRate.append(rate)
+          cBorn.append(now - rnd.uniform(0, 86400))
+
+  total = len(cNode)
+  totalRate = sum(cRate) or 1.0
+  ## Disks sized so an average node starts about 60% full.
+  disk = array('d', [sum(cBytes) / nodes / 0.6]) * nodes
+  loadScale = max(meanLoad * nodes - sum(base), 0.0) / totalRate
+  settings = dict(simSettings)
+  settings['cluster.routing.allocation.disk.watermark.low'] = '85%'
+  settings['cluster.routing.allocation.disk.watermark.high'] = '90%'
+  return Cluster("sim", names, nodeZones, ids, base, loadScale, disk, 31 * 1024 ** 3, indices, idxStart, idxPri,
+                 replicas, cIndex, cNode, array('i', [-1]) * total, cDocs, cBytes, cRate, cBorn,
+                 array('d', [0.0]) * total, {'start': now, 'wall': now, 'made': now, 'speed': float(speed)},
+                 dict((n, []) for n in range(nodes)), settings, threading.RLock())
+
+
+def sizedCluster(shards, nodes = 9, days = 30, primaries = 5, replicas = 1, **kwargs):
+  """
+  A cluster of about 'shards' shard copies: the number of customers is
+  chosen to fit.
+  """
+  perCustomer = days * (primaries + 1) / 2.0 * (replicas + 1)
+  customers = max(1, int(round(shards / perCustomer)))
+  return generateCluster(nodes=nodes, customers=customers, days=days, primaries=primaries,
+                         replicas=replicas, **kwargs)
+
+
+def _place(rnd, counts, used, nodeZones, spread):
+  """
+  Pick a node for a new copy: the less full of two random nodes that
+  hold no copy of the shard (and, with spread, are in a zone without
+  one), else the least full such node.
+  """
+  usedZones = set(nodeZones[n] for n in used) if spread else ()
+
+  def ok(n):
+    return n not in used and nodeZones[n] not in usedZones
+
+  picks = []
+  for attempt in range(8):
+    n = rnd.randrange(len(counts))
+    if ok(n):
+      picks.append(n)
+      if len(picks) == 2:
+        break
+  if not picks:
+    picks = [node for node in range(len(counts)) if ok(node)] or [node for node in range(len(counts)) if node not in used]
+  return min(picks, key=lambda n: counts[n])
+
+
+def simTime(cluster):
+  """
+  Simulated now: wall clock time since the cluster was made, times speed.
+  """
+  clock = cluster.clock
+  return clock['start'] + (time.time() - clock['wall']) * clock['speed']
+
+
+def setSpeed(cluster, speed):
+  with cluster.lock:
+    clock = cluster.clock
+    now = simTime(cluster)
+    clock['start'] = now
+    clock['wall'] = time.time()
+    clock['speed'] = float(speed)
+
+
+def advance(cluster, now = None):
+  """
+  Complete relocations whose recovery has finished by now.
+
+  returns number completed
+  """
+  if now is None:
+    now = simTime(cluster)
+  done = 0
+  with cluster.lock:
+    target = cluster.cTarget
+    for pos in range(len(target)):
+      if target[pos] >= 0 and cluster.cFinish[pos] <= now:
+        cluster.cNode[pos] = target[pos]
+        target[pos] = -1
+        cluster.cBorn[pos] = cluster.cFinish[pos]
+        done += 1
+  return done
+
+
+def copyDocs(cluster, pos, now):
+  made = cluster.clock['made']
+  return int(cluster.cDocs[pos] + cluster.cRate[pos] * max(now - made, 0))
+
+
+def copyBytes(cluster, pos, now, docBytes = 600):
+  made = cluster.clock['made']
+  return int(cluster.cBytes[pos] + cluster.cRate[pos] * max(now - made, 0) * docBytes)
+
+
+def shardOf(cluster, pos):
+  idx = cluster.cIndex[pos]
+  return (pos - cluster.idxStart[idx]) // (cluster.replicas + 1)
+
+
+def isPrimary(cluster, pos):
+  return (pos - cluster.idxStart[cluster.cIndex[pos]]) % (cluster.replicas + 1) == 0
+
+
+def shardCopies(cluster, idx, shard):
+  first = cluster.idxStart[idx] + shard * (cluster.replicas + 1)
+  return range(first, first + cluster.replicas + 1)
+
+
+def nodeLoads(cluster):
+  """
+  returns list of load per node id
+  """
+  rates = [0.0] * len(cluster.nodes)
+  for (node, rate) in zip(cluster.cNode, cluster.cRate):
+    rates[node] += rate
+  return [cluster.base[n] + cluster.loadScale * rates[n] for n in range(len(rates))]
+
+
+def relocations(cluster):
+  """
+  returns dict of node id -> [incoming, outgoing] relocations
+  """
+  busy = dict((n, [0, 0]) for n in range(len(cluster.nodes)))
+  for pos in range(len(cluster.cTarget)):
+    target = cluster.cTarget[pos]
+    if target >= 0:
+      busy[target][0] += 1
+      busy[cluster.cNode[pos]][1] += 1
+  return busy
+
+
+def usageModel(cluster):
+  """
+  The cluster as tellMeWhatToMove.py sees it: node -> [load, docs, disk,
+  shards], node -> list of [index, shard#, activity, bytes] with
+  activity in doc-writes/minute, and node -> zone.  Only started copies
+  are included.
+  """
+  now = simTime(cluster)
+  loads = nodeLoads(cluster)
+  usage = dict((name, [loads[n], 0, 0, 0]) for (n, name) in enumerate(cluster.nodes))
+  shards = dict((name, []) for name in cluster.nodes)
+  for pos in xrange(len(cluster.cNode)):
+    if cluster.cTarget[pos] >= 0:
+      continue
+    name = cluster.nodes[cluster.cNode[pos]]
+    size = copyBytes(cluster, pos, now)
+    rec = usage[name]
+    rec[1] += copyDocs(cluster, pos, now)
+    rec[2] += size
+    rec[3] += 1
+    shards[name].append([cluster.indices[cluster.cIndex[pos]], str(shardOf(cluster, pos)),
+                         int(round(cluster.cRate[pos] * 60)), size])
+  return usage, shards, dict(zip(cluster.nodes, cluster.zones))
+
+
+def applyMoves(cluster, moves):
+  """
+  Place moved copies on their destinations at once, bypassing recovery.
+  moves are (index, shard, source, destination) tuples such as
+  es_planner.Move.
+  """
+  byName = dict((name, n) for (n, name) in enumerate(cluster.nodes))
+  byIndex = dict((name, i) for (i, name) in enumerate(cluster.indices))
+  for (index, shard, source, destination) in moves:
+    for pos in shardCopies(cluster, byIndex[index], int(shard)):
+      if cluster.cNode[pos] == byName[source]:
+        cluster.cNode[pos] = byName[destination]
+        break
+
+
+def _parseBytes(value):
+  units = (('gb', 1024 ** 3), ('mb', 1024 ** 2), ('kb', 1024), ('b', 1))
+  text = str(value).lower()
+  for (unit, scale) in units:
+    if text.endswith(unit):
+      return float(text[:-len(unit)]) * scale
+  return float(text)
+
+
+class RerouteError(Exception):
+  pass
+
+
+def reroute(cluster, commands, dryRun = False):
+  """
+  Apply a list of reroute commands.  Only 'move' is supported.  Like
+  ES, the commands are all checked before any takes effect.  Raises
+  RerouteError for an invalid command.
+  """
+  with cluster.lock:
+    now = simTime(cluster)
+    advance(cluster, now)
+    byName = dict((name, n) for (n, name) in enumerate(cluster.nodes))
+    byIndex = dict((name, i) for (i, name) in enumerate(cluster.indices))
+    planned = []
+    taken = set()
+    for command in commands:
+      if 'move' not in command:
+        raise RerouteError("unsupported command %s" % ",".join(command))
+      move = command['move']
+      index = move.get('index')
+      if index not in byIndex:
+        raise RerouteError("[move_allocation] no such index [%s]" % index)
+      shard = int(move.get('shard', -1))
+      if not 0 <= shard < cluster.idxPri[byIndex[index]]:
+        raise RerouteError("[move_allocation] no such shard [%s][%d]" % (index, shard))
+      source = byName.get(move.get('from_node'))
+      destination = byName.get(move.get('to_node'))
+      if source is None or destination is None:
+        raise RerouteError("[move_allocation] unknown node [%s] or [%s]" %
+                           (move.get('from_node'), move.get('to_node')))
+      found = None
+      for pos in shardCopies(cluster, byIndex[index], shard):
+        if cluster.cNode[pos] == destination or cluster.cTarget[pos] == destination or (pos, destination) in taken:
+          raise RerouteError("[move_allocation] can't move [%s][%d], a copy is already on node [%s]" %
+                             (index, shard, move['to_node']))
+        if cluster.cNode[pos] == source:
+          found = pos
+      if found is None or cluster.cTarget[found] >= 0:
+        raise RerouteError("[move_allocation] can't move [%s][%d], failed to find it on node [%s]" %
+                           (index, shard, move['from_node']))
+      planned.append((found, destination))
+      taken.add((found, destination))
+
+    if dryRun:
+      return
+    rate = _parseBytes(cluster.settings['indices.recovery.max_bytes_per_sec'])
+    incoming = int(cluster.settings['cluster.routing.allocation.node_concurrent_incoming_recoveries'])
+    for (pos, destination) in planned:
+      slots = cluster.slots[destination]
+      slots.sort()
+      if len(slots) >= incoming and slots[0] > now:
+        start = slots.pop(0)
+      else:
+        if len(slots) >= incoming:
+          slots.pop(0)
+        start = now
+      finish = start + moveOverhead + copyBytes(cluster, pos, now) * incoming / rate
+      slots.append(finish)
+      cluster.cTarget[pos] = destination
+      cluster.cFinish[pos] = finish
+
+
+###############################################
+## _cat and JSON renderers.  Each returns an iterable of strings.
+
+def _catLines(rows, columns, header):
+  if header:
+    yield " ".join(columns) + "\n"
+  for row in rows:
+    yield " ".join(str(row[c]) for c in columns if c in row) + "\n"
+
+
+def catShards(cluster, columns, indexes = None, header = False):
+  now = simTime(cluster)
+  wanted = None
+  if indexes:
+    wanted = set(indexes)
+
+  def rows():
+    for pos in xrange(len(cluster.cNode)):
+      index = cluster.indices[cluster.cIndex[pos]]
+      if wanted is not None and index not in wanted:
+        continue
+      node = cluster.nodes[cluster.cNode[pos]]
+      target = cluster.cTarget[pos]
+      row = {'index': index, 'shard': shardOf(cluster, pos),
+             'prirep': 'p' if isPrimary(cluster, pos) else 'r',
+             'state': 'STARTED', 'docs': copyDocs(cluster, pos, now),
+             'store': copyBytes(cluster, pos, now), 'ip': '127.0.0.1', 'node': node}
+      if target >= 0:
+        row['state'] = 'RELOCATING'
+        row['node'] = "%s -> 127.0.0.1 %s %s" % (node, cluster.ids[target], cluster.nodes[target])
+        yield row
+        row = dict(row)
+        row.update({'state': 'INITIALIZING', 'docs': 0, 'store': 0, 'node': cluster.nodes[target]})
+      yield row
+
+  return _catLines(rows(), columns or ('index', 'shard', 'prirep', 'state', 'docs', 'store', 'ip', 'node'),
+                   header)
+
+
+def catNodes(cluster, columns, header = False):
+  loads = nodeLoads(cluster)
+  busy = relocations(cluster)
+  rows = []
+  for (n, name) in enumerate(cluster.nodes):
+    heap = min(99, int(30 + 8 * loads[n] + 3 * sum(busy[n])))
+    rows.append({'id': cluster.ids[n], 'name': name, 'host': name, 'ip': '127.0.0.1',
+                 'load': "%.2f" % loads[n], 'heap.percent': heap, 'hp': heap,
+                 'heap.max': cluster.heap, 'node.role': 'd', 'r': 'd', 'master': '-', 'm': '-'})
+  rows.append({'id': 'simmaster0001', 'name': 'master-1-zonea', 'host': 'master-1-zonea',
+               'ip': '127.0.0.1', 'load': "0.10", 'heap.percent': 20, 'hp': 20, 'heap.max': 4 * 1024 ** 3,
+               'node.role': 'm', 'r': 'm', 'master': '*', 'm': '*'})
+  return _catLines(rows, columns or ('host', 'ip', 'heap.percent', 'load', 'node.role', 'master', 'name'),
+                   header)
+
+
+def catIndices(cluster, columns, indexes = None, header = False):
+  now = simTime(cluster)
+  wanted = set(indexes) if indexes else None
+  copies = cluster.replicas + 1
+
+  def rows():
+    for (idx, index) in enumerate(cluster.indices):
+      if wanted is not None and index not in wanted:
+        continue
+      first = cluster.idxStart[idx]
+      count = cluster.idxPri[idx] * copies
+      docs = 0
+      store = 0
+      primary = 0
+      for pos in xrange(first, first + count):
+        size = copyBytes(cluster, pos, now)
+        store += size
+        if (pos - first) % copies == 0:
+          docs += copyDocs(cluster, pos, now)
+          primary += size
+      yield {'health': 'green', 'status': 'open', 'index': index, 'pri': cluster.idxPri[idx],
+             'rep': cluster.replicas, 'docs.count': docs, 'docs.deleted': docs // 50,
+             'store.size': store, 'pri.store.size': primary}
+
+  return _catLines(rows(), columns or ('health', 'status', 'index', 'pri', 'rep', 'docs.count',
+                                       'docs.deleted', 'store.size', 'pri.store.size'), header)
+
+
+def catAllocation(cluster, columns, header = False):
+  now = simTime(cluster)
+  shards = [0] * len(cluster.nodes)
+  used = [0] * len(cluster.nodes)
+  for pos in xrange(len(cluster.cNode)):
+    node = cluster.cNode[pos]
+    shards[node] += 1
+    used[node] += copyBytes(cluster, pos, now)
+  rows = []
+  for (n, name) in enumerate(cluster.nodes):
+    total = int(cluster.disk[n])
+    rows.append({'shards': shards[n], 'disk.indices': used[n], 'disk.used': used[n],
+                 'disk.avail': max(total - used[n], 0), 'disk.total': total,
+                 'disk.percent': used[n] * 100 // max(total, 1), 'host': name, 'ip': '127.0.0.1',
+                 'node': name})
+  return _catLines(rows, columns or ('shards', 'disk.indices', 'disk.used', 'disk.avail', 'disk.total',
+                                     'disk.percent', 'host', 'ip', 'node'), header)
+
+
+def catHealth(cluster, columns, header = False):
+  now = simTime(cluster)
+  relo = sum(1 for t in cluster.cTarget if t >= 0)
+  row = {'epoch': int(now), 'timestamp': time.strftime('%H:%M:%S', time.localtime(now)),
+         'cluster': cluster.name, 'status': 'green', 'node.total': len(cluster.nodes) + 1,
+         'node.data': len(cluster.nodes), 'shards': len(cluster.cNode),
+         'pri': sum(cluster.idxPri), 'relo': relo, 'init': relo, 'unassign': 0,
+         'pending_tasks': 0, 'max_task_wait_time': '-', 'active_shards_percent': '100.0%'}
+  return _catLines([row], columns or ('epoch', 'timestamp', 'cluster', 'status', 'node.total',
+                                      'node.data', 'shards', 'pri', 'relo', 'init', 'unassign',
+                                      'pending_tasks', 'max_task_wait_time', 'active_shards_percent'),
+                   header)
+
+
+def _routing(cluster, pos):
+  target = cluster.cTarget[pos]
+  return {'state': 'RELOCATING' if target >= 0 else 'STARTED', 'primary': isPrimary(cluster, pos),
+          'node': cluster.ids[cluster.cNode[pos]],
+          'relocating_node': cluster.ids[target] if target >= 0 else None,
+          'shard': shardOf(cluster, pos), 'index': cluster.indices[cluster.cIndex[pos]]}
+
+
+def clusterState(cluster):
+  """
+  The full cluster state document, one index at a time.
+  """
+  copies = cluster.replicas + 1
+  yield '{"cluster_name":%s,"version":%d,"master_node":"simmaster0001","nodes":%s' % (
+    json.dumps(cluster.name), int(simTime(cluster)),
+    json.dumps(dict((cluster.ids[n], {'name': name, 'transport_address': '127.0.0.1:9300',
+                                      'attributes': {'zone': cluster.zones[n]}})
+                    for (n, name) in enumerate(cluster.nodes))))
+
+  yield ',"metadata":{"cluster_uuid":"simcluster","templates":{},"indices":{'
+  for (idx, index) in enumerate(cluster.indices):
+    meta = {'state': 'open',
+            'settings': {'index': {'number_of_shards': str(cluster.idxPri[idx]),
+                                   'number_of_replicas': str(cluster.replicas),
+                                   'uuid': 'sim%08d' % idx}},
+            'mappings': {'event': {'properties': {'@timestamp': {'type': 'date'},
+                                                  'message': {'type': 'string'}}}},
+            'aliases': []}
+    yield '%s%s:%s' % (',' if idx else '', json.dumps(index), json.dumps(meta))
+
+  yield '}},"routing_table":{"indices":{'
+  for (idx, index) in enumerate(cluster.indices):
+    first = cluster.idxStart[idx]
+    shards = dict((str(s), [_routing(cluster, pos) for pos in range(first + s * copies, first + (s + 1) * copies)])
+                  for s in range(cluster.idxPri[idx]))
+    yield '%s%s:%s' % (',' if idx else '', json.dumps(index), json.dumps({'shards': shards}))
+
+  yield '}},"routing_nodes":{"unassigned":[],"nodes":{'
+  byNode = dict((n, []) for n in range(len(cluster.nodes)))
+  for pos in xrange(len(cluster.cNode)):
+    byNode[cluster.cNode[pos]].append(pos)
+  for n in range(len(cluster.nodes)):
+    yield '%s%s:[' % (',' if n else '', json.dumps(cluster.ids[n]))
+    yield ",".join(json.dumps(_routing(cluster, pos)) for pos in byNode[n])
+    yield ']'
+  yield '}}}'
+
+
+def indexingStats(cluster):
+  """
+  _stats/indexing?level=shards, one index at a time.
+  """
+  now = simTime(cluster)
+  copies = cluster.replicas + 1
+  yield '{"_shards":{"total":%d,"successful":%d,"failed":0},"indices":{' % ((len(cluster.cNode),) * 2)
+  for (idx, index) in enumerate(cluster.indices):
+    first = cluster.idxStart[idx]
+    shards = {}
+    for pos in xrange(first, first + cluster.idxPri[idx] * copies):
+      total = int(cluster.cRate[pos] * max(now - cluster.cBorn[pos], 0))
+      routing = _routing(cluster, pos)
+      shards.setdefault(str(routing['shard']), []).append(
+        {'routing': {'state': routing['state'], 'primary': routing['primary'], 'node': routing['node'],
+                     'relocating_node': routing['relocating_node']},
+         'indexing': {'index_total': total, 'index_time_in_millis': int(total * msPerDoc)}})
+    yield '%s%s:%s' % (',' if idx else '', json.dumps(index), json.dumps({'shards': shards}))
+  yield '}}'
+
+
+def nodesStats(cluster):
+  """
+  _nodes/stats with the thread pool, jvm, indices and fs figures
+  es_heat reads.  Merge, refresh and disk counters follow the indexing
+  on the node; GC time follows its base load, so nodes with a high
+  base load look busy by load average but not by indexing.
+  """
+  now = simTime(cluster)
+  loads = nodeLoads(cluster)
+  busy = relocations(cluster)
+  rates = [0.0] * len(cluster.nodes)
+  docs = [0.0] * len(cluster.nodes)
+  copies = [0] * len(cluster.nodes)
+  for pos in xrange(len(cluster.cNode)):
+    node = cluster.cNode[pos]
+    rates[node] += cluster.cRate[pos]
+    docs[node] += cluster.cRate[pos] * max(now - cluster.cBorn[pos], 0)
+    copies[node] += 1
+  meanRate = sum(rates) / max(len(rates), 1) or 1.0
+
+  nodes = {}
+  for (n, name) in enumerate(cluster.nodes):
+    nodes[cluster.ids[n]] = {
+      'name': name, 'roles': ['data', 'ingest'],
+      'thread_pool': {'bulk': {'queue': int(5 * rates[n] / meanRate), 'rejected': 0},
+                      'search': {'queue': 0, 'rejected': 0}},
+      'jvm': {'mem': {'heap_used_percent': min(99, int(30 + 8 * loads[n] + 3 * sum(busy[n])))},
+              'gc': {'collectors': {'young': {'collection_time_in_millis': int(cluster.base[n] * 300 * now)},
+                                    'old': {'collection_time_in_millis': 0}}}},
+      'indices': {'merges': {'total_time_in_millis': int(docs[n] * msPerDoc * 2)},
+                  'refresh': {'total_time_in_millis': int(copies[n] * now)}},
+      'fs': {'io_stats': {'total': {'operations': int(docs[n] / 100)}}},
+    }
+  nodes['simmaster0001'] = {'name': 'master-1-zonea', 'roles': ['master']}
+  return [json.dumps({'cluster_name': cluster.name, 'nodes': nodes})]
+
+
+def clusterSettings(cluster, defaults = False):
+  body = {'persistent': {}, 'transient': {}}
+  if defaults:
+    body['defaults'] = dict(cluster.settings)
+  return [json.dumps(body)]
+
+
+###############################################
+## HTTP stand-in
+
+class SimServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class SimHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """
+  Serves server.cluster.  Responses are streamed and the connection
+  closed at the end (HTTP/1.0), so nothing has to be sized up front.
+  """
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def _reply(self, status, parts, contentType = 'application/json; charset=UTF-8'):
+    self.send_response(status)
+    self.send_header('Content-Type', contentType)
+    self.end_headers()
+    for part in parts:
+      self.wfile.write(part)
+
+  def _error(self, status, kind, reason):
+    self._reply(status, [json.dumps({'error': {'type': kind, 'reason': reason}, 'status': status})])
+
+  def do_GET(self):
+    cluster = self.server.cluster
+    parsed = urlparse.urlparse(self.path)
+    query = dict((k, v[-1]) for (k, v) in urlparse.parse_qs(parsed.query, True).items())
+    parts = [p for p in parsed.path.split('/') if p]
+    columns = [c for c in query.get('h', '').split(',') if c]
+    header = query.get('v', 'false') in ('', 'true')
+    text = 'text/plain; charset=UTF-8'
+
+    advance(cluster)
+    with cluster.lock:
+      if parts[:2] == ['_cat', 'shards']:
+        indexes = parts[2].split(',') if len(parts) > 2 else None
+        self._reply(200, catShards(cluster, columns, indexes, header), text)
+      elif parts[:2] == ['_cat', 'nodes']:
+        self._reply(200, catNodes(cluster, columns, header), text)
+      elif parts[:2] == ['_cat', 'indices']:
+        indexes = parts[2].split(',') if len(parts) > 2 else None
+        self._reply(200, catIndices(cluster, columns, indexes, header), text)
+      elif parts[:2] == ['_cat', 'allocation']:
+        self._reply(200, catAllocation(cluster, columns, header), text)
+      elif parts[:2] == ['_cat', 'health']:
+        self._reply(200, catHealth(cluster, columns, header), text)
+      elif parts[:2] == ['_cluster', 'state']:
+        self._reply(200, clusterState(cluster))
+      elif parts[:2] == ['_cluster', 'settings']:
+        self._reply(200, clusterSettings(cluster, query.get('include_defaults') == 'true'))
+      elif parts[:2] == ['_stats', 'indexing']:
+        self._reply(200, indexingStats(cluster))
+      elif parts[:2] == ['_nodes', 'stats']:
+        self._reply(200, nodesStats(cluster))
+      elif not parts:
+        self._reply(200, [json.dumps({'name': 'master-1-zonea', 'cluster_name': cluster.name,
+                                      'version': {'number': '2.4.6'}})])
+      else:
+        self._error(400, 'illegal_argument_exception', 'no handler for %s' % parsed.path)
+
+  def do_POST(self):
+    cluster = self.server.cluster
+    parsed = urlparse.urlparse(self.path)
+    query = dict((k, v[-1]) for (k, v) in urlparse.parse_qs(parsed.query, True).items())
+    length = int(self.headers.getheader('Content-Length') or 0)
+    body = self.rfile.read(length) if length else ''
+
+    if parsed.path.strip('/') != '_cluster/reroute':
+      self._error(400, 'illegal_argument_exception', 'no handler for %s' % parsed.path)
+      return
+    try:
+      commands = json.loads(body or '{}').get('commands', [])
+      reroute(cluster, commands, query.get('dry_run') == 'true')
+    except ValueError, e:
+      self._error(400, 'parse_exception', str(e))
+    except RerouteError, e:
+      self._error(400, 'illegal_argument_exception', str(e))
+    else:
+      self._reply(200, [json.dumps({'acknowledged': True})])
+
+
+def startServer(cluster, port = 0, verbose = False):
+  """
+  Serve cluster on localhost in a background thread.  Port 0 picks a
+  free port.
+
+  returns the server; server.server_address[1] is the port
+  """
+  server = SimServer(('127.0.0.1', port), SimHandler)
+  server.cluster = cluster
+  server.verbose = verbose
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+###############################################
+## Argument parsing...
+parser = argparse.ArgumentParser(description='Serve a simulated ES cluster on localhost.')
+parser.add_argument("-p", "--port", default=9250, type=int,
+                    help="Port to listen on. (default 9250)")
+parser.add_argument("-N", "--nodes", default=9, type=int,
+                    help="Number of data nodes. (default 9)")
+parser.add_argument("-Z", "--zones", default=3, type=int,
+                    help="Number of zones. (default 3)")
+parser.add_argument("-C", "--customers", default=200, type=int,
+                    help="Number of customers. (default 200)")
+parser.add_argument("-D", "--days", default=30, type=int,
+                    help="Daily indexes per customer. (default 30)")
+parser.add_argument("-S", "--shards", default=0, type=int,
+                    help="Aim for about this many shard copies instead of -C customers.")
+parser.add_argument("--primaries", default=5, type=int,
+                    help="Most primary shards per index. (default 5)")
+parser.add_argument("-R", "--replicas", default=1, type=int,
+                    help="Replicas per shard. (default 1)")
+parser.add_argument("--skew", default=1.2, type=float,
+                    help="Zipf exponent of indexing volume across customers. (default 1.2)")
+parser.add_argument("--speed", default=1.0, type=float,
+                    help="Simulated seconds per real second. (default 1)")
+parser.add_argument("--seed", default=1, type=int,
+                    help="Random seed. (default 1)")
+parser.add_argument("-v", "--verbose", action='store_true',
+                    help="Log every request.")
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  options = dict(nodes=args.nodes, zones=args.zones, days=args.days, primaries=args.primaries,
+                 replicas=args.replicas, skew=args.skew, speed=args.speed, seed=args.seed)
+  if args.shards:
+    cluster = sizedCluster(args.shards, **options)
+  else:
+    cluster = generateCluster(customers=args.customers, **options)
+  print "Simulated cluster: %d nodes, %d indexes, %d shard copies." % (len(cluster.nodes), len(cluster.indices),
+                                                                       len(cluster.cNode))
+  server = startServer(cluster, args.port, args.verbose)
+  print "Serving on http://127.0.0.1:%d/ (Ctrl-C to stop)" % server.server_address[1]
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
@@ -0,0 +1,254 @@
+## es_snapshot.py - binary shard/node snapshot store for tellMeWhatToMove.py
+##
+## Each collection run is saved as one timestamped file in a snapshot
+## directory, so many past runs sit side by side and rates can be worked
+## out between any two of them without asking the cluster again.
+##
+## File layout (native byte order, flagged in the header, all sections
+## 8 byte aligned so every column can be sliced straight out of an mmap):
+##   header   magic, version, byte order, timestamp, name/shard/node counts
+##   names    interned index, node and zone names: uint32 offsets + utf-8 blob
+##   shards   columns: node, index (name ids), shard#, activity, docs,
+##            bytes, index_total, index_time_in_millis (-1 when unknown)
+##   nodes    columns: node, zone (name ids), load average
+
+import os
+import sys
+import mmap
+import time
+import struct
+from array import array
+from collections import namedtuple
+
+snapMagic = 'TMWS'
+snapVersion = 1
+snapSuffix = '.tmws'
+
+## Number of snapshots kept per directory.
+snapKeep = 200
+
+_header = struct.Struct('<4sHHdIIII')
+_byteOrder = {'little': 1, 'big': 2}
+
+
+def _typecode(size, codes):
+  for code in codes:
+    try:
+      if array(code).itemsize == size:
+        return code
+    except ValueError:
+      pass
+  raise ValueError("no %d byte array type" % size)
+
+_u32 = _typecode(4, 'IL')
+_i64 = _typecode(8, 'lq')
+
+## Column name -> array type, in file order.
+shardColumns = (('node', _u32), ('index', _u32), ('shard', _u32),
+                ('activity', _i64), ('docs', _i64), ('size', _i64),
+                ('indexTotal', _i64), ('indexTime', _i64))
+nodeColumns = (('node', _u32), ('zone', _u32), ('load', 'd'))
+
+Snapshot = namedtuple('Snapshot', 'stamp names shards nodes')
+
+
+def _pad(length):
+  return (8 - length % 8) % 8
+
+
+def snapshotName(stamp):
+  return time.strftime('%Y%m%dT%H%M%S', time.gmtime(stamp)) + ('.%03d' % (int(stamp * 1000) % 1000)) + snapSuffix
+
+
+def listSnapshots(dirName):
+  """
+  returns snapshot paths in the directory, oldest first
+  """
+  if not os.path.isdir(dirName):
+    return []
+  return [os.path.join(dirName, f) for f in sorted(os.listdir(dirName)) if f.endswith(snapSuffix)]
+
+
+def findSnapshot(dirName, name = None):
+  """
+  Path of the named snapshot (file name or unique prefix) or the latest.
+  returns None if there is no match
+  """
+  snaps = listSnapshots(dirName)
+  if name is None:
+    return snaps[-1] if snaps else None
+  matches = [s for s in snaps if os.path.basename(s).startswith(name) or s == name]
+  if len(matches) == 1:
+    return matches[0]
+  return None
+
+
+def writeSnapshot(dirName, rows, zones, loads, counters = None, stamp = None):
+  """
+  Save one collection run.
+  rows are [node, index, shard#, activity, docs, bytes] as built by
+  tellMeWhatToMove.py; counters is an optional dict of
+  (index, shard, node) -> (index_total, index_time_in_millis).
+
+  returns the path written
+  """
+  if stamp is None:
+    stamp = time.time()
+  if counters is None:
+    counters = {}
+  if not os.path.isdir(dirName):
+    os.makedirs(dirName)
+
+  ids = {}
+  names = []
+
+  def intern(name):
+    i = ids.get(name)
+    if i is None:
+      i = len(names)
+      ids[name] = i
+      names.append(name)
+    return i
+
+  shards = dict((col, array(code)) for (col, code) in shardColumns)
+  for (node, index, shard, activity, docs, size) in rows:
+    shards['node'].append(intern(node))
+    shards['index'].append(intern(index))
+    shards['shard'].append(int(shard))
+    shards['activity'].append(int(activity))
+    shards['docs'].append(int(docs))
+    shards['size'].append(int(size))
+    (total, busy) = counters.get((index, shard, node), (-1, -1))
+    shards['indexTotal'].append(int(total))
+    shards['indexTime'].append(int(busy))
+
+  nodes = dict((col, array(code)) for (col, code) in nodeColumns)
+  for node in sorted(set(zones) | set(loads)):
+    nodes['node'].append(intern(node))
+    nodes['zone'].append(intern(zones.get(node, '')))
+    nodes['load'].append(float(loads.get(node, 0.0)))
+
+  offsets = array(_u32, [0])
+  encoded = [n.encode('utf-8') for n in names]
+  blob = ''.join(encoded)
+  for n in encoded:
+    offsets.append(offsets[-1] + len(n))
+
+  path = os.path.join(dirName, snapshotName(stamp))
+  tmpPath = path + '.tmp'
+  with open(tmpPath, 'wb') as handle:
+    handle.write(_header.pack(snapMagic, snapVersion, _byteOrder[sys.byteorder], stamp,
+                              len(names), len(rows), len(nodes['node']), len(blob)))
+    handle.write('\0' * _pad(_header.size))
+    for part in [offsets.tostring(), blob] + \
+                [shards[col].tostring() for (col, code) in shardColumns] + \
+                [nodes[col].tostring() for (col, code) in nodeColumns]:
+      handle.write(part)
+      handle.write('\0' * _pad(len(part)))
+  os.rename(tmpPath, path)
+  return path
+
+
+def readSnapshot(path):
+  """
+  Load a snapshot through mmap.  Columns come back as arrays; name
+  columns hold ids into the names list.
+
+  returns Snapshot(stamp, names, shards column dict, nodes column dict)
+  """
+  with open(path, 'rb') as handle:
+    mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    (magic, version, order, stamp, nNames, nShards, nNodes, blobLen) = _header.unpack(mm[:_header.size])
+    if magic != snapMagic or version != snapVersion:
+      raise ValueError("%s is not a version %d snapshot" % (path, snapVersion))
+    swap = order != _byteOrder[sys.byteorder]
+    pos = [_header.size + _pad(_header.size)]
+
+    def column(code, count):
+      col = array(code)
+      length = col.itemsize * count
+      col.fromstring(mm[pos[0]:pos[0] + length])
+      if swap:
+        col.byteswap()
+      pos[0] += length + _pad(length)
+      return col
+
+    offsets = column(_u32, nNames + 1)
+    blob = mm[pos[0]:pos[0] + blobLen]
+    pos[0] += blobLen + _pad(blobLen)
+    names = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in xrange(nNames)]
+
+    shards = dict((col, column(code, nShards)) for (col, code) in shardColumns)
+    nodes = dict((col, column(code, nNodes)) for (col, code) in nodeColumns)
+  finally:
+    mm.close()
+  return Snapshot(stamp, names, shards, nodes)
+
+
+def snapshotRows(snap):
+  """
+  returns shard rows [node, index, shard#, activity, docs, bytes]
+  """
+  names = snap.names
+  s = snap.shards
+  return [[names[s['node'][i]], names[s['index'][i]], str(s['shard'][i]),
+           s['activity'][i], s['docs'][i], s['size'][i]]
+          for i in xrange(len(s['node']))]
+
+
+def snapshotNodes(snap):
+  """
+  returns dict of node -> zone and dict of node -> load
+  """
+  names = snap.names
+  n = snap.nodes
+  zones = {}
+  loads = {}
+  for i in xrange(len(n['node'])):
+    zones[names[n['node'][i]]] = names[n['zone'][i]]
+    loads[names[n['node'][i]]] = n['load'][i]
+  return zones, loads
+
+
+def snapshotRates(old, new):
+  """
+  Docs written per minute for each shard copy between two snapshots.
+  Uses the indexing counters when both snapshots have them for a copy,
+  otherwise the change in doc count.  Copies that are not in both, or
+  whose counter went backwards, are left out.
+
+  returns dict of (index, shard, node) -> docs/min
+  """
+  dt = new.stamp - old.stamp
+  if dt <= 0:
+    return {}
+
+  def keyed(snap):
+    names = snap.names
+    s = snap.shards
+    return dict(((names[s['index'][i]], str(s['shard'][i]), names[s['node'][i]]),
+                 (s['indexTotal'][i], s['docs'][i]))
+                for i in xrange(len(s['node'])))
+
+  before = keyed(old)
+  rates = {}
+  for (key, (total, docs)) in keyed(new).items():
+    prev = before.get(key)
+    if prev is None:
+      continue
+    if total >= 0 and prev[0] >= 0:
+      delta = total - prev[0]
+    else:
+      delta = docs - prev[1]
+    if delta >= 0:
+      rates[key] = delta * 60.0 / dt
+  return rates
+
+
+def pruneSnapshots(dirName, keep = snapKeep):
+  """
+  Remove all but the newest 'keep' snapshots.
+  """
+  for path in listSnapshots(dirName)[:-keep]:
+    os.remove(path)
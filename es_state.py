@@ -0,0 +1,118 @@
+## es_state.py - streaming size breakdown of the ES cluster state
+##
+## The full /_cluster/state on a large cluster is hundreds of MB.  Rather
+## than reading it into one string, the response is consumed chunk by
+## chunk and only the JSON structure (braces, brackets, keys) is tracked,
+## so memory use is bounded by the chunk size plus the nesting depth.
+##
+## Bytes are attributed to:
+##   top level sections (metadata, routing_table, routing_nodes, ...)
+##   customers, using the same customer-YYYY.MM.DD split as the report:
+##     metadata.indices.<index>
+##     routing_table.indices.<index>
+##     routing_nodes shard entries (by their "index" field)
+
+import re
+from es_aggregate import splitIndexName
+
+## Size of each read from the cluster state response.
+stateChunk = 64 * 1024
+
+## Sections whose "indices" object is keyed by index name.
+indexedSections = ('metadata', 'routing_table')
+
+## A complete JSON string, a structural character, or a lone quote
+## which marks a string that continues into the next chunk.
+_token = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\],:]|"')
+
+
+def readChunks(handle, size = stateChunk):
+  """
+  Generator of fixed size reads from a file-like response.
+  """
+  while True:
+    chunk = handle.read(size)
+    if not chunk:
+      break
+    yield chunk
+
+
+def stateBreakdown(chunks):
+  """
+  Incrementally scan a cluster state JSON document delivered as an
+  iterable of string chunks.
+
+  returns (total bytes, dict of section -> bytes, dict of customer -> bytes)
+  """
+  sections = {}
+  customers = {}
+
+  ## Stack frames: [kind, key, start offset, expecting key, tracked, index]
+  ##   tracked is 'idx' when the frame belongs to one index by its key,
+  ##   'shard' for routing_nodes shard entries (index comes from a field).
+  stack = []
+  section = None
+  sectionStart = 0
+
+  carry = ""
+  base = 0
+  total = 0
+
+  for chunk in chunks:
+    total += len(chunk)
+    data = carry + chunk
+    carry = ""
+
+    for m in _token.finditer(data):
+      tok = m.group()
+      pos = base + m.start()
+
+      if tok == '"':
+        ## String runs past the end of this chunk.
+        carry = data[m.start():]
+        break
+
+      if tok == '{' or tok == '[':
+        tracked = None
+        index = None
+        depth = len(stack)
+        if (depth == 3 and stack[0][1] in indexedSections and
+            stack[1][1] == 'indices' and stack[2][0] == '{'):
+          tracked = 'idx'
+          index = stack[2][1]
+        elif (tok == '{' and depth >= 2 and stack[-1][0] == '[' and
+              stack[0][1] == 'routing_nodes'):
+          tracked = 'shard'
+        stack.append([tok, None, pos, tok == '{', tracked, index])
+
+      elif tok == '}' or tok == ']':
+        frame = stack.pop()
+        if frame[4] and frame[5] is not None:
+          customer = splitIndexName(frame[5])[0]
+          customers[customer] = customers.get(customer, 0) + pos + 1 - frame[2]
+        if not stack and section is not None:
+          sections[section] = sections.get(section, 0) + pos - sectionStart
+          section = None
+
+      elif tok == ':':
+        stack[-1][3] = False
+
+      elif tok == ',':
+        if stack[-1][0] == '{':
+          stack[-1][3] = True
+
+      else:
+        frame = stack[-1]
+        if frame[0] == '{' and frame[3]:
+          frame[1] = tok[1:-1]
+          if len(stack) == 1:
+            if section is not None:
+              sections[section] = sections.get(section, 0) + pos - sectionStart
+            section = frame[1]
+            sectionStart = pos
+        elif frame[4] == 'shard' and frame[1] == 'index':
+          frame[5] = tok[1:-1]
+
+    base += len(data) - len(carry)
+
+  return total, sections, customers
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+## es_triage.py - why are shards unassigned, all of them at once
+##
+## Lists the UNASSIGNED shard copies from _cat/shards and asks
+## _cluster/allocation/explain about them from a pool of workers, no
+## more than --rate calls a second.  Copies with the same signature
+## (index, primary or replica, unassigned reason) get the same answer
+## from ES, so only the first of each is explained and the rest share
+## its cached result; after a node loss thousands of copies usually come
+## down to a few hundred calls.
+##
+## The summary groups the copies by the deciders that said NO (filter
+## for node/awareness filters, disk_threshold for the disk watermarks,
+## max_retry for copies that gave up after too many failed attempts,
+## ...) with a sample explanation, then by unassigned reason, then the
+## indexes with the most unassigned copies.
+"""
+usage: es_triage.py [-h] [-H HOST] [-P PORT] [-r RATE] [-w WORKERS] [-i INDEX]
+                    [-l] [-v]
+
+Explain all unassigned shards, grouped by cause.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -H HOST, --host HOST  An ES host in to query.
+  -P PORT, --port PORT  ES HTTP API Port (default: 9200)
+  -r RATE, --rate RATE  Most explain calls per second. (default 20)
+  -w WORKERS, --workers WORKERS
+                        Explain calls in flight. (default 8)
+  -i INDEX, --index INDEX
+                        Only shards of indexes matching this pattern.
+  -l, --list            Also list every unassigned shard with its deciders.
+  -v, --verbose         Increase verbosity.
+"""
+
+import json
+import time
+import fnmatch
+import logging
+import argparse
+import threading
+from collections import namedtuple
+from operator import itemgetter
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import es_cat
+import es_client
+
+## Explain calls per second and in flight.
+defaultRate = 20
+defaultWorkers = 8
+
+## Deciders called out on their own in the summary.
+namedDeciders = (('filter', 'node filters'), ('disk_threshold', 'disk watermark'),
+                 ('max_retry', 'max retries'))
+
+Unassigned = namedtuple('Unassigned', 'index shard primary reason')
+
+## deciders: dict of decider -> (nodes saying NO, sample explanation)
+## attempts: failed allocation attempts; error: why explain failed, or None
+Explanation = namedtuple('Explanation', 'summary deciders attempts error')
+
+
+class RateLimiter(object):
+  """
+  At most 'rate' acquire() calls return per second, across threads.
+  """
+  def __init__(self, rate):
+    self.interval = 1.0 / rate if rate > 0 else 0
+    self.next = time.time()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    with self.lock:
+      now = time.time()
+      wait = self.next - now
+      self.next = max(now, self.next) + self.interval
+    if wait > 0:
+      time.sleep(wait)
+
+
+def unassignedShards(esMaster, esPort, pattern = None):
+  """
+  returns list of Unassigned, one per unassigned shard copy
+  """
+  found = es_cat.cat(esMaster, esPort, 'shards', ('index', 'shard', 'prirep', 'unassigned.reason'),
+                     types={'shard': 'int'}, where={'state': ('UNASSIGNED',)}).data
+  shards = []
+  for (index, shard, prirep, reason) in izip(found['index'], found['shard'], found['prirep'],
+                                             found['unassigned.reason']):
+    if pattern and not fnmatch.fnmatch(index, pattern):
+      continue
+    shards.append(Unassigned(index, shard, prirep == 'p', reason or 'UNKNOWN'))
+  return shards
+
+
+def signature(shard):
+  return (shard.index, shard.primary, shard.reason)
+
+
+def parseExplain(data):
+  """
+  Boil an allocation explain answer down to the deciders saying NO.
+  Understands the ES 5+ layout (node_allocation_decisions) and the
+  ES 2.x one (nodes -> decisions).
+
+  returns Explanation
+  """
+  deciders = {}
+  if 'node_allocation_decisions' in data:
+    nodes = [node.get('deciders', []) for node in data['node_allocation_decisions']]
+  else:
+    nodes = [node.get('decisions', []) for node in data.get('nodes', {}).values()]
+  for decisions in nodes:
+    for decision in decisions:
+      if decision.get('decision') == 'NO':
+        (count, sample) = deciders.get(decision['decider'], (0, decision.get('explanation', '')))
+        deciders[decision['decider']] = (count + 1, sample)
+
+  info = data.get('unassigned_info', {})
+  summary = (data.get('allocate_explanation') or data.get('can_allocate') or
+             info.get('details') or '')
+  return Explanation(summary, deciders, info.get('failed_allocation_attempts', 0), None)
+
+
+def explainShard(esMaster, esPort, shard):
+  """
+  returns Explanation for one shard copy
+  """
+  body = json.dumps({'index': shard.index, 'shard': shard.shard, 'primary': shard.primary})
+  try:
+    return parseExplain(es_client.post(esMaster, esPort, '_cluster/allocation/explain', body).json())
+  except (requests.RequestException, ValueError), e:
+    logging.warn("Explain failed for %s[%d]: %s" % (shard.index, shard.shard, e))
+    return Explanation('', {}, 0, str(e))
+
+
+def explainAll(esMaster, esPort, shards, rate = defaultRate, workers = defaultWorkers):
+  """
+  Explain every signature once, concurrently and rate limited.
+
+  returns dict of signature -> Explanation
+  """
+  cache = {}
+  for shard in shards:
+    cache.setdefault(signature(shard), shard)
+  limiter = RateLimiter(rate)
+
+  def explain(item):
+    (sig, shard) = item
+    limiter.acquire()
+    return (sig, explainShard(esMaster, esPort, shard))
+
+  logging.info("Explaining %d signatures for %d unassigned copies" % (len(cache), len(shards)))
+  pool = ThreadPool(max(1, min(workers, len(cache))))
+  try:
+    return dict(pool.imap_unordered(explain, cache.items()))
+  finally:
+    pool.close()
+    pool.join()
+
+
+def triage(shards, explanations):
+  """
+  Group the unassigned copies.
+
+  returns (decider -> [copies, signatures, sample], reason -> copies,
+           index -> copies, explain errors)
+  """
+  deciders = {}
+  reasons = {}
+  indexes = {}
+  errors = 0
+  seen = set()
+  for shard in shards:
+    sig = signature(shard)
+    found = explanations[sig]
+    reasons[shard.reason] = reasons.get(shard.reason, 0) + 1
+    indexes[shard.index] = indexes.get(shard.index, 0) + 1
+    if found.error:
+      errors += 1
+      continue
+    for (decider, (nodes, sample)) in (found.deciders.items() or [('none', (0, found.summary))]):
+      rec = deciders.setdefault(decider, [0, 0, sample])
+      rec[0] += 1
+      if (decider, sig) not in seen:
+        seen.add((decider, sig))
+        rec[1] += 1
+  return (deciders, reasons, indexes, errors)
+
+
+def printTriage(shards, explanations, listAll = False):
+  (deciders, reasons, indexes, errors) = triage(shards, explanations)
+  print "Unassigned shard copies: %d (%d primaries), %d explain calls" % (
+    len(shards), sum(1 for s in shards if s.primary), len(explanations))
+  for (decider, label) in namedDeciders:
+    print "%20s: %d" % (label, deciders.get(decider, [0])[0])
+  if errors:
+    print "%20s: %d" % ("explain failed", errors)
+
+  print "\nBy Decider (copies blocked by a NO from the decider on any node)"
+  print "%20s\t%7s\t%10s\t%s" % ("decider", "copies", "signatures", "sample explanation")
+  for (decider, (copies, sigs, sample)) in sorted(deciders.items(), key=lambda d: d[1][0], reverse=True):
+    print "%20s\t%7d\t%10d\t%s" % (decider, copies, sigs, sample)
+
+  print "\nBy Unassigned Reason"
+  for (reason, copies) in sorted(reasons.items(), key=itemgetter(1), reverse=True):
+    print "%20s\t%7d" % (reason, copies)
+
+  print "\nMost Unassigned Indexes"
+  for (index, copies) in sorted(indexes.items(), key=itemgetter(1), reverse=True)[:10]:
+    print "%60s\t%7d" % (index, copies)
+
+  if listAll:
+    print "\nUnassigned Shards"
+    for shard in sorted(shards):
+      found = explanations[signature(shard)]
+      print "%60s\t%3d\t%s\t%20s\t%3d\t%s" % (shard.index, shard.shard, 'p' if shard.primary else 'r', shard.reason,
+                                              found.attempts, found.error or ",".join(sorted(found.deciders)) or found.summary)
+
+
+###############################################
+## Argument parsing...
+parser = argparse.ArgumentParser(description='Explain all unassigned shards, grouped by cause.')
+parser.add_argument("-H", "--host", default="localhost", help="An ES host in to query.")
+parser.add_argument("-P", "--port", default="9200", help="ES HTTP API Port (default: 9200)", type=int)
+parser.add_argument("-r", "--rate", default=defaultRate, type=float, help="Most explain calls per second. (default %d)" % defaultRate)
+parser.add_argument("-w", "--workers", default=defaultWorkers, type=int, help="Explain calls in flight. (default %d)" % defaultWorkers)
+parser.add_argument("-i", "--index", default=None, help="Only shards of indexes matching this pattern.")
+parser.add_argument("-l", "--list", action='store_true', help="Also list every unassigned shard with its deciders.")
+parser.add_argument("-v", "--verbose", action='store_true', help="Increase verbosity.")
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+  try:
+    shards = unassignedShards(args.host, args.port, args.index)
+  except requests.RequestException, e:
+    logging.error("Could not list shards: %s" % e)
+    exit(-1)
+  if not shards:
+    print "No unassigned shards."
+    exit()
+  start = time.time()
+  explanations = explainAll(args.host, args.port, shards, args.rate, args.workers)
+  logging.info("Explained in %.1fs" % (time.time() - start))
+  printTriage(shards, explanations, args.list)
@@ -0,0 +1,265 @@
+## es_watch.py - incremental customer index metrics for es_report.py --watch
+##
+## Keeps a warm model of the last _cat/indices answer: every index's row
+## and the per-customer aggregates built from them.  Each poll is diffed
+## against the model by index name and only indexes that appeared,
+## disappeared or changed are folded out of (es_aggregate.removeIndex)
+## and back into (es_aggregate.addIndex) their customer's record, so
+## customers whose indexes did not change are not touched.
+##
+## The totals and per-customer gauges are published as Prometheus text
+## on /metrics and/or as statsd gauges.  Per-customer exposition lines
+## are cached and only rebuilt for changed customers; statsd gets the
+## totals and the changed customers each poll (gauges keep their value).
+
+import time
+import socket
+import logging
+import threading
+import BaseHTTPServer
+from itertools import izip
+from collections import namedtuple
+
+import requests
+
+import es_cat
+import es_client
+import es_aggregate
+
+## _cat/indices columns, as in the one-shot report.
+catColumns = ('index', 'pri', 'docs.count', 'docs.deleted', 'store.size')
+catTypes = dict((column, 'int') for column in catColumns[1:])
+
+## Totals record layout.
+T_IDX, T_SHARDS, T_DOCS, T_SIZE, T_ORPHANS = range(5)
+
+## Per-customer gauges: (prometheus name, help, value from a customerRows row)
+customerGauges = (
+  ('es_customer_indices', 'Indexes per customer.', lambda row: row[1]),
+  ('es_customer_shards', 'Primary shards per customer.', lambda row: row[2]),
+  ('es_customer_docs', 'Documents per customer.', lambda row: row[3]),
+  ('es_customer_bytes', 'Store size per customer in bytes.', lambda row: row[4]),
+  ('es_customer_retention_days', 'Days between oldest and newest index.', lambda row: row[7]),
+)
+
+totalGauges = (
+  ('es_indices', 'Indexes in the cluster.', T_IDX),
+  ('es_shards', 'Primary shards in the cluster.', T_SHARDS),
+  ('es_docs', 'Documents in the cluster.', T_DOCS),
+  ('es_bytes', 'Data under management in bytes.', T_SIZE),
+  ('es_orphan_indices', 'Indexes not named customer-YYYY.MM.DD.', T_ORPHANS),
+)
+
+## indices: index -> (customer, date, shards, docs, size)
+## stats: es_aggregate customer records; dates: customer -> date -> count
+## exposition: customer -> cached gauge lines, in customerGauges order
+WatchModel = namedtuple('WatchModel', 'cluster indices stats dates totals exposition polls lock')
+
+
+def newModel(cluster):
+  return WatchModel(cluster, {}, {}, {}, [0, 0, 0, 0, 0], {},
+                    {'last': 0.0, 'took': 0.0, 'count': 0, 'changed': 0}, threading.Lock())
+
+
+def readIndices(esMaster, esPort, timeout = es_client.esTimeout):
+  """
+  returns dict of index -> (customer, date, shards, docs, size)
+  """
+  rows = {}
+  indices = es_cat.cat(esMaster, esPort, 'indices', catColumns, types=catTypes,
+                       where={'status': ('open',)}, timeout=timeout).data
+  for (name, shards, docs, deleted, size) in izip(indices['index'], indices['pri'], indices['docs.count'],
+                                                  indices['docs.deleted'], indices['store.size']):
+    (customer, idxDate) = es_aggregate.splitIndexName(name)
+    rows[name] = (customer, idxDate, shards, docs - deleted, size)
+  return rows
+
+
+def _fold(model, row, sign):
+  (customer, idxDate, shards, docs, size) = row
+  totals = model.totals
+  totals[T_IDX] += sign
+  totals[T_SHARDS] += sign * shards
+  totals[T_DOCS] += sign * docs
+  totals[T_SIZE] += sign * size
+  if idxDate == es_aggregate.orphanDate:
+    totals[T_ORPHANS] += sign
+    return None
+  dates = model.dates.setdefault(customer, {})
+  if sign > 0:
+    dates[idxDate] = dates.get(idxDate, 0) + 1
+    es_aggregate.addIndex(model.stats, customer, idxDate, shards, docs, size)
+  else:
+    dates[idxDate] -= 1
+    if not dates[idxDate]:
+      del dates[idxDate]
+    if not dates:
+      del model.dates[customer]
+    es_aggregate.removeIndex(model.stats, customer, idxDate, shards, docs, size, dates)
+  return customer
+
+
+def applyIndices(model, rows):
+  """
+  Diff a new readIndices result against the model and fold in only
+  the differences.
+
+  returns set of customers whose record changed
+  """
+  changed = set()
+  with model.lock:
+    old = model.indices
+    for (name, row) in old.items():
+      new = rows.get(name)
+      if new == row:
+        continue
+      changed.add(_fold(model, row, -1))
+      if new is not None:
+        changed.add(_fold(model, new, 1))
+    for (name, row) in rows.items():
+      if name not in old:
+        changed.add(_fold(model, row, 1))
+    model.indices.clear()
+    model.indices.update(rows)
+    changed.discard(None)
+
+    for customer in changed:
+      if customer in model.stats:
+        model.exposition[customer] = _customerLines(model, customer)
+      else:
+        model.exposition.pop(customer, None)
+  return changed
+
+
+def _label(text):
+  return text.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _customerRow(model, customer):
+  return next(es_aggregate.customerRows({customer: model.stats[customer]}))
+
+
+def _customerLines(model, customer):
+  row = _customerRow(model, customer)
+  labels = '{cluster="%s",customer="%s"}' % (_label(model.cluster), _label(customer))
+  return tuple("%s%s %d" % (name, labels, value(row)) for (name, text, value) in customerGauges)
+
+
+def prometheusText(model):
+  """
+  The model in the Prometheus text exposition format.
+  """
+  labels = '{cluster="%s"}' % _label(model.cluster)
+  out = []
+  with model.lock:
+    for (name, text, field) in totalGauges:
+      out.append("# HELP %s %s\n# TYPE %s gauge\n%s%s %d" % (name, text, name, name, labels,
+                                                           model.totals[field]))
+    customers = sorted(model.exposition)
+    for (i, (name, text, value)) in enumerate(customerGauges):
+      out.append("# HELP %s %s\n# TYPE %s gauge" % (name, text, name))
+      out.extend(model.exposition[c][i] for c in customers)
+    polls = model.polls
+    out.append("# HELP es_report_last_poll_seconds Unix time of the last _cat/indices poll.\n"
+               "# TYPE es_report_last_poll_seconds gauge\nes_report_last_poll_seconds%s %.3f" %
+               (labels, polls['last']))
+    out.append("# HELP es_report_poll_duration_seconds Time the last poll took.\n"
+               "# TYPE es_report_poll_duration_seconds gauge\nes_report_poll_duration_seconds%s %.3f" %
+               (labels, polls['took']))
+  return "\n".join(out) + "\n"
+
+
+def _statsdName(text):
+  return "".join(c if c.isalnum() or c in '-_' else '_' for c in text)
+
+
+def statsdLines(model, changed, prefix = "es"):
+  """
+  statsd gauges for the totals and the changed customers.  Customers
+  that went away are set to 0.
+  """
+  base = "%s.%s" % (prefix, _statsdName(model.cluster))
+  with model.lock:
+    lines = ["%s.%s:%d|g" % (base, name[3:], model.totals[field]) for (name, text, field) in totalGauges]
+    for customer in sorted(changed):
+      row = _customerRow(model, customer) if customer in model.stats else None
+      for (name, text, value) in customerGauges:
+        lines.append("%s.customer.%s.%s:%d|g" % (base, _statsdName(customer), name[12:],
+                                                 value(row) if row else 0))
+  return lines
+
+
+def sendStatsd(address, lines, packetSize = 1400):
+  """
+  Send lines to a statsd host:port over UDP, packed into datagrams of
+  up to packetSize bytes.
+  """
+  (host, port) = address.rsplit(':', 1)
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    packet = ""
+    for line in lines:
+      if packet and len(packet) + len(line) + 1 > packetSize:
+        sock.sendto(packet, (host, int(port)))
+        packet = ""
+      packet = packet + "\n" + line if packet else line
+    if packet:
+      sock.sendto(packet, (host, int(port)))
+  except socket.error, e:
+    logging.warn("statsd send to %s failed: %s" % (address, e))
+  finally:
+    sock.close()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    body = prometheusText(self.server.model)
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug(format % args)
+
+
+def startMetricsServer(model, port):
+  server = BaseHTTPServer.HTTPServer(('', port), MetricsHandler)
+  server.model = model
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def watch(esMaster, esPort, cluster, interval = 60, promPort = None, statsd = None, polls = None):
+  """
+  Poll _cat/indices every 'interval' seconds and publish the metrics,
+  until interrupted or after 'polls' polls.
+  """
+  model = newModel(cluster)
+  if promPort:
+    startMetricsServer(model, promPort)
+    logging.info("Serving Prometheus metrics on :%d/metrics" % promPort)
+
+  while polls is None or model.polls['count'] < polls:
+    start = time.time()
+    try:
+      rows = readIndices(esMaster, esPort)
+    except requests.RequestException, e:
+      logging.error("Poll failed: %s" % e)
+    else:
+      changed = applyIndices(model, rows)
+      model.polls.update(last=time.time(), took=time.time() - start, changed=len(changed))
+      logging.info("Poll %d: %d indexes, %d customers changed in %.2fs" %
+                   (model.polls['count'] + 1, len(rows), len(changed), model.polls['took']))
+      if statsd:
+        sendStatsd(statsd, statsdLines(model, changed))
+    model.polls['count'] += 1
+    if polls is None or model.polls['count'] < polls:
+      time.sleep(max(0, start + interval - time.time()))
+  return model
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+## esctl.py - the bash_aliases as one quick command
+##
+## Subcommands match the aliases (esNodes -> nodes, esRelo -> relo, esBS
+## -> bs, esSCount -> scount, esTasks -> tasks, esCSet -> cset, esHealth
+## -> health/watch).
+##
+## Startup is kept short: only the standard library needed to parse the
+## arguments is imported up front, es_client (and with it requests) only
+## when something has to be fetched.  _cat answers are kept on disk for
+## --ttl seconds and shared between subcommands, so relo, bs and scount
+## run back to back read _cat/shards once; each _cat API is always asked
+## for the same columns so they can share the entry.
+##
+## watch polls _cat/health through the one pooled es_client session and
+## shows how shard counts are changing per minute rather than the raw
+## snapshot, with an estimate of when the unassigned count reaches zero.
+"""
+usage: esctl.py [-h] [-H HOST] [-P PORT] [-t TTL] [-f] [-v]
+                {nodes,health,relo,bs,scount,tasks,cset,watch} ...
+
+Quick ES cluster checks.
+
+positional arguments:
+  {nodes,health,relo,bs,scount,tasks,cset,watch}
+    nodes               Nodes with heap, load, role and master, by heap.
+    health              Cluster health.
+    relo                Relocating shards.
+    bs                  Unassigned shards.
+    scount              Shard copies per node.
+    tasks               Pending cluster task count.
+    cset                Cluster settings.
+    watch               Poll health and show rates of change.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -H HOST, --host HOST  An ES host in to query. (default $MASTER or
+                        localhost)
+  -P PORT, --port PORT  ES HTTP API Port (default: 9200)
+  -t TTL, --ttl TTL     Seconds cached _cat answers are reused. (default 30)
+  -f, --fresh           Ignore cached answers.
+  -v, --verbose         Increase verbosity.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+## Seconds a cached _cat answer is reused.
+defaultTtl = 30
+
+cacheDir = os.environ.get('ESCTL_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'esctl'))
+
+## The one column set each _cat API is fetched with.
+catColumns = {
+  'shards': ('index', 'shard', 'prirep', 'state', 'store', 'node'),
+  'nodes': ('host', 'heap.percent', 'load', 'node.role', 'master'),
+  'health': ('epoch', 'timestamp', 'cluster', 'status', 'node.total', 'node.data', 'shards',
+             'pri', 'relo', 'init', 'unassign', 'pending_tasks', 'active_shards_percent'),
+}
+
+## _cat/health field positions.
+H_STATUS, H_NODES, H_SHARDS, H_RELO, H_INIT, H_UNASSIGN, H_TASKS = 3, 4, 6, 8, 9, 10, 11
+
+
+def _cachePath(host, port, api):
+  return os.path.join(cacheDir, "%s_%s_%s" % (host.replace(os.sep, '_'), port, api))
+
+
+def cat(host, port, api, ttl = defaultTtl, verbose = False):
+  """
+  Lines of a _cat API in its catColumns, from the cache when younger
+  than ttl seconds.
+  """
+  path = _cachePath(host, port, api)
+  try:
+    age = time.time() - os.path.getmtime(path)
+  except OSError:
+    age = None
+  if age is not None and age < ttl:
+    if verbose:
+      sys.stderr.write("_cat/%s cached %.0fs ago\n" % (api, age))
+    with open(path, 'r') as handle:
+      return handle.read().splitlines()
+
+  import es_client
+  lines = list(es_client.cat(host, port, api, catColumns[api]))
+  try:
+    if not os.path.isdir(cacheDir):
+      os.makedirs(cacheDir, 0700)
+    tmpName = "%s.%d" % (path, os.getpid())
+    with open(tmpName, 'w') as handle:
+      handle.write("\n".join(lines) + "\n")
+    os.rename(tmpName, path)
+  except (OSError, IOError), e:
+    if verbose:
+      sys.stderr.write("Could not cache _cat/%s: %s\n" % (api, e))
+  return lines
+
+
+def shards(args, state = None):
+  rows = [line.split() for line in cat(args.host, args.port, 'shards', args.ttl, args.verbose)]
+  return [fields for fields in rows if len(fields) >= 4 and (state is None or fields[3] == state)]
+
+
+def cmdNodes(args):
+  rows = [line.split() for line in cat(args.host, args.port, 'nodes', args.ttl, args.verbose)]
+  for fields in sorted(rows, key=lambda f: int(f[1]) if len(f) > 1 and f[1].isdigit() else -1, reverse=True):
+    print " ".join(fields)
+
+
+def cmdHealth(args):
+  print " ".join(catColumns['health'])
+  for line in cat(args.host, args.port, 'health', args.ttl, args.verbose):
+    print line
+
+
+def cmdRelo(args):
+  for fields in shards(args, 'RELOCATING'):
+    print " ".join(fields)
+
+
+def cmdBadShards(args):
+  unassigned = shards(args, 'UNASSIGNED')
+  for fields in unassigned:
+    print " ".join(fields)
+  if args.explain and unassigned:
+    import es_triage
+    found = es_triage.unassignedShards(args.host, args.port)
+    print
+    es_triage.printTriage(found, es_triage.explainAll(args.host, args.port, found))
+
+
+def cmdShardCount(args):
+  counts = {}
+  for fields in shards(args):
+    ## Started and relocating rows have every cell; initializing ones
+    ## have no store, unassigned ones no store or node and count under
+    ## UNASSIGNED.
+    node = fields[5] if len(fields) > 5 else fields[4] if len(fields) == 5 else fields[3]
+    counts[node] = counts.get(node, 0) + 1
+  for node in sorted(counts):
+    print "%7d %s" % (counts[node], node)
+
+
+def cmdTasks(args):
+  for line in cat(args.host, args.port, 'health', args.ttl, args.verbose):
+    fields = line.split()
+    if len(fields) > H_TASKS:
+      print fields[H_TASKS]
+
+
+def cmdSettings(args):
+  import es_client
+  sys.stdout.write(es_client.get(args.host, args.port, '_cluster/settings', params={'pretty': 'true'}).text)
+
+
+def _rate(now, last, field, elapsed):
+  return (int(now[field]) - int(last[field])) * 60.0 / elapsed
+
+
+def cmdWatch(args):
+  import es_client
+  print "%8s\t%6s\t%5s\t%8s\t%6s\t%6s\t%8s\t%5s\t%9s\t%9s\t%9s\t%s" % (
+    "time", "status", "nodes", "shards", "relo", "init", "unassign", "tasks",
+    "relo/min", "init/min", "unasn/min", "unassigned in")
+  last = None
+  polls = 0
+  while args.count is None or polls < args.count:
+    start = time.time()
+    try:
+      line = next(iter(es_client.cat(args.host, args.port, 'health', catColumns['health'])), None)
+    except IOError, e:
+      print "%8s\tpoll failed: %s" % (time.strftime('%H:%M:%S'), e)
+      line = None
+    else:
+      if line is None:
+        print "%8s\tpoll failed: empty answer" % time.strftime('%H:%M:%S')
+    fields = line.split() if line else None
+    if fields and len(fields) > H_TASKS:
+      rates = ("", "", "")
+      eta = ""
+      if last:
+        elapsed = max(start - last[0], 0.001)
+        rates = tuple("%+9.1f" % _rate(fields, last[1], f, elapsed) for f in (H_RELO, H_INIT, H_UNASSIGN))
+        fall = -_rate(fields, last[1], H_UNASSIGN, elapsed)
+        if int(fields[H_UNASSIGN]) and fall > 0:
+          eta = "%.0f min" % (int(fields[H_UNASSIGN]) / fall)
+      print "%8s\t%6s\t%5s\t%8s\t%6s\t%6s\t%8s\t%5s\t%9s\t%9s\t%9s\t%s" % (
+        time.strftime('%H:%M:%S'), fields[H_STATUS], fields[H_NODES], fields[H_SHARDS], fields[H_RELO],
+        fields[H_INIT], fields[H_UNASSIGN], fields[H_TASKS], rates[0], rates[1], rates[2], eta)
+      sys.stdout.flush()
+      last = (start, fields)
+    polls += 1
+    if args.count is None or polls < args.count:
+      time.sleep(max(0, start + args.interval - time.time()))
+
+
+###############################################
+## Argument parsing...
+parser = argparse.ArgumentParser(description='Quick ES cluster checks.')
+parser.add_argument("-H", "--host", default=os.environ.get('MASTER', 'localhost'), help="An ES host in to query. (default $MASTER or localhost)")
+parser.add_argument("-P", "--port", default="9200", help="ES HTTP API Port (default: 9200)", type=int)
+parser.add_argument("-t", "--ttl", default=defaultTtl, type=float, help="Seconds cached _cat answers are reused. (default %d)" % defaultTtl)
+parser.add_argument("-f", "--fresh", action='store_true', help="Ignore cached answers.")
+parser.add_argument("-v", "--verbose", action='store_true', help="Increase verbosity.")
+commands = parser.add_subparsers()
+commands.add_parser('nodes', help="Nodes with heap, load, role and master, by heap.").set_defaults(func=cmdNodes)
+commands.add_parser('health', help="Cluster health.").set_defaults(func=cmdHealth)
+commands.add_parser('relo', help="Relocating shards.").set_defaults(func=cmdRelo)
+command = commands.add_parser('bs', help="Unassigned shards.")
+command.add_argument("-e", "--explain", action='store_true', help="Also explain them, grouped by cause (see es_triage.py).")
+command.set_defaults(func=cmdBadShards)
+commands.add_parser('scount', help="Shard copies per node.").set_defaults(func=cmdShardCount)
+commands.add_parser('tasks', help="Pending cluster task count.").set_defaults(func=cmdTasks)
+commands.add_parser('cset', help="Cluster settings.").set_defaults(func=cmdSettings)
+command = commands.add_parser('watch', help="Poll health and show rates of change.")
+command.add_argument("-i", "--interval", default=30, type=float, help="Seconds between polls. (default 30)")
+command.add_argument("-n", "--count", default=None, type=int, help="Stop after this many polls.")
+command.set_defaults(func=cmdWatch)
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  if args.fresh:
+    args.ttl = 0
+  try:
+    args.func(args)
+  except KeyboardInterrupt:
+    pass
+  except IOError, e:
+    ## requests errors are IOErrors too; a closed stdout (head) is not an error
+    if e.errno != 32:
+      sys.stderr.write("esctl: %s\n" % e)
+      exit(1)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+## move-all-shards.py - move all shards off a node, as fast as the cluster
+##   can safely take it, in preparation for decommissioning a host.
+##
+## Destinations are chosen by the shared planner: each shard goes to the
+## node with the fewest shards that does not already hold a shard of that
+## index (same zone first, never into a zone holding another copy).  The
+## moves are ordered by es_schedule to finish the drain soonest given
+## shard sizes and the cluster's recovery limits, the projected timeline
+## is shown, and es_mover then runs them, adapting the number of
+## relocations in flight to recovery throughput and node heap and
+## checkpointing its progress so an interrupted drain can be resumed
+## with -r.
+"""
+usage: move-all-shards.py [-h] [-H HOST] [-P PORT] [-t TO] [-k CHECKPOINT]
+                          [-r] [-n] [-y] [-v]
+                          node
+
+Move all shards off a node.
+
+positional arguments:
+  node                  Node to drain.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -H HOST, --host HOST  An ES host in to query.
+  -P PORT, --port PORT  ES HTTP API Port (default: 9200)
+  -t TO, --to TO        Comma separated nodes allowed as destinations
+                        (default all other data nodes).
+  -k CHECKPOINT, --checkpoint CHECKPOINT
+                        Checkpoint file (default /tmp/drain-NODE.json).
+  -r, --resume          Resume from the checkpoint instead of planning again.
+  -n, --dry-run         Show the plan, do not move anything.
+  -y, --yes             Do not ask for confirmation.
+  -v, --verbose         Increase verbosity.
+"""
+
+import sys
+import argparse
+import logging
+
+import es_collect
+import es_mover
+import es_planner
+import es_schedule
+
+
+def planDrain(esMaster, esPort, source, allowed = None):
+  """
+  Plan moves for every STARTED shard on source.
+
+  returns list of es_mover moves
+  """
+  (totalDocs, rows) = es_collect.getShardData(esMaster, esPort)
+  (zones, loads) = es_collect.getNodeData(esMaster, esPort)
+
+  usage = dict((node, [0, 0, 0, 0]) for node in loads)
+  shards = dict((node, []) for node in loads)
+  for (node, index, shard, activity, docs, size) in rows:
+    if node not in usage:
+      continue
+    usage[node][0] += 1
+    ## Activity of 1 per shard: the planner then balances shard counts.
+    shards[node].append([index, shard, 1, size])
+
+  if source not in usage:
+    logging.error("%s is not a data node." % source)
+    sys.exit(1)
+
+  exclude = ()
+  if allowed:
+    exclude = [node for node in usage if node not in allowed]
+  model = es_planner.buildModel(usage, shards, exclude, zones)
+  (moves, stuck) = es_planner.planDrain(model, source)
+  for (index, node) in stuck:
+    logging.warn("Could not find node to move %s from %s" % (index, node))
+
+  sizes = dict(((e[0], e[1]), e[3]) for e in shards[source])
+  return [es_mover.newMove(m.index, m.shard, m.source, m.destination, sizes.get((m.index, m.shard), 0))
+          for m in moves]
+
+
+###############################################
+## Argument parsing...
+parser = argparse.ArgumentParser(description='Move all shards off a node.')
+parser.add_argument("node", help="Node to drain.")
+parser.add_argument("-H", "--host", default="localhost",
+                    help="An ES host in to query.")
+parser.add_argument("-P", "--port", default="9200", type=int,
+                    help="ES HTTP API Port (default: 9200)")
+parser.add_argument("-t", "--to", default="",
+                    help="Comma separated nodes allowed as destinations (default all other data nodes).")
+parser.add_argument("-k", "--checkpoint", default=None,
+                    help="Checkpoint file (default /tmp/drain-NODE.json).")
+parser.add_argument("-r", "--resume", default=False, action='store_true',
+                    help="Resume from the checkpoint instead of planning again.")
+parser.add_argument("-n", "--dry-run", default=False, action='store_true',
+                    help="Show the plan, do not move anything.")
+parser.add_argument("-y", "--yes", default=False, action='store_true',
+                    help="Do not ask for confirmation.")
+parser.add_argument("-v", "--verbose", action='store_true',
+                    help="Increase verbosity.")
+
+args = parser.parse_args()
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG if args.verbose else logging.INFO,
+                   format='%(asctime)s [%(levelname)s] %(message)s'
+                   )
+
+esHost = args.host
+esPort = args.port
+checkpoint = args.checkpoint or "/tmp/drain-%s.json" % args.node
+
+plan = None
+if args.resume:
+  plan = es_mover.loadCheckpoint(checkpoint)
+  if plan is None:
+    logging.error("No checkpoint %s to resume." % checkpoint)
+    sys.exit(1)
+  logging.info("Resuming %d moves from %s." % (len(plan), checkpoint))
+else:
+  logging.info("Fetching current shard list for %s." % args.node)
+  plan = planDrain(esHost, esPort, args.node, args.to.split(',') if args.to else None)
+
+## Order the moves for the shortest drain and show the projected timeline.
+(rate, incoming, outgoing) = es_schedule.recoverySettings(esHost, esPort)
+(timeline, makespan, bound) = es_schedule.scheduleMoves([m for m in plan if m['status'] == 'pending'],
+                                                        rate, incoming, outgoing)
+es_schedule.orderPlan(plan, timeline)
+es_schedule.logTimeline(timeline, makespan, bound, rate, incoming, outgoing)
+
+if args.dry_run:
+  sys.exit(0)
+
+if not args.yes:
+  print "About to move %d shards from %s.  Make sure you've stopped ES rebalancing." % (len(plan), args.node)
+  answer = raw_input("Are you ready to continue? [y/n] ")
+  if answer != "y":
+    print "Bailing out."
+    sys.exit(0)
+
+es_mover.executeMoves(esHost, esPort, plan, checkpoint)
@@ -4,11 +4,12 @@
 ##   how to rebalance the cluster by moving shards.
 ##
 ##   Should have option to limit by size.
-##   Should perform a shard swap so that shard counts across nodes
-##   remain the same.
 """
 usage: tellMeWhatToMove.py [-h] [-c CLUSTER] [-H HOST] [-P PORT] [-t TEMP]
-                           [-g] [-l LIMIT] [-v] [-m {load,dedup}]
+                           [-g] [-S SNAPSHOT] [-B BASE] [-n SAMPLES] [-i INTERVAL] [-Q] [-l LIMIT]
+                           [-x EXCLUDE] [-I INVENTORY] [-T] [-W WEIGHTS] [-e]
+                           [--profile PROFILE] [--cprofile CPROFILE] [-v]
+                           [-m {load,dedup,swap}]
 
 Generate a customer index report against ElasticSearch.
 
@@ -19,12 +20,41 @@ optional arguments:
   -H HOST, --host HOST  An ES host in to query.
   -P PORT, --port PORT  ES HTTP API Port (default: 9200)
   -t TEMP, --temp TEMP  Temp directory to write files.
-  -g, --nogather        Do not collect new shard data. Use existing files.
+  -g, --nogather        Do not collect new shard data. Use existing snapshot.
+  -S SNAPSHOT, --snapshot SNAPSHOT
+                        Snapshot to use with -g (name or prefix, default
+                        latest).
+  -B BASE, --base BASE  With -g, shard activity is measured since this
+                        snapshot.
+  -n SAMPLES, --samples SAMPLES
+                        Number of indexing stats samples for shard activity.
+                        (default 3)
+  -i INTERVAL, --interval INTERVAL
+                        Seconds between indexing stats samples. (default 10)
+  -Q, --quick           Quick activity estimate from 2 samples (one interval).
   -l LIMIT, --limit LIMIT
                         Max number of moves to suggest. (default 5. 0 means no
                         moves)
+  -x EXCLUDE, --exclude EXCLUDE
+                        Comma separated nodes never to move shards to.
+  -I INVENTORY, --inventory INVENTORY
+                        Cluster inventory file (name host[:port] [timeout]
+                        per line); collect from all clusters at once and
+                        suggest moves for each.
+  -T, --heat            Rank nodes by heat from _nodes/stats (thread pool
+                        queues and rejections, heap, GC, merge and refresh
+                        time, disk I/O) instead of load average.
+  -W WEIGHTS, --weights WEIGHTS
+                        With -T, heat weights as metric=weight,...
+  -e, --execute         Submit the suggested moves, throttled by the move
+                        executor.
+  --profile PROFILE     Write per phase wall and cpu time, ES wait, requests,
+                        bytes, rows and peak rss as JSON to this file ('-'
+                        for stderr).
+  --cprofile CPROFILE   With --profile, comma separated phases (or 'all') to
+                        run under cProfile, dumped to PROFILE.<phase>.prof.
   -v, --verbose         Increase verbosity.
-  -m {load,dedup}, --method {load,dedup}
+  -m {load,dedup,swap}, --method {load,dedup,swap}
                         Select move determination method.
 
 Examples:
@@ -35,6 +65,34 @@ tellMeWhatToMove.py
 tellMeWhatToMove.py -g
   same as above, but do not collect new activity data.  
 
+tellMeWhatToMove.py -n 7 -i 10
+  estimate shard activity from 7 indexing stats samples over a minute for
+  tighter rate bounds.  -Q takes a single 10 second interval instead.
+
+tellMeWhatToMove.py -m swap -l 10
+  suggest up to 5 swaps: a hot shard on the busiest node traded for a
+  cold shard of similar size on a cool node, both moves in one reroute,
+  so shard counts per node do not change.
+
+tellMeWhatToMove.py -g -S 20160515T012002 -B 20160515T002002
+  use an older snapshot, with shard activity measured over the hour since
+  an even older one.  Snapshots are kept in TEMP/tmwtm-UID.snap.
+
+tellMeWhatToMove.py -I clusters.txt -Q
+  collect from every cluster listed in clusters.txt at the same time,
+  suggest moves for each, then rank all clusters and their hottest nodes.
+  A cluster that is down or slower than its timeout is listed as
+  unreachable and does not hold up the others.
+
+tellMeWhatToMove.py -T -W gc=0,merge=0
+  rank nodes by heat instead of load average, ignoring GC and merge time
+  altogether, so a node that is only busy with a long GC or a merge storm
+  is not drained.  Heat is stored in the snapshot in place of the load.
+
+tellMeWhatToMove.py -Q --profile /tmp/tmwtm.json --cprofile plan
+  time each phase (collect, snapshot, activity, plan, ...) and show how much
+  of it was spent waiting on ES, with a cProfile dump of the planning.
+
 tellMeWhatToMove.py -g -l 0
   only collect node load and current list of shards.  Do no move calculations.
   display node utilization information like:
@@ -55,167 +113,109 @@ tellMeWhatToMove.py -g -l 0
 2016-05-15 01:20:22,846 [INFO] ##### Totals:        5162226006 [ 37149] (14335.38 gb) 
 """
 
-import re
 import os
 import sys
-import time
-import requests
+import atexit
 import argparse
+import es_client
+import es_collect
+import es_rate
+import es_snapshot
+import es_planner
+import es_mover
+import es_schedule
+import es_inventory
+import es_heat
+import es_profile
 import logging
-from collections import namedtuple
-from operator import attrgetter, itemgetter, methodcaller
-from datetime import datetime
 
 
-def getShardDataDisk (esMaster, esPort, firstPass, fileName):
-  """
-  Gathers shard data from ES.  If firstPass is a dict-array, then this
-  is the 2nd pass to determine doc-writes/minute for each shard.  Otherwise
-  shard activity is 0
-
-  returns total number of documents in ES
-  """
-  totalDocs = 0
-  with open(fileName, 'w') as handle:
-      req = requests.get('http://%s:%s/_cat/shards?bytes=b' % (esMaster, esPort), stream=True)
-      for esShards in req.iter_lines():
-          if re.search('STARTED', esShards):
-              fields = esShards.split()
-              totalDocs += int(fields[4])
-              shardId = fields[0] + "." + fields[1] + "." + fields[7]
-              ## File Format is:
-              ## node index shard# shard-activity totalDocsInShard sizeOfShardBytes
-              if type(firstPass) is int:
-                handle.write("%s %s %s %d %d %d\n" % 
-                             (fields[7], fields[0], fields[1], 0, int(fields[4]), int(fields[5])))
-              elif shardId in firstPass:
-                handle.write("%s %s %s %d %d %d\n" % 
-                             (fields[7], fields[0], fields[1], 
-                              int(fields[4]) - int(firstPass[shardId][0]), int(fields[4]), int(fields[5])))
-
-  handle.close()
-  return totalDocs
-
-
-def getShardDataMem (esMaster, esPort):
-  """
-  Query ES for shard data on all ACTIVE shards.
-  Store and return dict of results.
-
-  returns shards dict
-  """
-  shards = dict()
-  req = requests.get('http://%s:%s/_cat/shards?bytes=b' % (esMaster, esPort), stream=True)
-  for esShards in req.iter_lines():
-      if re.search('STARTED', esShards):
-          fields = esShards.split()
-          shardId = fields[0] + "." + fields[1] + "." + fields[7]
-          shards[shardId] = (fields[4], fields[5])
-          
-  return shards
-
-
-def totalDocsFromDisk (fileName):
+def collectData (esMaster, esPort, samples = 0, interval = 10, timeout = es_client.esTimeout,
+                 heat = None, heatCache = None):
   """
-  Get count of total docs from existing shard data file.
+  Collection phase.  The shard, node and indexing stats requests run
+  concurrently.  With 2 or more samples, shard activity is the estimated
+  doc-writes/minute of each shard from the _stats indexing counters.
+  With heat (a weights dict) node loads are es_heat scores instead of
+  the load average.
+
+  returns total # of docs in ES, shard rows, node zones, node loads,
+          node rates, last indexing counters
   """
-  totalDocs = 0
-  with open(fileName, 'r') as sHandle:
-    for shards in sHandle.readlines():
-      fields = shards.split()
-      totalDocs += int(fields[4])
-  sHandle.close()
-  return totalDocs
-
-def collectShardActivity (esMaster, esPort, tmpDir):
+  calls = {
+    'shards': (es_collect.getShardData, (esMaster, esPort, timeout)),
+    'nodes': (es_collect.getNodeData, (esMaster, esPort, timeout)),
+  }
+  if samples >= 2:
+    logging.info("Collecting shard data and %d indexing samples %ds apart." % (samples, interval))
+    calls['samples'] = (es_rate.collectSamples, (esMaster, esPort, samples, interval, timeout))
+  else:
+    logging.info("Collecting shard data.")
+  if heat is not None:
+    calls['heat'] = (es_heat.collectHeat, (esMaster, esPort, interval, heatCache, timeout))
+
+  results = es_client.gather(calls)
+  (totalDocs, rows) = results['shards']
+  (zones, loads) = results['nodes']
+  if heat is not None:
+    scores = es_heat.heatScores(results['heat'], heat)
+    es_heat.logHeat(results['heat'], scores)
+    loads = dict((node, scores.get(node, 0.0)) for node in loads)
+  samples = results.get('samples', [])
+  rates = es_rate.estimateRates(samples)
+  for row in rows:
+    rate = rates.get((row[1], row[2], row[0]))
+    if rate:
+      row[3] = int(round(rate[es_rate.RATE] * 60))
+  counters = samples[-1][1] if samples else {}
+  return totalDocs, rows, zones, loads, es_rate.nodeRates(rates), counters
+
+
+def logNodeRates (nodeRates):
   """
-  Performs a 2 pass request against ES for shard data.
-  The second pass is 1 minute after the first in order to
-  determine doc-writes/minute per shard.
-
-  returns total # of docs in ES
+  Show the estimated indexing rate of each node with its 95% bounds.
   """
-  totalDocs = 0
-
-  logging.info("Collecting first set of shard data into memory.")
-  shards = getShardDataMem(esMaster, esPort)
-  ## Waiting a minute to be able to get docs/minute count.
-  logging.info("Sleeping for a minute... try and relax.")  
-  time.sleep(60)
+  logging.info("Node          docs/s  [    low -    high]  index ms/s")
+  for node in sorted(nodeRates, key=lambda n: nodeRates[n][es_rate.RATE], reverse=True):
+    rec = nodeRates[node]
+    logging.info("%s %9.1f  [%8.1f - %8.1f]  %9.1f" % (node, rec[es_rate.RATE], rec[es_rate.LOW],
+                                                       rec[es_rate.HIGH], rec[es_rate.BUSY]))
 
-  logging.info("Collecting second set of shard data into %s." % tmpDir + ".1")
 
-  ## Write second pass
-  return getShardDataDisk(esMaster, esPort, shards, tmpDir + ".1")
-
-
-def collectNodeData (esMaster, esPort, tmpDir):
-  """
-  Get the load for each datanode in the ES cluster.
-  returns nothing
-  """
-  nodeF1 = tmpDir + ".5"
-  nodeF2 = tmpDir + ".6"
-
-  logging.info("Retrieving data node load average")
-  with open(nodeF1, 'w') as handle1:
-      with open(nodeF2, 'w') as handle2:
-          req = requests.get('http://%s:%s/_cat/nodes?h=name,load,node,node.role' % 
-                             (esMaster, esPort), stream=True)
-          for esNodes in req.iter_lines():
-              fields = esNodes.split()
-              if (len(fields) >= 3) and (fields[2] == 'd'):
-                  zone = fields[0].split('-')
-                  handle1.write("ZONE %s %s\n" % (fields[0], zone[2][-1:]))
-                  handle2.write("LOADAVE %s %s\n" % (fields[0], fields[1]))
-  handle1.close()
-  handle2.close()
-
-def calcShardActivity(tmpDir, totDocs = 1):
+def calcShardActivity(nodeLoad, shardRows, nodeZone = None):
   """
   Show based on system load, the amount of docs and space
-  that a node occupies within the ES cluster.
+  that a node occupies within the ES cluster, and the same per zone.
 
-  nodeUsage - dict of nodes w/ array of counts [docs, disk bytes, shards]
+  nodeUsage - dict of nodes w/ array of counts [load, docs, disk bytes, shards]
   nodeShards - dict of nodes w/ array of shard information
   returns nodeUsage and nodeShards 
   """
-  shD1 = tmpDir + ".1"
-  
-  nLoad = tmpDir + ".6"
-  nZone = tmpDir + ".5"
-
   nodeUsage = {}
   nodeShards = {}
 
-  with open(nLoad, 'r') as nHandle:
-    for nodes in nHandle.readlines():
-      fields = nodes.split()
-      ## Fields: documents, disk, shards
-      nodeUsage[fields[1]] = [ float(fields[2]), 0, 0, 0 ]
-  nHandle.close()
+  for node in nodeLoad:
+    ## Fields: load, documents, disk, shards
+    nodeUsage[node] = [ nodeLoad[node], 0, 0, 0 ]
 
   totDocs = 0
   totDisk = 0
   totShards = 0
-  with open(shD1, 'r') as sHandle:
-    for shards in sHandle.readlines():
-      fields = shards.split()
+  for (node, index, shard, activity, docs, size) in shardRows:
       ## Add to document count for node
-      nodeUsage[fields[0]][1] += int(fields[4])
-      totDocs += int(fields[4])
+      nodeUsage[node][1] += docs
+      totDocs += docs
       ## diskspace used
-      nodeUsage[fields[0]][2] += int(fields[5])
-      totDisk += int(fields[5])
+      nodeUsage[node][2] += size
+      totDisk += size
       ## shard count
-      nodeUsage[fields[0]][3] += 1
+      nodeUsage[node][3] += 1
       totShards += 1
 
-      if fields[0] in nodeShards:
-          nodeShards[fields[0]].append([fields[1], fields[2], fields[3], fields[5]])
+      if node in nodeShards:
+          nodeShards[node].append([index, shard, activity, size])
       else:
-          nodeShards[fields[0]] = [[fields[1], fields[2], fields[3], fields[5]]]
-  sHandle.close()
+          nodeShards[node] = [[index, shard, activity, size]]
   
   logging.info("Node            Load       Docs [shards]       (space): Percent [shards] ( space)")
   for node in nodeUsage.iterkeys():
@@ -229,100 +229,94 @@ def calcShardActivity(tmpDir, totDocs = 1):
 
                                                                                   
   logging.info("##### Totals:       %11d [%6d] (%2.2f gb)" % (int(totDocs), int(totShards), float(totDisk) / 1073741824.00))
+
+  if nodeZone:
+    zoneUsage = {}
+    for node in nodeUsage:
+      zone = zoneUsage.setdefault(nodeZone.get(node, '?'), [0.0, 0, 0, 0])
+      for i in range(4):
+        zone[i] += nodeUsage[node][i]
+    logging.info("Zone            Load       Docs [shards]       (space): Percent [shards] ( space)")
+    for zone in sorted(zoneUsage):
+      logging.info("%-4s   %6.2f %10d [%6d]  (%7.2f gb):  %5.2f%% [%5.2f%%] (%5.2f%%)" % (zone, zoneUsage[zone][0],
+                                                                                     zoneUsage[zone][1],
+                                                                                     zoneUsage[zone][3],
+                                                                                     float(zoneUsage[zone][2]) / 1073741824.00,
+                                                                                     float(zoneUsage[zone][1] * 100) / float(max(totDocs, 1)),
+                                                                                     float(zoneUsage[zone][3] * 100) / float(max(totShards, 1)),
+                                                                                     float(zoneUsage[zone][2] * 100) / float(max(totDisk, 1))))
   return nodeUsage, nodeShards
 
-def shardsToMoveLoad(usage, shards, limit = 10):
+def shardsToMoveLoad(esMaster, esPort, usage, shards, limit = 10, exclude = (), zones = None):
   """
   Figure out which shards to move from what node to another node.
   Source node is the one with the highest load.
   Destination node is the one with the lowest load.
-  Shard to move is based on change in # of docs over one minute.
-  Will not move a shard to a node that already has a shard of that index.
+  Shard to move is based on its indexing activity.
+  Will not move a shard to a node that already has a shard of that index,
+  to a node in exclude, or into a zone holding another copy of the shard;
+  nodes in the source's zone are preferred.  Each move is applied to the
+  planner's model before the next is chosen.  The move commands shown
+  point at esMaster:esPort.
+
+  returns list of move groups (one move each)
   """
-  hotNode = ''
-  curLoad = 0.0
-  for node in usage:
-      if usage[node][0] > curLoad:
-          hotNode = node
-          curLoad = usage[node][0]
-  ## Find 'limit' # of shards that should be moved.
-  curCount = 0
-  usageHiLo = sorted(usage.items(), key=itemgetter(1), reverse=True)
-  usageLoHi = sorted(usage.items(), key=itemgetter(1))
-
-  for (node, values) in usageHiLo:
-    if curCount >= limit:
-      break
-
-    for a in sorted(shards[node], key=itemgetter(2), reverse=True):
-      if curCount >= limit:
-        break
-      curCount = curCount + 1
-
-      sNode = findIdx(a[0], usageLoHi, shards, 1)
-      if sNode:
-        logging.info("Move index %s, shard %s from %s to %s" % (a[0], a[1], node, sNode))
-        writeShardMove(a[0], a[1], node, sNode, esHost, esPort)
-      else:
-        logging.warn("Could not find node to move %s from %s" % (a[0], node))
+  model = es_planner.buildModel(usage, shards, exclude, zones)
+  (moves, stuck) = es_planner.planLoadMoves(model, limit)
+
+  for (index, node) in stuck:
+    logging.warn("Could not find node to move %s from %s" % (index, node))
+  for move in moves:
+    logging.info("Move index %s, shard %s from %s to %s" % move)
+    writeShardMove(move.index, move.shard, move.source, move.destination, esMaster, esPort)
+  return [[move] for move in moves]
 
 
-def findIdx (index, nodes, shards, limit = 1):
+def shardsToMoveSwap(esMaster, esPort, usage, shards, limit = 10, exclude = (), zones = None):
   """
-  Find a node where the number of shards for an index is
-  below the limit of shards allowed per node.
+  Trade a hot shard on the busiest node for a cold shard of similar size
+  on a cooler node.  Both moves go in one reroute so shard counts and
+  disk use per node stay level while indexing load evens out.
 
-  returns the first node that qualifies or False if no nodes can be found
+  returns list of move groups (the two moves of each swap)
   """
-  for (sNode, sValues) in nodes:
-    onHost = 0
-    if sNode != "es2a":
-      for sIdx in shards[sNode]:
-        if index in sIdx:
-          onHost += 1
-          if onHost >= limit:
-            break
-          
-      if onHost < limit:
-        return sNode
-      
-  return False
-
-def shardsToMoveDeDup(usage, shards, limit = 1):
+  model = es_planner.buildModel(usage, shards, exclude, zones)
+  swaps = es_planner.planSwapMoves(model, limit)
+  if not swaps:
+    logging.warn("Could not find shards to swap.")
+
+  for pair in swaps:
+    for move in pair:
+      logging.info("Move index %s, shard %s from %s to %s" % move)
+    writeShardMoves(pair, esMaster, esPort)
+  return [list(pair) for pair in swaps]
+
+
+def shardsToMoveDeDup(esMaster, esPort, usage, shards, limit = 1, exclude = (), zones = None):
   """
   Get rid of duplicate indexes on hosts.
   limit is the max number of shards from an index that can be on a node.
+  Extra shards are moved to the coolest node that can take them, never
+  into a zone holding another copy of the shard, same zone first.
+
+  returns list of move groups (one move each)
   """
-  usageHiLo = sorted(usage.items(), key=itemgetter(1), reverse=True)
-  usageLoHi = sorted(usage.items(), key=itemgetter(1))
-  
-  for (node, loads) in usageHiLo:
+  model = es_planner.buildModel(usage, shards, exclude, zones)
+
+  for node in sorted(usage, key=lambda n: usage[n][0], reverse=True):
     ## Look for duplication of indexes
-    curCount = 1
-    curIdx = ""
-    for a in sorted(shards[node], key=itemgetter(0)):
-      if a[0] == curIdx:
-        curCount += 1
-      else:
-        if curCount > limit:
-          logging.warn("[%s] %d shards of index %s" % (node, curCount, curIdx))
-        curIdx = a[0]
-        curCount = 1
-
-## This would suggest the actual moves per shard...  
-## If this is really bad, then probably better to adjust ES settings
-## than do this manually.        
-#        sNode = findIdx(a[0], usageLoHi, shards, 2)
-#        if sNode:
-#          logging.info("Move index %s, shard %s from %s to %s" % (a[0], a[1], node, sNode))
-#          if sNode in shards:
-#            shards[sNode].append([a[0], a[1], 0, 0])
-#          else:
-#            shards[sNode] = [[a[0], a[1], 0, 0]]
-#          
-#          writeShardMove(a[0], a[1], node, sNode, esHost, esPort)
-#        else:
-#          logging.warn("Could not find node to move %s from %s" % (a[0], node))
+    for index in sorted(model.counts):
+      curCount = model.counts[index].get(node, 0)
+      if curCount > limit:
+        logging.warn("[%s] %d shards of index %s" % (node, curCount, index))
+
+  (moves, stuck) = es_planner.planDedupMoves(model, limit)
+  for (index, node) in stuck:
+    logging.warn("Could not find node to move %s from %s" % (index, node))
+  for move in moves:
+    logging.info("Move index %s, shard %s from %s to %s" % move)
+    writeShardMove(move.index, move.shard, move.source, move.destination, esMaster, esPort)
+  return [[move] for move in moves]
 
 
 def writeShardMove(index, shard, source, destination, master = "", port="9200"):
@@ -331,6 +325,34 @@ def writeShardMove(index, shard, source, destination, master = "", port="9200"):
 
   logging.info("Move Command:\n\tdate; curl -XPOST '%s:%s/_cluster/reroute' -d '{ \"commands\": [{ \"move\": { \"index\": \"%s\", \"shard\": \"%s\", \"from_node\": \"%s\", \"to_node\": \"%s\" }}]}' | cut -c1-160" % (master, port, index, shard, source, destination))
 
+def writeShardMoves(moves, master = "", port="9200"):
+  """
+  Show one reroute command carrying several moves.
+  """
+  if not master:
+    master = moves[0].destination
+
+  commands = ", ".join("{ \"move\": { \"index\": \"%s\", \"shard\": \"%s\", \"from_node\": \"%s\", \"to_node\": \"%s\" }}" % move
+                       for move in moves)
+  logging.info("Move Command:\n\tdate; curl -XPOST '%s:%s/_cluster/reroute' -d '{ \"commands\": [%s]}' | cut -c1-160" % (master, port, commands))
+
+
+def suggestMoves(esMaster, esPort, usage, shards, method, limit, exclude = (), zones = None):
+  """
+  Run the chosen move determination method for the cluster at
+  esMaster:esPort.
+
+  returns list of move groups
+  """
+  if method == "dedup":
+    return shardsToMoveDeDup(esMaster, esPort, usage, shards, limit, exclude, zones)
+  elif method == "swap":
+    logging.info("Determining which shards to swap.")
+    return shardsToMoveSwap(esMaster, esPort, usage, shards, limit, exclude, zones)
+  logging.info("Determining which shards to move.")
+  return shardsToMoveLoad(esMaster, esPort, usage, shards, limit, exclude, zones)
+
+
 ###############################################
 ## Argument parsing...
 parser = argparse.ArgumentParser(description='Generate a customer index report against ElasticSearch.')
@@ -343,12 +365,36 @@ parser.add_argument("-P", "--port", default="9200", type=int,
 parser.add_argument("-t", "--temp", default="/tmp", 
                     help="Temp directory to write files.")
 parser.add_argument("-g", "--nogather", default=False, action='store_true', 
-                    help="Do not collect new shard data.  Use existing files.")
+                    help="Do not collect new shard data.  Use existing snapshot.")
+parser.add_argument("-S", "--snapshot", default=None,
+                    help="Snapshot to use with -g (name or prefix, default latest).")
+parser.add_argument("-B", "--base", default=None,
+                    help="With -g, shard activity is measured since this snapshot.")
+parser.add_argument("-n", "--samples", default=3, type=int,
+                    help="Number of indexing stats samples for shard activity. (default 3)")
+parser.add_argument("-i", "--interval", default=10, type=int,
+                    help="Seconds between indexing stats samples. (default 10)")
+parser.add_argument("-Q", "--quick", default=False, action='store_true',
+                    help="Quick activity estimate from 2 samples (one interval).")
 parser.add_argument("-l", "--limit", default=5, type=int,
                     help="Max number of moves to suggest. (default 5. 0 means no moves)")
+parser.add_argument("-x", "--exclude", default="",
+                    help="Comma separated nodes never to move shards to.")
+parser.add_argument("-I", "--inventory", default=None,
+                    help="Cluster inventory file (name host[:port] [timeout] per line); collect from all clusters at once and suggest moves for each.")
+parser.add_argument("-T", "--heat", default=False, action='store_true',
+                    help="Rank nodes by heat from _nodes/stats (thread pool queues and rejections, heap, GC, merge and refresh time, disk I/O) instead of load average.")
+parser.add_argument("-W", "--weights", default="",
+                    help="With -T, heat weights as metric=weight,...")
+parser.add_argument("-e", "--execute", default=False, action='store_true',
+                    help="Submit the suggested moves, throttled by the move executor.")
+parser.add_argument("--profile", default=None,
+                    help="Write per phase wall and cpu time, ES wait, requests, bytes, rows and peak rss as JSON to this file ('-' for stderr).")
+parser.add_argument("--cprofile", default="",
+                    help="With --profile, comma separated phases (or 'all') to run under cProfile, dumped to PROFILE.<phase>.prof.")
 parser.add_argument("-v", "--verbose", action='store_true', 
                     help="Increase verbosity.")
-parser.add_argument("-m", "--method", default="load", choices=['load','dedup'],
+parser.add_argument("-m", "--method", default="load", choices=['load','dedup','swap'],
                     help="Select move determination method.")
 
 args = parser.parse_args()
@@ -365,26 +411,130 @@ esPort = args.port
 tempDir = args.temp
 clusterName = args.cluster
 
-fnamePre = tempDir + "/tmwtm-" + str(os.geteuid())
+snapDir = tempDir + "/tmwtm-" + str(os.geteuid()) + ".snap"
+
+profile = es_profile.Profile('tellMeWhatToMove', bool(args.profile), [p for p in args.cprofile.split(',') if p])
+if args.profile:
+  atexit.register(profile.write, args.profile)
+
+heat = None
+if args.heat:
+  try:
+    heat = es_heat.parseWeights(args.weights)
+  except ValueError, e:
+    logging.error("Bad -W: %s" % e)
+    sys.exit(1)
+
+if args.inventory:
+  if args.nogather or args.execute:
+    logging.error("-g and -e work on a single cluster, not with -I.")
+    sys.exit(1)
+  samples = 2 if args.quick else args.samples
+  exclude = args.exclude.split(',') if args.exclude else ()
+
+  def collectCluster(cluster):
+    return collectData(cluster.host, cluster.port, samples, args.interval,
+                       es_inventory.httpTimeout(cluster), heat, snapDir + "/" + cluster.name + ".nodestats")
+
+  clusters = es_inventory.readInventory(args.inventory)
+  logging.info("Collecting from %d clusters." % len(clusters))
+  summary = []
+  hottest = []
+  with profile.phase('collect'):
+    collected = es_inventory.fanOut(clusters, collectCluster)
+    profile.count(sum(len(data[1]) for (cluster, data, error) in collected if data))
+  for (cluster, data, error) in collected:
+    if error:
+      summary.append((cluster.name, None, error))
+      continue
+    (totShards, shardRows, nodeZone, nodeLoad, nodeRates, counters) = data
+    logging.info("##### Cluster %s (%s:%d)" % (cluster.name, cluster.host, cluster.port))
+    with profile.phase('snapshot'):
+      snapPath = es_snapshot.writeSnapshot(snapDir + "/" + cluster.name, shardRows, nodeZone, nodeLoad, counters)
+      es_snapshot.pruneSnapshots(snapDir + "/" + cluster.name)
+    with profile.phase('activity'):
+      (usage, shards) = calcShardActivity(nodeLoad, shardRows, nodeZone)
+      profile.count(len(shardRows))
+    if args.limit > 0:
+      with profile.phase('plan'):
+        profile.count(len(suggestMoves(cluster.host, cluster.port, usage, shards, args.method, args.limit, exclude, nodeZone)))
+    summary.append((cluster.name, [sum(u[i] for u in usage.values()) for i in range(4)] + [len(usage)], None))
+    hottest.extend((usage[node][0], cluster.name, node) for node in usage)
+
+  logging.info("##### All clusters")
+  logging.info("Cluster              Nodes  Mean load        Docs [shards]       (space)")
+  for (name, totals, error) in summary:
+    if error:
+      logging.info("%-20s unreachable: %s" % (name, error))
+    else:
+      logging.info("%-20s %5d %10.2f %11d [%6d]  (%7.2f gb)" % (name, totals[4], totals[0] / max(totals[4], 1),
+                                                              totals[1], totals[3], totals[2] / 1073741824.00))
+  logging.info("Hottest nodes:")
+  for (load, name, node) in sorted(hottest, reverse=True)[:10]:
+    logging.info("  %6.2f  %s %s" % (load, name, node))
+  sys.exit(0)
 
 if args.nogather and args.limit > 0:
-  logging.info("Using exiting data collection files.")
-  totShards = totalDocsFromDisk(fnamePre + ".1")
-elif args.nogather and args.limit == 0:
-  logging.info("Skipping shard activity data collection.")
-  totShards = getShardDataDisk(esHost, esPort, 0, fnamePre + ".1")
-  collectNodeData(esHost, esPort, fnamePre)  
+  profile.switch('snapshot')
+  snapPath = es_snapshot.findSnapshot(snapDir, args.snapshot)
+  if not snapPath:
+    logging.error("No snapshot %s in %s" % (args.snapshot or "", snapDir))
+    sys.exit(1)
+  logging.info("Using existing snapshot %s." % snapPath)
+  snap = es_snapshot.readSnapshot(snapPath)
+  shardRows = es_snapshot.snapshotRows(snap)
+  totShards = sum(row[4] for row in shardRows)
+  (nodeZone, nodeLoad) = es_snapshot.snapshotNodes(snap)
+  if args.base:
+    basePath = es_snapshot.findSnapshot(snapDir, args.base)
+    if not basePath:
+      logging.error("No snapshot %s in %s" % (args.base, snapDir))
+      sys.exit(1)
+    logging.info("Shard activity since snapshot %s." % basePath)
+    rates = es_snapshot.snapshotRates(es_snapshot.readSnapshot(basePath), snap)
+    for row in shardRows:
+      row[3] = int(round(rates.get((row[1], row[2], row[0]), 0)))
 else:
-  totShards = collectShardActivity(esHost, esPort, fnamePre)
-  collectNodeData(esHost, esPort, fnamePre)
-
-(usage, shards) = calcShardActivity(fnamePre, totShards)
+  if args.nogather:
+    logging.info("Skipping shard activity data collection.")
+  samples = 0
+  if not args.nogather:
+    samples = args.samples
+    if args.quick:
+      samples = 2
+  profile.switch('collect')
+  (totShards, shardRows, nodeZone, nodeLoad, nodeRates, counters) = collectData(esHost, esPort, samples, args.interval,
+                                                                                heat=heat, heatCache=snapDir + ".nodestats")
+  profile.count(len(shardRows))
+  if nodeRates:
+    logNodeRates(nodeRates)
+  profile.switch('snapshot')
+  snapPath = es_snapshot.writeSnapshot(snapDir, shardRows, nodeZone, nodeLoad, counters)
+  es_snapshot.pruneSnapshots(snapDir)
+  logging.info("Saved snapshot %s." % snapPath)
+
+profile.switch('activity')
+(usage, shards) = calcShardActivity(nodeLoad, shardRows, nodeZone)
+profile.count(len(shardRows))
 
 if args.limit > 0:
-  if args.method == "dedup":
-    shardsToMoveDeDup(usage, shards, args.limit)
-  else:
-    logging.info("Determining which shards to move.")
-    shardsToMoveLoad(usage, shards, args.limit)
-
-  
+  exclude = args.exclude.split(',') if args.exclude else ()
+  profile.switch('plan')
+  groups = suggestMoves(esHost, esPort, usage, shards, args.method, args.limit, exclude, nodeZone)
+  profile.count(len(groups))
+
+  if args.execute and groups:
+    sizes = dict(((row[1], row[2], row[0]), row[5]) for row in shardRows)
+    plan = []
+    for (group, moves) in enumerate(groups):
+      for move in moves:
+        plan.append(es_mover.newMove(move.index, move.shard, move.source, move.destination,
+                                     sizes.get((move.index, move.shard, move.source), 0), group))
+    profile.switch('schedule')
+    (rate, incoming, outgoing) = es_schedule.recoverySettings(esHost, esPort)
+    (timeline, makespan, bound) = es_schedule.scheduleMoves(plan, rate, incoming, outgoing)
+    es_schedule.orderPlan(plan, timeline)
+    es_schedule.logTimeline(timeline, makespan, bound, rate, incoming, outgoing)
+    logging.info("Executing %d moves." % len(plan))
+    profile.switch('execute')
+    es_mover.executeMoves(esHost, esPort, plan, snapDir + "/moves.json")